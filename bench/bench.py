@@ -0,0 +1,583 @@
+#!/usr/bin/python3
+# SPDX-License-Identifier: MIT
+
+"""DistroBaker benchmark harness.
+
+Generates a set of synthetic components and times DistroBaker processing
+them end to end, fully offline.  Source and destination dist-git are local
+bare repositories, both lookaside caches are served by a local HTTP server
+with an upload CGI stand-in and both build systems by a fake koji XML-RPC
+server.  Nothing is ever contacted over the network.
+
+The harness runs in three rounds:
+
+    cold      process_components() on all components, nothing synchronized
+    warm      process_components() again, nothing changed since the last round
+    messages  process_message() on tagging events of updated components
+
+Example:
+
+    % PYTHONPATH=lib python3 bench/bench.py -n 50 --history 20 -j 4
+
+The harness is not part of the test suite and is never collected by pytest.
+"""
+
+import argparse
+import email.parser
+import email.policy
+import fnmatch
+import hashlib
+import http.server
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import xmlrpc.client
+import xmlrpc.server
+
+import koji
+
+import distrobaker
+
+logger = logging.getLogger("bench")
+
+CACHE_PATH = "%(name)s/%(filename)s/%(hashtype)s/%(hash)s/%(filename)s"
+
+CONFIG = """\
+configuration:
+  source:
+    scm: file://{root}/src
+    cache:
+      url: {lookaside}/src
+      cgi: {lookaside}/src/upload.cgi
+      path: "{path}"
+    profile: bench-source
+    mbs: http://127.0.0.1:1
+  destination:
+    scm: file://{root}/dst
+    cache:
+      url: {lookaside}/dst
+      cgi: {lookaside}/dst/upload.cgi
+      path: "{path}"
+    profile: bench-destination
+    mbs: http://127.0.0.1:1
+  trigger:
+    rpms: bench
+    modules: bench-modular
+  build:
+    prefix: file://{root}/dst
+    target: bench-candidate
+    scratch: false
+  git:
+    author: DistroBaker
+    email: noreply@example.com
+    message: Merged update from upstream sources
+  control:
+    strict: false
+    build: true
+    merge: true
+    clone: {clone}
+  defaults:
+    rpms:
+      source: "%(component)s.git"
+      destination: "%(component)s.git#bench"
+    modules:
+      source: "%(component)s.git#%(stream)s"
+      destination: "%(component)s.git#%(stream)s-bench"
+    cache:
+      source: "%(component)s"
+      destination: "%(component)s"
+"""
+
+KOJI_PROFILE = """\
+[{name}]
+server = {server}
+weburl = {server}
+topurl = {server}
+authtype = kerberos
+"""
+
+
+def git(cwd, *args):
+    """Runs a git command with a fixed identity.
+
+    :param cwd: The working directory
+    :returns: The command output
+    """
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="Bench",
+        GIT_AUTHOR_EMAIL="bench@example.com",
+        GIT_COMMITTER_NAME="Bench",
+        GIT_COMMITTER_EMAIL="bench@example.com",
+    )
+    return subprocess.run(
+        ["git"] + list(args),
+        cwd=cwd,
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    ).stdout.strip()
+
+
+class Lookaside(http.server.BaseHTTPRequestHandler):
+    """Serves lookaside cache files and mimics the upload CGI.
+
+    Files are kept in memory in `files`, keyed by the request path.
+    """
+
+    files = dict()
+    lock = threading.Lock()
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        with self.lock:
+            data = self.files.get(self.path)
+        if data is None:
+            self.reply(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+
+    def do_GET(self):
+        with self.lock:
+            data = self.files.get(self.path)
+        if data is None:
+            self.reply(404)
+            return
+        self.reply(200, data)
+
+    def do_POST(self):
+        if not self.path.endswith("/upload.cgi"):
+            self.reply(404)
+            return
+        prefix = self.path[: -len("/upload.cgi")]
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        msg = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            "Content-Type: {}\r\n\r\n".format(
+                self.headers["Content-Type"]
+            ).encode("utf-8")
+            + body
+        )
+        fields = dict()
+        upload = None
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name == "file":
+                upload = (part.get_filename(), part.get_payload(decode=True))
+            else:
+                fields[name] = part.get_payload(decode=True).decode("utf-8")
+        hashtype = "sha512" if "sha512sum" in fields else "md5"
+        digest = fields.get(hashtype + "sum")
+        filename = upload[0] if upload else fields.get("filename")
+        path = "{}/{}".format(
+            prefix,
+            CACHE_PATH
+            % {
+                "name": fields.get("name"),
+                "filename": filename,
+                "hashtype": hashtype,
+                "hash": digest,
+            },
+        )
+        if upload is None:
+            with self.lock:
+                present = path in self.files
+            self.reply(200, b"Available" if present else b"Missing")
+            return
+        if hashlib.new(hashtype, upload[1]).hexdigest() != digest:
+            self.reply(500, b"Checksum mismatch")
+            return
+        with self.lock:
+            self.files[path] = upload[1]
+        self.reply(200, "Stored {} ok".format(filename).encode("utf-8"))
+
+
+class Koji:
+    """A fake koji hub serving the calls DistroBaker makes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.builds = dict()
+        self.tasks = dict()
+        self.calls = 0
+
+    def _dispatch(self, method, params):
+        if params and isinstance(params[-1], dict) and "__starstar" in params[-1]:
+            kwargs = dict(params[-1])
+            del kwargs["__starstar"]
+            params = params[:-1]
+        else:
+            kwargs = dict()
+        with self.lock:
+            self.calls += 1
+        if method == "multiCall":
+            return [
+                [self._dispatch(x["methodName"], tuple(x["params"]))]
+                for x in params[0]
+            ]
+        if method.startswith("_") or not hasattr(self, method):
+            raise xmlrpc.client.Fault(1, "Unknown method {}".format(method))
+        return getattr(self, method)(*params, **kwargs)
+
+    def tag(self, build):
+        with self.lock:
+            self.builds[build["package_name"]] = build
+
+    def listTagged(self, tag, package=None, latest=False, **kwargs):
+        if tag != "bench":
+            return list()
+        with self.lock:
+            builds = list(self.builds.values())
+        return [x for x in builds if package in (None, x["package_name"])]
+
+    def getBuild(self, nvr, strict=False, **kwargs):
+        with self.lock:
+            for b in self.builds.values():
+                if b["nvr"] == nvr:
+                    return b
+        return None
+
+    def build(self, src, target, opts=None, **kwargs):
+        with self.lock:
+            task = len(self.tasks) + 1
+            self.tasks[task] = {
+                "id": task,
+                "method": "build",
+                "request": [src, target, opts],
+                "state": 2,
+            }
+        return task
+
+    def listBuilds(self, source=None, **kwargs):
+        with self.lock:
+            return [
+                {"task_id": x["id"], "state": 1, "source": x["request"][0]}
+                for x in self.tasks.values()
+                if source is None or fnmatch.fnmatch(x["request"][0], source)
+            ]
+
+    def listTasks(self, opts=None, **kwargs):
+        opts = opts or dict()
+        with self.lock:
+            return [
+                x
+                for x in self.tasks.values()
+                if x["state"] in opts.get("state", [x["state"]])
+            ]
+
+    def getTaskInfo(self, task, request=False, **kwargs):
+        with self.lock:
+            return self.tasks.get(task)
+
+    def logout(self, **kwargs):
+        return None
+
+    def getAPIVersion(self, **kwargs):
+        return 1
+
+    def getLoggedInUser(self, **kwargs):
+        return {"id": 1, "name": "bench"}
+
+
+def start_servers():
+    """Starts the lookaside and koji stand-ins in background threads.
+
+    :returns: A (lookaside URL, koji URL, koji instance) tuple
+    """
+    lookaside = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Lookaside)
+    threading.Thread(target=lookaside.serve_forever, daemon=True).start()
+    hub = Koji()
+    server = xmlrpc.server.SimpleXMLRPCServer(
+        ("127.0.0.1", 0), allow_none=True, logRequests=False
+    )
+    server.register_instance(hub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (
+        "http://127.0.0.1:{}".format(lookaside.server_address[1]),
+        "http://127.0.0.1:{}".format(server.server_address[1]),
+        hub,
+    )
+
+
+def commit_component(work, comp, release, files, size, rng):
+    """Records a new synthetic release of a component in its working copy
+    and publishes its sources in the source lookaside cache.
+
+    :returns: The commit hash
+    """
+    sources = list()
+    for i in range(files):
+        name = "{}-{}-{}.tar.gz".format(comp, release, i)
+        data = bytes(rng.getrandbits(8) for _ in range(size))
+        digest = hashlib.sha512(data).hexdigest()
+        sources.append("SHA512 ({}) = {}".format(name, digest))
+        path = "/src/" + CACHE_PATH % {
+            "name": "rpms/" + comp,
+            "filename": name,
+            "hashtype": "sha512",
+            "hash": digest,
+        }
+        with Lookaside.lock:
+            Lookaside.files[path] = data
+    with open(os.path.join(work, "sources"), "w") as f:
+        f.write("\n".join(sources) + "\n")
+    with open(os.path.join(work, comp + ".spec"), "w") as f:
+        f.write(
+            "Name: {}\nVersion: 1.0\nRelease: {}\nLicense: MIT\n".format(
+                comp, release
+            )
+        )
+    git(work, "add", "-A")
+    git(work, "commit", "-q", "-m", "Release {}".format(release))
+    return git(work, "rev-parse", "HEAD")
+
+
+def tag_component(hub, root, comp, release, ref):
+    """Tags a build of the given component release in the fake koji."""
+    hub.tag(
+        {
+            "package_name": comp,
+            "name": comp,
+            "version": "1.0",
+            "release": str(release),
+            "nvr": "{}-1.0-{}".format(comp, release),
+            "source": "git+file://{}/src/rpms/{}.git#{}".format(
+                root, comp, ref
+            ),
+        }
+    )
+
+
+def generate(root, hub, args):
+    """Generates the synthetic source and destination repositories.
+
+    :returns: Dictionary of component working copies
+    """
+    rng = random.Random(args.seed)
+    works = dict()
+    for n in range(args.components):
+        comp = "bench{:05d}".format(n)
+        src = os.path.join(root, "src", "rpms", comp + ".git")
+        dst = os.path.join(root, "dst", "rpms", comp + ".git")
+        work = os.path.join(root, "work", comp)
+        git(root, "init", "-q", "--bare", src)
+        git(root, "init", "-q", work)
+        git(work, "checkout", "-q", "-b", "rawhide")
+        for release in range(1, args.history + 1):
+            ref = commit_component(
+                work, comp, release, args.files, args.size * 1024, rng
+            )
+            if release == 1:
+                git(root, "clone", "-q", "--bare", work, dst)
+                git(dst, "branch", "-m", "rawhide", "bench")
+        git(work, "push", "-q", src, "rawhide")
+        tag_component(hub, root, comp, args.history, ref)
+        works[comp] = work
+    return works
+
+
+def configure(root, lookaside, hubs, args):
+    """Writes the koji profiles and the configuration repository.
+
+    :returns: The configuration `link#branch` URL
+    """
+    home = os.path.join(root, "home")
+    os.makedirs(os.path.join(home, ".koji", "config.d"))
+    with open(os.path.join(home, ".koji", "config.d", "bench.conf"), "w") as f:
+        for which in ("source", "destination"):
+            f.write(KOJI_PROFILE.format(name="bench-" + which, server=hubs))
+    os.environ["HOME"] = home
+    work = os.path.join(root, "work", "config")
+    git(root, "init", "-q", work)
+    git(work, "checkout", "-q", "-b", "main")
+    with open(os.path.join(work, "distrobaker.yaml"), "w") as f:
+        f.write(
+            CONFIG.format(
+                root=root, lookaside=lookaside, path=CACHE_PATH, clone=args.clone
+            )
+        )
+    git(work, "add", "-A")
+    git(work, "commit", "-q", "-m", "Configuration")
+    git(root, "clone", "-q", "--bare", work, os.path.join(root, "config.git"))
+    return os.path.join(root, "config.git") + "#main"
+
+
+def timed_round(name, func, count):
+    """Runs and times a single benchmark round.
+
+    :returns: The round result dictionary
+    """
+    logger.info("Running the %s round.", name)
+    start = time.monotonic()
+    func()
+    elapsed = time.monotonic() - start
+    return {
+        "round": name,
+        "components": count,
+        "seconds": round(elapsed, 3),
+        "per_second": round(count / elapsed, 3) if elapsed else None,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark DistroBaker offline.")
+    ap.add_argument("-n", "--components", type=int, default=20)
+    ap.add_argument(
+        "--history", type=int, default=10, help="commits per component"
+    )
+    ap.add_argument(
+        "--files", type=int, default=2, help="lookaside files per commit"
+    )
+    ap.add_argument(
+        "--size", type=int, default=64, help="lookaside file size in KiB"
+    )
+    ap.add_argument(
+        "--messages",
+        type=int,
+        default=10,
+        help="components updated for the messages round",
+    )
+    ap.add_argument("-j", "--jobs", type=int, default=1)
+    ap.add_argument("-c", "--cache-jobs", dest="cache_jobs", type=int, default=1)
+    ap.add_argument(
+        "--clone", choices=distrobaker.clone_strategies, default="full"
+    )
+    ap.add_argument(
+        "--git-backend",
+        dest="git_backend",
+        choices=distrobaker.git_backends,
+        default=distrobaker.git_backend(),
+    )
+    ap.add_argument("--stages", default="", help="pipeline stage workers")
+    ap.add_argument(
+        "--koji-sessions", dest="koji_sessions", type=int, default=4
+    )
+    ap.add_argument("--no-stream", dest="stream", action="store_false")
+    ap.add_argument("--state", action="store_true", help="use a state database")
+    ap.add_argument("--mirror", action="store_true", help="use a mirror store")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", action="store_true", help="print JSON only")
+    ap.add_argument("-l", "--loglevel", default="warning")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()))
+    distrobaker.loglevel(getattr(logging, args.loglevel.upper()))
+    # The fake hub does not authenticate
+    koji.ClientSession.gssapi_login = lambda self, *a, **kw: True
+
+    with tempfile.TemporaryDirectory(prefix="distrobaker-bench-") as root:
+        lookaside, hubs, hub = start_servers()
+        config = configure(root, lookaside, hubs, args)
+        logger.info("Generating %d component(s).", args.components)
+        works = generate(root, hub, args)
+        distrobaker.jobs(args.jobs)
+        distrobaker.cache_jobs(args.cache_jobs)
+        distrobaker.stream(args.stream)
+        distrobaker.stages(args.stages)
+        distrobaker.koji_sessions(args.koji_sessions)
+        distrobaker.git_backend(args.git_backend)
+        if args.state:
+            distrobaker.state(os.path.join(root, "state.db"))
+        if args.mirror:
+            distrobaker.mirror(os.path.join(root, "mirror"))
+        if distrobaker.load_config(config) is None:
+            sys.exit("Could not load the benchmark configuration.")
+
+        results = list()
+        results.append(
+            timed_round(
+                "cold",
+                lambda: distrobaker.process_components(set()),
+                args.components,
+            )
+        )
+        results.append(
+            timed_round(
+                "warm",
+                lambda: distrobaker.process_components(set()),
+                args.components,
+            )
+        )
+        rng = random.Random(args.seed + 1)
+        messages = list()
+        for comp in sorted(works)[: args.messages]:
+            release = args.history + 1
+            ref = commit_component(
+                works[comp], comp, release, args.files, args.size * 1024, rng
+            )
+            git(
+                works[comp],
+                "push",
+                "-q",
+                os.path.join(root, "src", "rpms", comp + ".git"),
+                "rawhide",
+            )
+            tag_component(hub, root, comp, release, ref)
+            messages.append(
+                types.SimpleNamespace(
+                    topic="org.fedoraproject.prod.buildsys.tag",
+                    body={
+                        "name": comp,
+                        "version": "1.0",
+                        "release": str(release),
+                        "tag": "bench",
+                    },
+                )
+            )
+        results.append(
+            timed_round(
+                "messages",
+                lambda: [distrobaker.process_message(m) for m in messages],
+                len(messages),
+            )
+        )
+        # the fake hub finishes builds instantly
+        distrobaker.poll_tasks()
+        report = {
+            "parameters": vars(args),
+            "rounds": results,
+            "koji_calls": hub.calls,
+            "builds": len(hub.tasks),
+            "build_summary": distrobaker.build_summary(),
+            "metrics": distrobaker.metrics_summary(),
+        }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for r in results:
+        print(
+            "{round:>10}  {components:>6} component(s)  {seconds:>9.3f} s  "
+            "{per_second} component(s)/s".format(**r)
+        )
+    print("{:>10}  {} call(s), {} build(s)".format("koji", hub.calls, len(hub.tasks)))
+    print("{:>10}  {}".format("outcomes", report["build_summary"]))
+    for phase, m in sorted(report["metrics"]["phases"].items()):
+        print(
+            "{:>10}  {:>6} run(s)  {:>9.3f} s  {:.3f} s average".format(
+                phase, m["count"], m["seconds"], m["average"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,264 @@
+import collections.abc
+import concurrent.futures
+import contextlib
+import hashlib
+import http.server
+import io
+import json
 import logging
 import os
+import queue
 import random
-import string
+import shutil
+import sqlite3
 import tempfile
-import datetime
+import threading
+import time
+import urllib.parse
+import uuid
 
+import fedora_messaging.exceptions
 import git
 import koji
+import pycurl
 import pyrpkg
 import regex
 import yaml
 
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
 # Global logger
 logger = logging.getLogger(__name__)
 
 # Global configuration config
 c = dict()
 
+# Serializes configuration updates so that readers never observe
+# a partially updated configuration
+config_lock = threading.Lock()
+
+# Persistent configuration repository checkouts, keyed by link
+config_checkouts = dict()
+
 # Retry attempts if things fail
 retry = 3
 
 # Running in the dry run mode
 dry_run = False
 
+# Number of components processed concurrently
+workers = 1
+
+# Number of lookaside cache files transferred concurrently per component
+cache_workers = 1
+
+# Limit of lookaside cache transfers across all components; unlimited if None
+cache_limit = None
+
+# Semaphore enforcing cache_limit
+cache_slots = None
+
+# Stream lookaside cache files directly from the source to the destination
+streaming = True
+
+# Path to the persistent state database; disabled if None
+state_path = None
+
+# The state database connection, opened on first use
+state_db = None
+
+# Serializes access to the state database
+state_lock = threading.Lock()
+
+# Destination lookaside cache files known to be present during this run,
+# as (cgi, name, filename, hash) tuples
+cache_present = set()
+
+# Guards cache_present
+cache_present_lock = threading.Lock()
+
+# Triggers waiting to be processed in the service mode, keyed by
+# (namespace, component); each holds the newest NVR, the state row IDs of
+# all coalesced triggers and the time the trigger becomes due
+pending = dict()
+
+# Components currently being processed by the workers
+running = set()
+
+# The last successfully synchronized NVR of each component
+synced = dict()
+
+# Guards pending, running and synced and wakes up the workers
+work = threading.Condition()
+
+# Worker threads started by start_workers()
+worker_threads = list()
+
+# Tells the workers to exit, see stop_workers()
+stopping = threading.Event()
+
+# Debounce window for coalescing repeated triggers, in seconds
+debounce = 0
+
+# Estimated processing durations of components in seconds, keyed by the
+# (namespace, component) tuple; loaded from the state database on first use
+durations = dict()
+
+# Whether durations were loaded from the state database
+durations_loaded = False
+
+# Guards durations
+durations_lock = threading.Lock()
+
+# Root directory of the persistent git mirror store; disabled if None
+mirror_root = None
+
+# Mirror store size cap in bytes; unlimited if None
+mirror_cap = None
+
+# Guards the mirror store bookkeeping
+mirror_lock = threading.Lock()
+
+# Per-mirror locks, keyed by the mirror path
+mirror_locks = dict()
+
+# Sizes in bytes and last use times of the mirrors, keyed by the mirror
+# path; the store is scanned once and then only updated mirrors measured
+mirror_index = None
+
+# Latency histogram bucket upper bounds, in seconds
+metrics_buckets = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+# Guards timings and counters
+metrics_lock = threading.Lock()
+
+# Per-phase latency histograms, keyed by the phase name
+timings = dict()
+
+# Counters, keyed by the (name, phase) tuple
+counters = dict()
+
+# Base delay of the exponential retry backoff, in seconds
+backoff_base = 1.0
+
+# Maximum delay between two retry attempts, in seconds
+backoff_max = 60.0
+
+# Consecutive failures after which an endpoint circuit opens
+breaker_threshold = 5
+
+# Seconds an open endpoint circuit stays open before another attempt
+breaker_cooldown = 60.0
+
+# Endpoint circuit breaker states, keyed by the endpoint host
+breakers = dict()
+
+# Guards breakers
+breaker_lock = threading.Lock()
+
+# Per-host concurrency and rate limiters, keyed by the endpoint host
+limiters = dict()
+
+# Configured per-host limits, including the `default` entry
+limits = dict()
+
+# Guards limiters and limits
+limits_lock = threading.Lock()
+
+# git error messages that retrying will not fix
+fatal_git_errors = (
+    "not found",
+    "does not exist",
+    "does not appear to be a git repository",
+    "did not match any",
+    "couldn't find remote ref",
+    "permission denied",
+    "authentication failed",
+    "could not read username",
+    "[rejected]",
+    "[remote rejected]",
+    "can only be used with the remote configured",
+)
+
+# Supported git backends for the in-repository operations
+git_backends = ("git", "pygit2")
+
+# The git backend in use; pygit2 runs merges in-process if available
+backend = "pygit2" if pygit2 is not None else "git"
+
+# Synchronization pipeline stages, in order
+stage_names = ("git", "cache", "push", "build")
+
+# Worker threads per pipeline stage; the pipeline is disabled if empty
+# and every component runs all its stages in the calling thread
+stage_workers = dict()
+
+# Pipeline stage queues, keyed by the stage name; started on first use
+stage_queues = dict()
+
+# Serializes the pipeline startup
+stage_lock = threading.Lock()
+
+# Per-thread cache of lookaside cache curl handles
+sessions = threading.local()
+
+# Interval in seconds between the build task polls; disabled if 0
+watch_interval = 60
+
+# Submitted build tasks being watched, keyed by the task ID
+watched = dict()
+
+# The destination build system user ID; looked up on first use
+build_owner = None
+
+# Outcomes of finished build tasks, keyed by the task ID
+outcomes = dict()
+
+# Serializes access to the watched tasks and their outcomes
+watch_lock = threading.Lock()
+
+# The build task watcher thread; started on first use
+watcher_thread = None
+
+# Build system session pools, keyed by the side, source or destination
+pools = dict()
+
+# Serializes the build system session pool creation
+pools_lock = threading.Lock()
+
+# Maximum number of build system sessions per side
+pool_size = 4
+
+# Build system session lifetime in seconds; slightly less than an hour,
+# the usual koji session expiry, to be safe
+session_lifetime = 3550
+
+# Sessions are renewed in the background this many seconds before they expire
+session_renewal = 300
+
+# Interval in seconds between the background session health checks
+session_check = 60
+
 # sources file regular expression
 sre = regex.compile(
     r"^(?>(?P<hash>[a-f0-9]{32})  (?P<file>.+)|SHA512 \((?P<file>.+)\) = (?<hash>[a-f0-9]{128}))$"
 )
 
+# Supported repository clone strategies
+clone_strategies = ("full", "shallow", "blobless")
+
+# Maximum number of history deepening rounds for shallow clones before
+# fetching the complete history
+deepen_rounds = 5
+
 # Matching the namespace/component text format
 cre = regex.compile(
     r"^(?P<namespace>rpms|modules)/(?P<component>[A-Za-z0-9:._+-]+)$"
@@ -78,185 +309,1221 @@ def pretend(val=None):
     return dry_run
 
 
-def get_config():
-    """Gets the current global configuration dictionary.
+def jobs(val=None):
+    """Gets or, optionally, sets the number of components processed
+    concurrently.  Like the other module settings, this is expected to be
+    set before any processing starts.
 
-    The dictionary may be empty if no configuration has been successfully
-    loaded yet.
+    :param val: The number of parallel jobs, optional
+    :returns: The current number of parallel jobs
+    """
+    global workers
+    if val is not None:
+        workers = max(1, val)
+    return workers
 
-    :returns: The global configuration dictionary
+
+def cache_jobs(val=None):
+    """Gets or, optionally, sets the number of lookaside cache files
+    transferred concurrently for a single component.
+
+    :param val: The number of parallel transfers per component, optional
+    :returns: The current number of parallel transfers per component
     """
-    return c
+    global cache_workers
+    if val is not None:
+        cache_workers = max(1, val)
+    return cache_workers
 
 
-def split_scmurl(scmurl):
-    """Splits a `link#ref` style URLs into the link and ref parts.  While
-    generic, many code paths in DistroBaker expect these to be branch names.
-    `link` forms are also accepted, in which case the returned `ref` is None.
+def cache_jobs_total(val=None):
+    """Gets or, optionally, sets the global limit of concurrent lookaside
+    cache transfers across all components.  Set to 0 to disable the limit.
 
-    It also attempts to extract the namespace and component, where applicable.
-    These can only be detected if the link matches the standard dist-git
-    pattern; in other cases the results may be bogus or None.
+    :param val: The global number of parallel transfers, optional
+    :returns: The current global limit, or None if unlimited
+    """
+    global cache_limit, cache_slots
+    if val is not None:
+        cache_limit = val if val > 0 else None
+        cache_slots = threading.BoundedSemaphore(val) if val > 0 else None
+    return cache_limit
 
-    :param scmurl: A link#ref style URL, with #ref being optional
-    :returns: A dictionary with `link`, `ref`, `ns` and `comp` keys
+
+def koji_sessions(val=None):
+    """Gets or, optionally, sets the maximum number of build system
+    sessions kept per side.  Callers beyond this many wait for a session
+    to be returned to the pool.
+
+    :param val: The number of sessions per side, optional
+    :returns: The current number of sessions per side
     """
-    scm = scmurl.split("#", 1)
-    nscomp = scm[0].split("/")
-    return {
-        "link": scm[0],
-        "ref": scm[1] if len(scm) >= 2 else None,
-        "ns": nscomp[-2] if len(nscomp) >= 2 else None,
-        "comp": nscomp[-1] if nscomp else None,
-    }
+    global pool_size
+    if val is not None:
+        pool_size = max(1, val)
+    return pool_size
 
 
-def split_module(comp):
-    """Splits modules component name into name and stream pair.  Expects the
-    name to be in the `name:stream` format.  Defaults to stream=master if the
-    split fails.
+def watch(val=None):
+    """Gets or, optionally, sets the interval between the polls of the
+    submitted build tasks.  All watched tasks are polled at once.  Set to 0
+    to disable watching.
 
-    :param comp: The component name
-    :returns: Dictionary with name and stream
+    :param val: The poll interval in seconds, optional
+    :returns: The current poll interval in seconds
     """
-    ms = comp.split(":")
-    return {
-        "name": ms[0],
-        "stream": ms[1] if len(ms) > 1 and ms[1] else "master",
-    }
+    global watch_interval
+    if val is not None:
+        watch_interval = max(0, val)
+    return watch_interval
 
 
-def parse_sources(comp, ns, sources):
-    """Parses the supplied source file and generates a set of
-    tuples containing the filename, the hash, and the hashtype.
+def stream(val=None):
+    """Gets or, optionally, sets whether lookaside cache files are streamed
+    from the source to the destination cache instead of being staged on
+    the local disk first.
 
-    :param comps: The component we are parsing
-    :param ns: The namespace of the component
-    :param sources: The sources file to parse
-    :returns: A set of tuples containing the filename, the hash, and the hashtype, or None on error
+    :param val: True to stream files, False to stage them, optional
+    :returns: The current value of the streaming mode
     """
-    src = set()
-    try:
-        if not os.path.isfile(sources):
-            logger.debug("No sources file found for %s/%s.", ns, comp)
-            return set()
-        with open(sources, "r") as fh:
-            for line in fh:
-                m = sre.match(line.rstrip())
-                if m is None:
-                    logger.error(
-                        'Cannot parse "%s" from sources of %s/%s.',
-                        line,
-                        ns,
-                        comp,
-                    )
-                    return None
-                m = m.groupdict()
-                src.add(
-                    (
-                        m["file"],
-                        m["hash"],
-                        "sha512" if len(m["hash"]) == 128 else "md5",
-                    )
-                )
-    except Exception:
-        logger.exception("Error processing sources of %s/%s.", ns, comp)
-        return None
-    logger.debug("Found %d source file(s) for %s/%s.", len(src), ns, comp)
-    return src
+    global streaming
+    if val is not None:
+        streaming = val
+    return streaming
 
 
-# FIXME: This needs even more error checking, e.g.
-#         - check if blocks are actual dictionaries
-#         - check if certain values are what we expect
-def load_config(crepo):
-    """Loads or updates the global configuration from the provided URL in
-    the `link#branch` format.  If no branch is provided, assumes `master`.
+def state(val=None):
+    """Gets or, optionally, sets the path to the persistent state database.
+    The database remembers, among other things, which lookaside cache files
+    are known to be present in the destination cache.  Set to an empty
+    string to disable the persistent state.
 
-    The operation is atomic and the function can be safely called to update
-    the configuration without the danger of clobbering the current one.
+    :param val: The state database path, optional
+    :returns: The current state database path, or None if disabled
+    """
+    global state_path, state_db
+    if val is not None:
+        with state_lock:
+            if state_db is not None:
+                state_db.close()
+                state_db = None
+            state_path = os.path.abspath(val) if val else None
+    return state_path
 
-    `crepo` must be a git repository with `distrobaker.yaml` in it.
 
-    :param crepo: `link#branch` style URL pointing to the configuration
-    :returns: The configuration dictionary, or None on error
+def state_query(sql, params=(), rowid=False):
+    """Runs a statement against the state database, opening and
+    initializing the database on first use.  Safe to be called
+    concurrently.
+
+    :param sql: The SQL statement
+    :param params: The statement parameters, optional
+    :param rowid: Return the ID of the last inserted row instead, optional
+    :returns: A list of result rows or the row ID, or None if the state is disabled or on error
     """
-    global c
-    cdir = tempfile.TemporaryDirectory(prefix="distrobaker-")
-    logger.info("Fetching configuration from %s to %s", crepo, cdir.name)
-    scm = split_scmurl(crepo)
-    if scm["ref"] is None:
-        scm["ref"] = "master"
-    for attempt in range(retry):
+    global state_db
+    with state_lock:
+        if state_path is None:
+            return None
         try:
-            git.Repo.clone_from(scm["link"], cdir.name).git.checkout(
-                scm["ref"]
-            )
+            if state_db is None:
+                logger.debug("Opening the state database %s.", state_path)
+                state_db = sqlite3.connect(state_path, check_same_thread=False)
+                state_db.execute(
+                    "CREATE TABLE IF NOT EXISTS lookaside ("
+                    "cache TEXT, name TEXT, filename TEXT, hash TEXT, "
+                    "PRIMARY KEY (cache, name, filename, hash))"
+                )
+                state_db.execute(
+                    "CREATE TABLE IF NOT EXISTS syncs ("
+                    "ns TEXT, comp TEXT, source TEXT, destination TEXT, "
+                    "head TEXT, nvr TEXT, task INTEGER, updated REAL, "
+                    "PRIMARY KEY (ns, comp))"
+                )
+                state_db.execute(
+                    "CREATE TABLE IF NOT EXISTS durations ("
+                    "ns TEXT, comp TEXT, seconds REAL, "
+                    "PRIMARY KEY (ns, comp))"
+                )
+                state_db.execute(
+                    "CREATE TABLE IF NOT EXISTS builds ("
+                    "task INTEGER PRIMARY KEY, ns TEXT, comp TEXT, nvr TEXT, "
+                    "state TEXT, submitted REAL, finished REAL)"
+                )
+                state_db.execute(
+                    "CREATE TABLE IF NOT EXISTS queue ("
+                    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "ns TEXT, comp TEXT, nvr TEXT)"
+                )
+                state_db.commit()
+            cursor = state_db.execute(sql, params)
+            rows = cursor.lastrowid if rowid else cursor.fetchall()
+            state_db.commit()
         except Exception:
-            logger.warning(
-                "Failed to fetch configuration, retrying (#%d).",
-                attempt + 1,
-                exc_info=True,
-            )
-            continue
-        else:
-            logger.info("Configuration fetched successfully.")
-            break
-    else:
-        logger.error("Failed to fetch configuration, giving up.")
+            logger.exception("Failed querying the state database.")
+            return None
+    return rows
+
+
+def get_sync_state(ns, comp):
+    """Gets the recorded state of the last synchronization of the given
+    component from the state database.
+
+    :param ns: The component namespace
+    :param comp: The component name
+    :returns: A dictionary with the `source`, `destination`, `head`, `nvr`
+              and `task` keys, or None if unknown
+    """
+    rows = state_query(
+        "SELECT source, destination, head, nvr, task FROM syncs "
+        "WHERE ns = ? AND comp = ?",
+        (ns, comp),
+    )
+    if not rows:
         return None
-    if os.path.isfile(os.path.join(cdir.name, "distrobaker.yaml")):
-        try:
-            with open(os.path.join(cdir.name, "distrobaker.yaml")) as f:
-                y = yaml.safe_load(f)
-            logger.debug(
-                "%s loaded, processing.",
-                os.path.join(cdir.name, "distrobaker.yaml"),
+    return dict(zip(("source", "destination", "head", "nvr", "task"), rows[0]))
+
+
+def set_sync_state(ns, comp, **kwargs):
+    """Records the state of a synchronization of the given component in the
+    state database.  Accepts the same keys get_sync_state() returns; keys
+    not passed are left untouched.
+
+    :param ns: The component namespace
+    :param comp: The component name
+    :returns: None
+    """
+    state_query(
+        "INSERT OR IGNORE INTO syncs (ns, comp) VALUES (?, ?)", (ns, comp)
+    )
+    for k, v in kwargs.items():
+        if k not in ("source", "destination", "head", "nvr", "task"):
+            raise ValueError("Unknown sync state key: {}".format(k))
+        state_query(
+            "UPDATE syncs SET {} = ?, updated = ? WHERE ns = ? AND comp = ?".format(
+                k
+            ),
+            (v, time.time(), ns, comp),
+        )
+    return None
+
+
+def mirror(val=None):
+    """Gets or, optionally, sets the root directory of the persistent git
+    mirror store.  Set to an empty string to disable mirroring.
+
+    :param val: The mirror store root directory, optional
+    :returns: The current mirror store root directory, or None if disabled
+    """
+    global mirror_root, mirror_index
+    if val is not None:
+        mirror_root = os.path.abspath(val) if val else None
+        mirror_index = None
+    return mirror_root
+
+
+def mirror_size(val=None):
+    """Gets or, optionally, sets the mirror store size cap in bytes.
+    Least recently used mirrors are evicted once the cap is exceeded.
+    Set to 0 to disable the cap.
+
+    :param val: The size cap in bytes, optional
+    :returns: The current size cap in bytes, or None if unlimited
+    """
+    global mirror_cap
+    if val is not None:
+        mirror_cap = val if val > 0 else None
+    return mirror_cap
+
+
+def coalesce(val=None):
+    """Gets or, optionally, sets the debounce window for coalescing repeated
+    triggers of the same component in the service mode.  Triggers are held
+    back for this long after the last trigger of the component arrived and
+    only the newest NVR is processed.
+
+    :param val: The debounce window in seconds, optional
+    :returns: The current debounce window in seconds
+    """
+    global debounce
+    if val is not None:
+        debounce = max(0, val)
+    return debounce
+
+
+def git_backend(val=None):
+    """Gets or, optionally, sets the git backend used for merging.  The
+    `pygit2` backend merges in-process, without spawning git, and is only
+    available if pygit2 is installed; the `git` backend uses the git
+    command line tools through GitPython.
+
+    :param val: The backend name, optional
+    :returns: The current backend name
+    """
+    global backend
+    if val is not None:
+        if val not in git_backends:
+            raise ValueError("Unknown git backend: {}".format(val))
+        if val == "pygit2" and pygit2 is None:
+            logger.warning("pygit2 is not available, using the git backend.")
+            val = "git"
+        backend = val
+    return backend
+
+
+def stages(val=None):
+    """Gets or, optionally, sets the number of worker threads of each
+    synchronization pipeline stage.  With the pipeline enabled, the `git`,
+    `cache`, `push` and `build` stages of different components overlap, each
+    stage bounded by its own worker count.  Stages not listed get a single
+    worker.  An empty value disables the pipeline.
+
+    :param val: A dictionary or a `stage=N,...` string of worker counts, optional
+    :returns: The current dictionary of worker counts per stage
+    """
+    global stage_workers
+    if val is not None:
+        if isinstance(val, str):
+            val = dict(
+                x.split("=", 1) for x in val.replace(" ", "").split(",") if x
             )
-        except Exception:
-            logger.exception("Could not parse distrobaker.yaml.")
-            return None
-    else:
-        logger.error(
-            "Configuration repository does not contain distrobaker.yaml."
+        for k in val:
+            if k not in stage_names:
+                raise ValueError("Unknown pipeline stage: {}".format(k))
+        stage_workers = (
+            {k: max(1, int(val.get(k, 1))) for k in stage_names}
+            if val
+            else dict()
         )
-        return None
-    n = dict()
-    if "configuration" in y:
-        cnf = y["configuration"]
-        for k in ("source", "destination"):
-            if k in cnf:
-                n[k] = dict()
-                if "scm" in cnf[k]:
-                    n[k]["scm"] = str(cnf[k]["scm"])
-                else:
-                    logger.error("Configuration error: %s.scm missing.", k)
-                    return None
-                if "cache" in cnf[k]:
-                    n[k]["cache"] = dict()
-                    for kc in ("url", "cgi", "path"):
-                        if kc in cnf[k]["cache"]:
-                            n[k]["cache"][kc] = str(cnf[k]["cache"][kc])
-                        else:
-                            logger.error(
-                                "Configuration error: %s.cache.%s missing.",
-                                k,
-                                kc,
-                            )
-                            return None
-                else:
-                    logger.error("Configuration error: %s.cache missing.", k)
-                    return None
-                if "profile" in cnf[k]:
-                    n[k]["profile"] = str(cnf[k]["profile"])
-                else:
-                    logger.error("Configuration error: %s.profile missing.", k)
-                    return None
-                if "mbs" in cnf[k]:
-                    n[k]["mbs"] = str(cnf[k]["mbs"])
-                else:
-                    logger.error("Configuration error: %s.mbs missing.", k)
-                    return None
+    return stage_workers
+
+
+def job_slots():
+    """Gets the number of components actually processed concurrently.
+    This is `jobs()`, raised to the total number of pipeline stage workers
+    with the pipeline enabled, as every component in flight occupies its
+    caller until it leaves the pipeline and fewer would leave stage
+    workers idle.
+
+    :returns: The number of concurrently processed components
+    """
+    return max(workers, sum(stage_workers.values()))
+
+
+def backoff(val=None):
+    """Gets or, optionally, sets the base delay of the exponential retry
+    backoff.  The n-th retry waits a random time of up to `val * 2^(n-1)`
+    seconds, capped at one minute.
+
+    :param val: The base delay in seconds, optional
+    :returns: The current base delay in seconds
+    """
+    global backoff_base
+    if val is not None:
+        backoff_base = max(0, val)
+    return backoff_base
+
+
+class CircuitOpenError(Exception):
+    """Raised when an operation is not attempted because its endpoint
+    failed repeatedly and its circuit breaker is open.  The `remaining`
+    attribute holds the seconds left until the circuit lets attempts
+    through again."""
+
+    def __init__(self, message, remaining=0):
+        super().__init__(message)
+        self.remaining = remaining
+
+
+def get_endpoint(link):
+    """Gets the endpoint, i.e. the host, a link points to.  Local paths
+    share a single `local` endpoint.
+
+    :param link: A URL, scp-style git link or a local path
+    :returns: The endpoint name
+    """
+    if "://" in link:
+        return urllib.parse.urlsplit(link).hostname or "local"
+    if ":" in link and not link.startswith("/"):
+        return link.split(":", 1)[0].split("@")[-1]
+    return "local"
+
+
+def is_retryable(e):
+    """Classifies an exception as either transient, worth retrying, or
+    fatal.
+
+    :param e: The exception
+    :returns: True if the operation should be retried, False otherwise
+    """
+    if isinstance(e, CircuitOpenError):
+        return True
+    if isinstance(e, (AttributeError, KeyError, TypeError, ValueError)):
+        return False
+    if isinstance(e, git.exc.GitCommandError):
+        err = str(e.stderr).lower()
+        return not any(x in err for x in fatal_git_errors)
+    return True
+
+
+def circuit_check(endpoint):
+    """Raises CircuitOpenError if the circuit of the endpoint is open.
+    Once the cooldown passes, attempts are let through again; a single
+    further failure reopens the circuit.
+
+    :param endpoint: The endpoint name
+    :returns: None
+    """
+    with breaker_lock:
+        b = breakers.get(endpoint)
+        if (
+            b is not None
+            and b["failures"] >= breaker_threshold
+            and time.monotonic() - b["opened"] < breaker_cooldown
+        ):
+            remaining = breaker_cooldown - time.monotonic() + b["opened"]
+            raise CircuitOpenError(
+                "The {} endpoint failed {} times in a row, not trying it "
+                "for {:.0f} seconds.".format(endpoint, b["failures"], remaining),
+                remaining,
+            )
+    return None
+
+
+def blame(e, endpoint):
+    """Attributes an exception to the endpoint that caused it, so that
+    operations involving several endpoints record their failures against
+    the right circuit, see with_retry().
+
+    :param e: The exception
+    :param endpoint: The endpoint name, see get_endpoint()
+    :returns: The exception
+    """
+    e.endpoint = endpoint
+    return e
+
+
+def circuit_record(endpoint, success):
+    """Records the outcome of an operation on the endpoint.
+
+    :param endpoint: The endpoint name
+    :param success: True if the operation succeeded
+    :returns: None
+    """
+    with breaker_lock:
+        if success:
+            breakers.pop(endpoint, None)
+            return None
+        b = breakers.setdefault(endpoint, {"failures": 0, "opened": 0})
+        b["failures"] += 1
+        if b["failures"] >= breaker_threshold:
+            if b["failures"] == breaker_threshold:
+                logger.warning(
+                    "The %s endpoint failed %d times in a row, opening its circuit.",
+                    endpoint,
+                    b["failures"],
+                )
+            b["opened"] = time.monotonic()
+    return None
+
+
+class Limiter:
+    """Limits the number of concurrent operations on a host and, using
+    a token bucket, the rate at which new operations are started.  Used as
+    a context manager around every single operation.
+    """
+
+    def __init__(self, connections=0, rate=0, burst=1):
+        """Creates the limiter.
+
+        :param connections: Maximum concurrent operations, 0 for unlimited
+        :param rate: Maximum operations started per second, 0 for unlimited
+        :param burst: Operations that can be started at once before the rate applies
+        """
+        self.settings = (connections, rate, burst)
+        self.slots = threading.BoundedSemaphore(connections) if connections else None
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Takes a token from the bucket, waiting for one if necessary."""
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def __enter__(self):
+        if self.slots is not None:
+            self.slots.acquire()
+        try:
+            self.take()
+        except BaseException:
+            if self.slots is not None:
+                self.slots.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        if self.slots is not None:
+            self.slots.release()
+        return False
+
+
+def configure_limits(val):
+    """Sets the per-host limits.  Limiters of hosts whose limits did not
+    change are kept, so that operations in progress stay accounted for.
+
+    :param val: Dictionary of host names, or `default`, to dictionaries
+                with the `connections`, `rate` and `burst` keys
+    :returns: None
+    """
+    global limits
+    with limits_lock:
+        limits = dict(val)
+        for host in list(limiters):
+            lim = limits.get(host, limits.get("default"))
+            if lim is None or limiters[host].settings != (
+                lim["connections"],
+                lim["rate"],
+                lim["burst"],
+            ):
+                del limiters[host]
+    return None
+
+
+def get_limiter(endpoint):
+    """Gets the limiter of the given endpoint.
+
+    :param endpoint: The endpoint name, see get_endpoint()
+    :returns: The limiter, or None if the endpoint is not limited
+    """
+    with limits_lock:
+        if endpoint not in limiters:
+            lim = limits.get(endpoint, limits.get("default"))
+            if lim is None:
+                return None
+            limiters[endpoint] = Limiter(
+                lim["connections"], lim["rate"], lim["burst"]
+            )
+        return limiters[endpoint]
+
+
+@contextlib.contextmanager
+def throttle(*endpoints):
+    """Context manager holding a slot of every given endpoint for the
+    duration of an operation, see Limiter.  Endpoints are always acquired
+    in the same order to prevent deadlocks.
+
+    :param endpoints: The endpoint names, see get_endpoint()
+    """
+    with contextlib.ExitStack() as stack:
+        for endpoint in sorted(set(endpoints)):
+            limiter = get_limiter(endpoint)
+            if limiter is not None:
+                stack.enter_context(limiter)
+        yield
+
+
+def with_retry(func, endpoint, what, phase, also=()):
+    """Calls func, retrying transient failures up to `retries()` times with
+    an exponential backoff and jitter.  Fatal errors are not retried and
+    endpoints failing repeatedly are not attempted for a while, see
+    circuit_check(); attempts hitting an open circuit wait for at least
+    its remaining cooldown before the next one.
+
+    Every attempt is throttled according to the limits of the endpoint and
+    any other endpoints involved, see throttle().  Failures count against
+    the circuit of the endpoint the exception is attributed to, see blame(),
+    and the main endpoint otherwise.
+
+    :param func: The function to call, without arguments
+    :param endpoint: The endpoint the function talks to, see get_endpoint()
+    :param what: Description of the operation for logging
+    :param phase: The metrics phase name for the retry counter
+    :param also: Other endpoints the function talks to, optional
+    :returns: The func return value
+    :raises: The last exception if all attempts failed, or CircuitOpenError
+    """
+    attempts = max(1, retry)
+    for attempt in range(attempts):
+        try:
+            for name in sorted({endpoint, *also}):
+                circuit_check(name)
+            with throttle(endpoint, *also):
+                result = func()
+        except Exception as e:
+            if not is_retryable(e):
+                logger.warning(
+                    "%s failed with a non-retryable error.",
+                    what,
+                    exc_info=True,
+                )
+                raise
+            if not isinstance(e, CircuitOpenError):
+                circuit_record(getattr(e, "endpoint", endpoint), False)
+            if attempt + 1 >= attempts:
+                logger.warning(
+                    "%s attempt #%d/%d failed.",
+                    what,
+                    attempt + 1,
+                    attempts,
+                    exc_info=True,
+                )
+                raise
+            count("retries", phase)
+            delay = random.uniform(
+                0, min(backoff_max, backoff_base * 2 ** attempt)
+            )
+            if isinstance(e, CircuitOpenError):
+                delay += e.remaining
+            logger.warning(
+                "%s attempt #%d/%d failed, retrying in %.1f seconds.",
+                what,
+                attempt + 1,
+                attempts,
+                delay,
+                exc_info=True,
+            )
+            time.sleep(delay)
+        else:
+            for name in {endpoint, *also}:
+                circuit_record(name, True)
+            return result
+
+
+def observe(phase, seconds):
+    """Records the duration of a single run of the given phase.
+
+    :param phase: The phase name
+    :param seconds: The duration in seconds
+    :returns: None
+    """
+    with metrics_lock:
+        t = timings.setdefault(
+            phase,
+            {"buckets": [0] * len(metrics_buckets), "count": 0, "sum": 0.0},
+        )
+        for i, b in enumerate(metrics_buckets):
+            if seconds <= b:
+                t["buckets"][i] += 1
+        t["count"] += 1
+        t["sum"] += seconds
+    return None
+
+
+def count(name, phase, val=1):
+    """Increments a counter, such as the transferred bytes or retries,
+    of the given phase.
+
+    :param name: The counter name
+    :param phase: The phase name
+    :param val: The increment, optional
+    :returns: None
+    """
+    with metrics_lock:
+        counters[(name, phase)] = counters.get((name, phase), 0) + val
+    return None
+
+
+@contextlib.contextmanager
+def timed(phase):
+    """Context manager and decorator recording the duration of the wrapped
+    code as a run of the given phase.
+
+    :param phase: The phase name
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(phase, time.monotonic() - start)
+
+
+def metrics_summary():
+    """Gets a summary of the collected metrics suitable for logging.
+
+    :returns: A dictionary with the `phases`, `counters` and `queue` keys
+    """
+    with metrics_lock:
+        phases = {
+            k: {
+                "count": v["count"],
+                "seconds": round(v["sum"], 3),
+                "average": round(v["sum"] / v["count"], 3)
+                if v["count"]
+                else 0,
+            }
+            for k, v in timings.items()
+        }
+        cnt = dict()
+        for (name, phase), v in counters.items():
+            cnt.setdefault(name, dict())[phase] = v
+    return {"phases": phases, "counters": cnt, "queue": queue_depth()}
+
+
+def metrics_text():
+    """Renders the collected metrics in the Prometheus text exposition
+    format.
+
+    :returns: The metrics text
+    """
+    lines = [
+        "# HELP distrobaker_phase_seconds Duration of synchronization phases.",
+        "# TYPE distrobaker_phase_seconds histogram",
+    ]
+    with metrics_lock:
+        for phase, t in sorted(timings.items()):
+            for b, n in zip(metrics_buckets, t["buckets"]):
+                lines.append(
+                    'distrobaker_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(
+                        phase, b, n
+                    )
+                )
+            lines.append(
+                'distrobaker_phase_seconds_bucket{{phase="{}",le="+Inf"}} {}'.format(
+                    phase, t["count"]
+                )
+            )
+            lines.append(
+                'distrobaker_phase_seconds_sum{{phase="{}"}} {}'.format(
+                    phase, t["sum"]
+                )
+            )
+            lines.append(
+                'distrobaker_phase_seconds_count{{phase="{}"}} {}'.format(
+                    phase, t["count"]
+                )
+            )
+        names = sorted({x[0] for x in counters})
+        for name in names:
+            lines.append("# TYPE distrobaker_{}_total counter".format(name))
+            for (n, phase), v in sorted(counters.items()):
+                if n == name:
+                    lines.append(
+                        'distrobaker_{}_total{{phase="{}"}} {}'.format(
+                            name, phase, v
+                        )
+                    )
+    lines.append("# HELP distrobaker_queue_depth Triggers waiting in the queue.")
+    lines.append("# TYPE distrobaker_queue_depth gauge")
+    lines.append("distrobaker_queue_depth {}".format(queue_depth()))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the collected metrics in the Prometheus text format."""
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request: " + format, *args)
+
+
+def serve_metrics(port, address="127.0.0.1"):
+    """Starts serving the collected metrics over HTTP in a background
+    thread.
+
+    :param port: The port to listen on
+    :param address: The address to listen on, optional
+    :returns: The server instance, or None on error
+    """
+    try:
+        server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    except Exception:
+        logger.exception("Could not start the metrics endpoint on port %d.", port)
+        return None
+    threading.Thread(
+        target=server.serve_forever, name="metrics", daemon=True
+    ).start()
+    logger.info("Serving metrics on http://%s:%d/metrics.", address, port)
+    return server
+
+
+def get_config():
+    """Gets the current global configuration dictionary.
+
+    The dictionary may be empty if no configuration has been successfully
+    loaded yet.
+
+    :returns: The global configuration dictionary
+    """
+    return c
+
+
+def split_scmurl(scmurl):
+    """Splits a `link#ref` style URLs into the link and ref parts.  While
+    generic, many code paths in DistroBaker expect these to be branch names.
+    `link` forms are also accepted, in which case the returned `ref` is None.
+
+    It also attempts to extract the namespace and component, where applicable.
+    These can only be detected if the link matches the standard dist-git
+    pattern; in other cases the results may be bogus or None.
+
+    :param scmurl: A link#ref style URL, with #ref being optional
+    :returns: A dictionary with `link`, `ref`, `ns` and `comp` keys
+    """
+    scm = scmurl.split("#", 1)
+    nscomp = scm[0].split("/")
+    return {
+        "link": scm[0],
+        "ref": scm[1] if len(scm) >= 2 else None,
+        "ns": nscomp[-2] if len(nscomp) >= 2 else None,
+        "comp": nscomp[-1] if nscomp else None,
+    }
+
+
+def split_module(comp):
+    """Splits modules component name into name and stream pair.  Expects the
+    name to be in the `name:stream` format.  Defaults to stream=master if the
+    split fails.
+
+    :param comp: The component name
+    :returns: Dictionary with name and stream
+    """
+    ms = comp.split(":")
+    return {
+        "name": ms[0],
+        "stream": ms[1] if len(ms) > 1 and ms[1] else "master",
+    }
+
+
+def vercmp(a, b):
+    """Compares two version or release strings the way RPM does.  Used
+    when the rpm bindings are not available.
+
+    :param a: The first version string
+    :param b: The second version string
+    :returns: 1 if a is newer than b, -1 if older, 0 if equal
+    """
+    if a == b:
+        return 0
+    while a or b:
+        a = regex.sub(r"^[^a-zA-Z0-9~^]+", "", a)
+        b = regex.sub(r"^[^a-zA-Z0-9~^]+", "", b)
+        # tilde sorts before everything, even the end of the string
+        if a.startswith("~") or b.startswith("~"):
+            if not a.startswith("~"):
+                return 1
+            if not b.startswith("~"):
+                return -1
+            a, b = a[1:], b[1:]
+            continue
+        # caret sorts after the end of the string but before anything else
+        if a.startswith("^") or b.startswith("^"):
+            if not a:
+                return -1
+            if not b:
+                return 1
+            if not a.startswith("^"):
+                return 1
+            if not b.startswith("^"):
+                return -1
+            a, b = a[1:], b[1:]
+            continue
+        if not a or not b:
+            break
+        numeric = a[0] in "0123456789"
+        pattern = r"^[0-9]+" if numeric else r"^[a-zA-Z]+"
+        x = regex.match(pattern, a).group()
+        y = regex.match(pattern, b)
+        if y is None:
+            # numeric segments are newer than alphabetic ones
+            return 1 if numeric else -1
+        y = y.group()
+        a, b = a[len(x):], b[len(y):]
+        if numeric:
+            x, y = x.lstrip("0"), y.lstrip("0")
+            if len(x) != len(y):
+                return 1 if len(x) > len(y) else -1
+        if x != y:
+            return 1 if x > y else -1
+    if not a and not b:
+        return 0
+    return 1 if a else -1
+
+
+def compare_nvrs(a, b):
+    """Compares two NVRs of the same component by their versions and
+    releases, using the rpm bindings if available.  NVRs that cannot be
+    parsed compare as equal.
+
+    :param a: The first NVR
+    :param b: The second NVR
+    :returns: 1 if a is newer than b, -1 if older, 0 if equal
+    """
+    try:
+        a, b = koji.parse_NVR(a), koji.parse_NVR(b)
+    except Exception:
+        logger.debug("Cannot compare %s and %s.", a, b, exc_info=True)
+        return 0
+    if rpm is not None:
+        return rpm.labelCompare(
+            ("0", a["version"], a["release"]), ("0", b["version"], b["release"])
+        )
+    return vercmp(a["version"], b["version"]) or vercmp(
+        a["release"], b["release"]
+    )
+
+
+@timed("read_sources")
+def read_sources(repo, ref="HEAD"):
+    """Reads the sources file of the given commit directly from the git
+    object store, without relying on the working tree.  Uses the persistent
+    `git cat-file --batch` process of the repository, so repeated reads do
+    not spawn any new processes.
+
+    :param repo: git Repo instance
+    :param ref: The commit to read the sources file from, optional
+    :returns: The sources file contents, or an empty string if there is none
+    """
+    try:
+        data = repo.git.get_object_data("{}:sources".format(ref))[3]
+    except ValueError:
+        return ""
+    return data.decode("utf-8")
+
+
+def parse_sources_line(line):
+    """Parses a single sources file line without using regular expressions.
+    Handles the common `SHA512 (file) = hash` and `hash  file` forms.
+
+    :param line: The line to parse, without the trailing whitespace
+    :returns: A (filename, hash, hashtype) tuple, or None if not recognized
+    """
+    if line.startswith("SHA512 ("):
+        name, sep, digest = line[8:].rpartition(") = ")
+        if (
+            sep
+            and name
+            and len(digest) == 128
+            and not digest.strip("0123456789abcdef")
+        ):
+            return (name, digest, "sha512")
+    else:
+        digest, sep, name = line.partition("  ")
+        if (
+            sep
+            and name
+            and len(digest) == 32
+            and not digest.strip("0123456789abcdef")
+        ):
+            return (name, digest, "md5")
+    return None
+
+
+@timed("parse_sources")
+def parse_sources(comp, ns, sources):
+    """Parses the supplied source file contents into a dictionary indexed
+    by the (filename, hash) tuples, holding the hashtype.  Lines the fast
+    parser does not recognize are matched with the full regular expression.
+
+    :param comps: The component we are parsing
+    :param ns: The namespace of the component
+    :param sources: The sources file contents to parse
+    :returns: A dictionary of (filename, hash) tuples to hashtypes, or None on error
+    """
+    src = dict()
+    try:
+        if not sources:
+            logger.debug("No sources file found for %s/%s.", ns, comp)
+            return dict()
+        for line in sources.splitlines():
+            line = line.rstrip()
+            s = parse_sources_line(line)
+            if s is None:
+                m = sre.match(line)
+                if m is None:
+                    logger.error(
+                        'Cannot parse "%s" from sources of %s/%s.',
+                        line,
+                        ns,
+                        comp,
+                    )
+                    return None
+                m = m.groupdict()
+                s = (
+                    m["file"],
+                    m["hash"],
+                    "sha512" if len(m["hash"]) == 128 else "md5",
+                )
+            src[(s[0], s[1])] = s[2]
+    except Exception:
+        logger.exception("Error processing sources of %s/%s.", ns, comp)
+        return None
+    logger.debug("Found %d source file(s) for %s/%s.", len(src), ns, comp)
+    return src
+
+
+def diff_sources(old, new):
+    """Finds the source files in new that are not in old, grouped by
+    their hashtype.
+
+    :param old: The old sources, as returned by parse_sources()
+    :param new: The new sources, as returned by parse_sources()
+    :returns: A dictionary of hashtypes to lists of (filename, hash, hashtype) tuples
+    """
+    diff = dict()
+    for key, hashtype in new.items():
+        if key not in old:
+            diff.setdefault(hashtype, list()).append(
+                (key[0], key[1], hashtype)
+            )
+    return diff
+
+
+def fetch_config(scm):
+    """Fetches the configuration repository into its persistent checkout,
+    cloning it on first use and only fetching the changes afterwards, and
+    checks out the requested reference.
+
+    :param scm: The SCM dictionary as returned by split_scmurl()
+    :returns: The checkout path, or None on error
+    """
+
+    def fetch():
+        cdir = config_checkouts.get(scm["link"])
+        try:
+            if cdir is None:
+                cdir = tempfile.TemporaryDirectory(prefix="distrobaker-")
+                logger.info(
+                    "Fetching configuration from %s to %s",
+                    scm["link"],
+                    cdir.name,
+                )
+                repo = git.Repo.clone_from(scm["link"], cdir.name)
+                config_checkouts[scm["link"]] = cdir
+            else:
+                logger.info(
+                    "Updating configuration from %s in %s",
+                    scm["link"],
+                    cdir.name,
+                )
+                repo = git.Repo(cdir.name)
+                repo.git.fetch("--prune", "--tags", "--force", "origin")
+            if "origin/{}".format(scm["ref"]) in [
+                r.name for r in repo.remotes.origin.refs
+            ]:
+                repo.git.checkout("--force", "--detach", "origin/" + scm["ref"])
+            else:
+                repo.git.checkout("--force", scm["ref"])
+        except Exception:
+            config_checkouts.pop(scm["link"], None)
+            raise
+        return cdir.name
+
+    try:
+        path = with_retry(
+            fetch,
+            get_endpoint(scm["link"]),
+            "Fetching configuration",
+            "config",
+        )
+    except Exception:
+        logger.error("Failed to fetch configuration, giving up.")
+        return None
+    logger.info("Configuration fetched successfully.")
+    return path
+
+
+def expand_component(defaults, ns, comp, cnf):
+    """Computes the effective configuration of a configured component from
+    its configuration entry and the configured defaults.
+
+    :param defaults: The `defaults` block of the main configuration
+    :param ns: The component namespace
+    :param comp: The component name, `name:stream` for modules
+    :param cnf: The component configuration entry
+    :returns: The component configuration dictionary
+    """
+    cname = comp
+    sname = ""
+    if ns == "modules":
+        ms = split_module(comp)
+        cname = ms["name"]
+        sname = ms["stream"]
+    e = dict()
+    e["source"] = defaults[ns]["source"] % {
+        "component": cname,
+        "stream": sname,
+    }
+    e["destination"] = defaults[ns]["destination"] % {
+        "component": cname,
+        "stream": sname,
+    }
+    e["cache"] = {
+        "source": defaults["cache"]["source"]
+        % {"component": cname, "stream": sname},
+        "destination": defaults["cache"]["destination"]
+        % {"component": cname, "stream": sname},
+    }
+    for ck in ("source", "destination"):
+        if ck in cnf:
+            e[ck] = str(cnf[ck])
+    if "cache" in cnf:
+        for ck in ("source", "destination"):
+            if ck in cnf["cache"]:
+                e["cache"][ck] = str(cnf["cache"][ck])
+    return e
+
+
+class Components(collections.abc.Mapping):
+    """Resolves the effective configuration of components in a namespace.
+
+    Behaves as a read-only mapping of the configured components to their
+    configuration dictionaries.  Entries are only computed from the raw
+    configuration and the defaults on first access and memoized.  Use
+    resolve() to also get the default configuration of unconfigured
+    components.
+    """
+
+    def __init__(self, defaults, ns, raw, prev=None):
+        """Creates the resolver.
+
+        :param defaults: The `defaults` block of the main configuration
+        :param ns: The component namespace
+        :param raw: Dictionary of the raw component configuration entries
+        :param prev: The resolver of the previous configuration, optional;
+                     memoized entries that did not change are reused
+        """
+        self.defaults = defaults
+        self.ns = ns
+        self.raw = raw
+        self.memo = dict()
+        if prev is not None and prev.defaults == defaults:
+            for comp, e in list(prev.memo.items()):
+                if raw.get(comp, dict()) == prev.raw.get(comp, dict()):
+                    self.memo[comp] = e
+
+    def __getitem__(self, comp):
+        if comp not in self.raw:
+            raise KeyError(comp)
+        return self.resolve(comp)
+
+    def __contains__(self, comp):
+        return comp in self.raw
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def resolve(self, comp):
+        """Gets the configuration of the given component, configured or
+        not.
+
+        :param comp: The component name, `name:stream` for modules
+        :returns: The component configuration dictionary
+        """
+        e = self.memo.get(comp)
+        if e is None:
+            e = expand_component(
+                self.defaults, self.ns, comp, self.raw.get(comp, dict())
+            )
+            self.memo[comp] = e
+        return e
+
+
+# FIXME: This needs even more error checking, e.g.
+#         - check if blocks are actual dictionaries
+#         - check if certain values are what we expect
+def load_config(crepo):
+    """Loads or updates the global configuration from the provided URL in
+    the `link#branch` format.  If no branch is provided, assumes `master`.
+
+    The operation is atomic and the function can be safely called to update
+    the configuration without the danger of clobbering the current one.
+    The configuration repository checkout is kept between calls and only
+    updated.  Component configuration is resolved lazily, see Components;
+    entries whose configuration and defaults did not change since the last
+    load are kept.
+
+    `crepo` must be a git repository with `distrobaker.yaml` in it.
+
+    :param crepo: `link#branch` style URL pointing to the configuration
+    :returns: The configuration dictionary, or None on error
+    """
+    global c
+    scm = split_scmurl(crepo)
+    if scm["ref"] is None:
+        scm["ref"] = "master"
+    cdir = fetch_config(scm)
+    if cdir is None:
+        return None
+    if os.path.isfile(os.path.join(cdir, "distrobaker.yaml")):
+        try:
+            with open(os.path.join(cdir, "distrobaker.yaml")) as f:
+                y = yaml.safe_load(f)
+            logger.debug(
+                "%s loaded, processing.",
+                os.path.join(cdir, "distrobaker.yaml"),
+            )
+        except Exception:
+            logger.exception("Could not parse distrobaker.yaml.")
+            return None
+    else:
+        logger.error(
+            "Configuration repository does not contain distrobaker.yaml."
+        )
+        return None
+    n = dict()
+    if "configuration" in y:
+        cnf = y["configuration"]
+        for k in ("source", "destination"):
+            if k in cnf:
+                n[k] = dict()
+                if "scm" in cnf[k]:
+                    n[k]["scm"] = str(cnf[k]["scm"])
+                else:
+                    logger.error("Configuration error: %s.scm missing.", k)
+                    return None
+                if "cache" in cnf[k]:
+                    n[k]["cache"] = dict()
+                    for kc in ("url", "cgi", "path"):
+                        if kc in cnf[k]["cache"]:
+                            n[k]["cache"][kc] = str(cnf[k]["cache"][kc])
+                        else:
+                            logger.error(
+                                "Configuration error: %s.cache.%s missing.",
+                                k,
+                                kc,
+                            )
+                            return None
+                else:
+                    logger.error("Configuration error: %s.cache missing.", k)
+                    return None
+                if "profile" in cnf[k]:
+                    n[k]["profile"] = str(cnf[k]["profile"])
+                else:
+                    logger.error("Configuration error: %s.profile missing.", k)
+                    return None
+                if "mbs" in cnf[k]:
+                    n[k]["mbs"] = str(cnf[k]["mbs"])
+                else:
+                    logger.error("Configuration error: %s.mbs missing.", k)
+                    return None
             else:
                 logger.error("Configuration error: %s missing.", k)
                 return None
@@ -307,6 +1574,26 @@ def load_config(crepo):
                 else:
                     logger.error("Configuration error: control.%s missing.", k)
                     return None
+            n["control"]["clone"] = "full"
+            if "clone" in cnf["control"]:
+                n["control"]["clone"] = str(cnf["control"]["clone"])
+                if n["control"]["clone"] not in clone_strategies:
+                    logger.error(
+                        "Configuration error: control.clone must be one of %s.",
+                        ", ".join(clone_strategies),
+                    )
+                    return None
+            n["control"]["depth"] = 1
+            if "depth" in cnf["control"]:
+                try:
+                    n["control"]["depth"] = int(cnf["control"]["depth"])
+                except (TypeError, ValueError):
+                    n["control"]["depth"] = 0
+                if n["control"]["depth"] < 1:
+                    logger.error(
+                        "Configuration error: control.depth must be a positive integer."
+                    )
+                    return None
             n["control"]["exclude"] = {"rpms": set(), "modules": set()}
             if "exclude" in cnf["control"]:
                 for cns in ("rpms", "modules"):
@@ -314,6 +1601,32 @@ def load_config(crepo):
                         n["control"]["exclude"][cns].update(
                             cnf["control"]["exclude"][cns]
                         )
+            n["control"]["priority"] = {"rpms": dict(), "modules": dict()}
+            if "priority" in cnf["control"]:
+                for cns in ("rpms", "modules"):
+                    for pc, pv in (
+                        cnf["control"]["priority"].get(cns) or dict()
+                    ).items():
+                        try:
+                            n["control"]["priority"][cns][str(pc)] = int(pv)
+                        except (TypeError, ValueError):
+                            logger.error(
+                                "Configuration error: control.priority.%s.%s must be an integer.",
+                                cns,
+                                pc,
+                            )
+                            return None
+            n["control"]["aging"] = 600.0
+            if "aging" in cnf["control"]:
+                try:
+                    n["control"]["aging"] = float(cnf["control"]["aging"])
+                except (TypeError, ValueError):
+                    n["control"]["aging"] = 0
+                if n["control"]["aging"] <= 0:
+                    logger.error(
+                        "Configuration error: control.aging must be a positive number."
+                    )
+                    return None
             for cns in ("rpms", "modules"):
                 if n["control"]["exclude"]["rpms"]:
                     logger.info(
@@ -329,6 +1642,39 @@ def load_config(crepo):
         else:
             logger.error("Configuration error: control missing.")
             return None
+        n["limits"] = dict()
+        if "limits" in cnf:
+            for host, lim in (cnf["limits"] or dict()).items():
+                host = str(host)
+                n["limits"][host] = dict()
+                lim = lim or dict()
+                try:
+                    n["limits"][host]["connections"] = int(
+                        lim.get("connections", 0)
+                    )
+                    n["limits"][host]["rate"] = float(lim.get("rate", 0))
+                    n["limits"][host]["burst"] = int(
+                        lim.get(
+                            "burst", max(1, int(n["limits"][host]["rate"]))
+                        )
+                    )
+                except (AttributeError, TypeError, ValueError):
+                    logger.error(
+                        "Configuration error: limits.%s is not valid.", host
+                    )
+                    return None
+                if (
+                    n["limits"][host]["connections"] < 0
+                    or n["limits"][host]["rate"] < 0
+                    or n["limits"][host]["burst"] < 1
+                ):
+                    logger.error(
+                        "Configuration error: limits.%s is not valid.", host
+                    )
+                    return None
+            logger.info(
+                "Limiting connections to %d host(s).", len(n["limits"])
+            )
         if "defaults" in cnf:
             n["defaults"] = dict()
             for dk in ("cache", "rpms", "modules"):
@@ -357,7 +1703,7 @@ def load_config(crepo):
         logger.error("The required configuration block is missing.")
         return None
     components = 0
-    nc = {
+    raw = {
         "rpms": dict(),
         "modules": dict(),
     }
@@ -367,42 +1713,20 @@ def load_config(crepo):
             if k in cnf:
                 for p in cnf[k].keys():
                     components += 1
-                    nc[k][p] = dict()
-                    cname = p
-                    sname = ""
-                    if k == "modules":
-                        ms = split_module(p)
-                        cname = ms["name"]
-                        sname = ms["stream"]
-                    nc[k][p]["source"] = n["defaults"][k]["source"] % {
-                        "component": cname,
-                        "stream": sname,
-                    }
-                    nc[k][p]["destination"] = n["defaults"][k][
-                        "destination"
-                    ] % {"component": cname, "stream": sname}
-                    nc[k][p]["cache"] = {
-                        "source": n["defaults"]["cache"]["source"]
-                        % {"component": cname, "stream": sname},
-                        "destination": n["defaults"]["cache"]["destination"]
-                        % {"component": cname, "stream": sname},
-                    }
-                    if cnf[k][p] is None:
-                        cnf[k][p] = dict()
-                    for ck in ("source", "destination"):
-                        if ck in cnf[k][p]:
-                            nc[k][p][ck] = str(cnf[k][p][ck])
-                    if "cache" in cnf[k][p]:
-                        for ck in ("source", "destination"):
-                            if ck in cnf[k][p]["cache"]:
-                                nc[k][p]["cache"][ck] = str(
-                                    cnf[k][p]["cache"][ck]
-                                )
+                    raw[k][p] = cnf[k][p] if cnf[k][p] is not None else dict()
             logger.info(
                 "Found %d configured component(s) in the %s namespace.",
-                len(nc[k]),
+                len(raw[k]),
                 k,
             )
+    with config_lock:
+        prev = c.get("comps")
+    nc = {
+        k: Components(
+            n["defaults"], k, raw[k], prev[k] if prev is not None else None
+        )
+        for k in ("rpms", "modules")
+    }
     if n["control"]["strict"]:
         logger.info(
             "Running in the strict mode.  Only configured components will be processed."
@@ -418,22 +1742,265 @@ def load_config(crepo):
             )
         else:
             logger.info("No components explicitly configured.")
-    c["main"] = n
-    c["comps"] = nc
+    with config_lock:
+        c["main"] = n
+        c["comps"] = nc
+    configure_limits(n["limits"])
     return c
 
 
-def clone_destination_repo(ns, comp, cdst, dscm, dirname):
+def get_mirror_lock(path):
+    """Gets the lock guarding the given mirror repository.
+
+    :param path: The mirror repository path
+    :returns: The lock object
+    """
+    with mirror_lock:
+        return mirror_locks.setdefault(path, threading.Lock())
+
+
+def measure_mirror(path):
+    """Measures the size of a single mirror.
+
+    :param path: The mirror repository path
+    :returns: The size in bytes
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def index_mirror(path):
+    """Records the current size of a just updated mirror in the mirror
+    index, scanning the whole mirror store first if not indexed yet.
+
+    :param path: The mirror repository path
+    :returns: None
+    """
+    global mirror_index
+    with mirror_lock:
+        scanned = mirror_index is not None
+    if not scanned:
+        index = dict()
+        for ns in os.listdir(mirror_root):
+            nsdir = os.path.join(mirror_root, ns)
+            if not os.path.isdir(nsdir):
+                continue
+            for m in os.listdir(nsdir):
+                mpath = os.path.join(nsdir, m)
+                index[mpath] = (
+                    os.stat(mpath).st_mtime,
+                    measure_mirror(mpath),
+                )
+        with mirror_lock:
+            if mirror_index is None:
+                mirror_index = index
+    size = measure_mirror(path)
+    with mirror_lock:
+        mirror_index[path] = (time.time(), size)
+    return None
+
+
+def evict_mirrors(keep=None):
+    """Evicts the least recently used mirrors from the mirror store until
+    its total size fits the configured cap.  Mirrors currently in use are
+    never evicted.  Works with the mirror index, see index_mirror().
+
+    :param keep: Path of a mirror that must not be evicted, optional
+    :returns: The number of evicted mirrors
+    """
+    if mirror_root is None or mirror_cap is None:
+        return 0
+    with mirror_lock:
+        if mirror_index is None:
+            return 0
+        mirrors = sorted((v[0], k, v[1]) for k, v in mirror_index.items())
+    total = sum(x[2] for x in mirrors)
+    evicted = 0
+    for _, path, size in mirrors:
+        if total <= mirror_cap:
+            break
+        if path == keep:
+            continue
+        lock = get_mirror_lock(path)
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            logger.debug("Evicting mirror %s (%d bytes).", path, size)
+            shutil.rmtree(path, ignore_errors=True)
+            with mirror_lock:
+                mirror_index.pop(path, None)
+        finally:
+            lock.release()
+        total -= size
+        evicted += 1
+    if evicted:
+        logger.info(
+            "Evicted %d mirror(s), the mirror store now holds %d bytes.",
+            evicted,
+            total,
+        )
+    return evicted
+
+
+def update_mirror(ns, comp, dscm, sscm):
+    """Creates or incrementally updates the persistent bare mirror of the
+    component repositories.  Destination branches are mirrored as local
+    branches while source branches are kept under `refs/remotes/source`,
+    so that both share a single object store.
+
+    Does nothing if the mirror store is disabled.
+
+    :param ns: The component namespace
+    :param comp: The component name
+    :param dscm: The destination SCM
+    :param sscm: The source SCM
+    :returns: The mirror repository path, or None if unavailable
+    """
+    if mirror_root is None:
+        return None
+    path = os.path.join(mirror_root, ns, "{}.git".format(comp))
+    logger.debug("Updating the %s/%s mirror in %s.", ns, comp, path)
+    with get_mirror_lock(path):
+        try:
+            if os.path.isdir(path):
+                mrepo = git.Repo(path)
+            else:
+                mrepo = git.Repo.init(path, mkdir=True, bare=True)
+            remotes = [x.name for x in mrepo.remotes]
+            for name, link in (
+                ("destination", dscm["link"]),
+                ("source", sscm["link"]),
+            ):
+                if name in remotes:
+                    mrepo.git.remote("set-url", name, link)
+                else:
+                    mrepo.git.remote("add", name, link)
+        except Exception:
+            logger.warning(
+                "Failed to prepare the %s/%s mirror, not using it.",
+                ns,
+                comp,
+                exc_info=True,
+            )
+            return None
+
+        def fetch_destination():
+            mrepo.git.fetch(
+                "--prune",
+                "destination",
+                "+refs/heads/{0}:refs/heads/{0}".format(dscm["ref"]),
+            )
+
+        def fetch_source():
+            if sscm["ref"]:
+                mrepo.git.fetch(
+                    "source",
+                    "+refs/heads/{0}:refs/remotes/source/{0}".format(
+                        sscm["ref"]
+                    ),
+                )
+            else:
+                mrepo.git.fetch("--prune", "source")
+
+        try:
+            # each fetch is throttled and recorded for its own host
+            with_retry(
+                fetch_destination,
+                get_endpoint(dscm["link"]),
+                "Updating the {}/{} mirror".format(ns, comp),
+                "mirror",
+            )
+            with_retry(
+                fetch_source,
+                get_endpoint(sscm["link"]),
+                "Updating the {}/{} mirror".format(ns, comp),
+                "mirror",
+            )
+        except Exception:
+            logger.warning(
+                "Exhausted mirror update attempts for %s/%s, not using it.",
+                ns,
+                comp,
+            )
+            return None
+        os.utime(path)
+        try:
+            index_mirror(path)
+        except Exception:
+            logger.warning(
+                "Failed to index the %s mirror.", path, exc_info=True
+            )
+    logger.debug("Successfully updated the %s/%s mirror.", ns, comp)
+    try:
+        evict_mirrors(keep=path)
+    except Exception:
+        logger.warning("Failed to evict mirrors.", exc_info=True)
+    return path
+
+
+def get_remote_head(scm):
+    """Gets the current head commit of a remote branch.
+
+    :param scm: The SCM with the `link` and `ref` keys
+    :returns: The head commit hash, or None on error
+    """
+    try:
+        with throttle(get_endpoint(scm["link"])):
+            out = git.cmd.Git().ls_remote(
+                "--heads", scm["link"], "refs/heads/{}".format(scm["ref"])
+            )
+    except Exception:
+        logger.debug("Failed listing %s.", scm["link"], exc_info=True)
+        return None
+    return out.split("\t", 1)[0] if out else None
+
+
+@timed("clone")
+def clone_destination_repo(ns, comp, cdst, dscm, dirname, use_mirror=None):
     """Clone the component destination SCM repository to the given directory path.
     Git remote name 'origin' will be used.
 
+    If a mirror is provided, the repository is cloned from the local mirror,
+    hardlinking its objects, and the origin is then pointed to the actual
+    destination.  Falls back to a regular clone if that fails.  Otherwise
+    the configured clone strategy is used.
+
     :param ns: The component namespace
     :param comp: The component name
     :param cdst: The destination repository for the component
     :param dscm: The destination SCM
     :param dirname: Path to which the requested repository should be cloned
+    :param use_mirror: Path to the component mirror repository, optional
     :returns: repo, or None on error
     """
+    if use_mirror is not None:
+        logger.debug(
+            "Cloning %s/%s from the mirror %s", ns, comp, use_mirror
+        )
+        try:
+            with get_mirror_lock(use_mirror):
+                repo = git.Repo.clone_from(
+                    use_mirror, dirname, branch=dscm["ref"]
+                )
+            repo.git.remote("set-url", "origin", dscm["link"])
+        except Exception:
+            logger.warning(
+                "Failed to clone %s/%s from the mirror, falling back to a regular clone.",
+                ns,
+                comp,
+                exc_info=True,
+            )
+            shutil.rmtree(dirname, ignore_errors=True)
+            os.makedirs(dirname, exist_ok=True)
+        else:
+            logger.debug("Successfully cloned %s/%s from the mirror.", ns, comp)
+            return repo
     logger.debug(
         "Cloning %s/%s from %s/%s/%s",
         ns,
@@ -442,28 +2009,37 @@ def clone_destination_repo(ns, comp, cdst, dscm, dirname):
         ns,
         cdst,
     )
-    for attempt in range(retry):
+    opts = dict()
+    if c["main"]["control"]["clone"] == "shallow":
+        opts["depth"] = c["main"]["control"]["depth"]
+    elif c["main"]["control"]["clone"] == "blobless":
+        opts["filter"] = "blob:none"
+
+    def clone():
         try:
-            repo = git.Repo.clone_from(
-                dscm["link"], dirname, branch=dscm["ref"]
+            return git.Repo.clone_from(
+                dscm["link"], dirname, branch=dscm["ref"], **opts
             )
         except Exception:
-            logger.warning(
-                "Cloning attempt #%d/%d failed, retrying.",
-                attempt + 1,
-                retry,
-                exc_info=True,
-            )
-            continue
-        else:
-            break
-    else:
+            shutil.rmtree(dirname, ignore_errors=True)
+            os.makedirs(dirname, exist_ok=True)
+            raise
+
+    try:
+        repo = with_retry(
+            clone,
+            get_endpoint(dscm["link"]),
+            "Cloning {}/{}".format(ns, comp),
+            "clone",
+        )
+    except Exception:
         logger.error("Exhausted cloning attempts for %s/%s.", ns, comp)
         return None
     logger.debug("Successfully cloned %s/%s.", ns, comp)
     return repo
 
 
+@timed("fetch")
 def fetch_upstream_repo(ns, comp, csrc, sscm, repo):
     """Fetch the component source SCM repository to the given git repo.
     Git remote name 'source' will be used.
@@ -483,30 +2059,160 @@ def fetch_upstream_repo(ns, comp, csrc, sscm, repo):
     else:
         logger.debug("Fetching all upstream branches for %s/%s.", ns, comp)
     repo.git.remote("add", "source", sscm["link"])
-    for attempt in range(retry):
+    opts = list()
+    if is_shallow(repo):
+        opts.append("--depth={}".format(c["main"]["control"]["depth"]))
+    elif c["main"]["control"]["clone"] == "blobless":
+        opts.append("--filter=blob:none")
+
+    def fetch():
+        if sscm["ref"]:
+            repo.git.fetch(*opts, "source", sscm["ref"])
+        else:
+            repo.git.fetch(*opts, "source")
+
+    try:
+        with_retry(
+            fetch,
+            get_endpoint(sscm["link"]),
+            "Fetching upstream {}/{}".format(ns, comp),
+            "fetch",
+        )
+    except Exception:
+        logger.error(
+            "Exhausted upstream fetching attempts for %s/%s.", ns, comp
+        )
+        return None
+    logger.debug(
+        "Successfully fetched upstream repository for %s/%s.", ns, comp
+    )
+    return repo
+
+
+def is_shallow(repo):
+    """Checks whether the given repository is a shallow clone.
+
+    :param repo: git Repo instance
+    :returns: True if the repository is shallow, False otherwise
+    """
+    return os.path.isfile(os.path.join(repo.git_dir, "shallow"))
+
+
+def has_commit(repo, ref):
+    """Checks whether the given commit is available in the repository.
+
+    :param repo: git Repo instance
+    :param ref: The commit reference
+    :returns: True if the commit is available, False otherwise
+    """
+    try:
+        repo.git.cat_file("-e", "{}^{{commit}}".format(ref))
+    except Exception:
+        return False
+    return True
+
+
+def is_ancestor(repo, ancestor, ref):
+    """Checks whether a commit is an ancestor of another commit.
+
+    :param repo: git Repo instance
+    :param ancestor: The potential ancestor commit reference
+    :param ref: The descendant commit reference
+    :returns: True if ancestor is an ancestor of ref, False otherwise
+    """
+    try:
+        repo.git.merge_base("--is-ancestor", ancestor, ref)
+    except Exception:
+        return False
+    return True
+
+
+def deepen_repo(ns, comp, repo, bscm, sscm, ancestry=False):
+    """Deepens the history of a shallow repository until the build commit
+    is available and, optionally, until the destination branch head is
+    reachable from it, as required for fast forward pulls.  Doubles the
+    fetched depth in every round and fetches the complete history as the
+    last resort.
+
+    Does nothing for complete repositories.
+
+    :param ns: The component namespace
+    :param comp: The component name
+    :param repo: git Repo instance
+    :param bscm: The component build SCM
+    :param sscm: The source SCM
+    :param ancestry: Whether the destination head must be reachable, optional
+    :returns: repo, or None on error
+    """
+    if not is_shallow(repo):
+        return repo
+
+    def complete():
+        if not has_commit(repo, bscm["ref"]):
+            return False
+        return not ancestry or is_ancestor(repo, "HEAD", bscm["ref"])
+
+    depth = c["main"]["control"]["depth"]
+    remote = ["source", sscm["ref"]] if sscm["ref"] else ["source"]
+    if not has_commit(repo, bscm["ref"]):
+        logger.debug(
+            "Build commit of %s/%s not available, fetching it directly.",
+            ns,
+            comp,
+        )
         try:
-            if sscm["ref"]:
-                repo.git.fetch("source", sscm["ref"])
-            else:
-                repo.git.fetch("--all")
+            with throttle(get_endpoint(sscm["link"])):
+                repo.git.fetch(
+                    "--depth={}".format(depth), "source", bscm["ref"]
+                )
         except Exception:
-            logger.warning(
-                "Fetching upstream attempt #%d/%d failed, retrying.",
-                attempt + 1,
-                retry,
+            logger.debug(
+                "Failed fetching the %s/%s build commit directly.",
+                ns,
+                comp,
                 exc_info=True,
             )
-            continue
-        else:
+    for _ in range(deepen_rounds):
+        if complete():
+            return repo
+        logger.debug(
+            "History of %s/%s not deep enough, deepening by %d.",
+            ns,
+            comp,
+            depth,
+        )
+        try:
+            with throttle(get_endpoint(sscm["link"])):
+                repo.git.fetch("--deepen={}".format(depth), *remote)
+        except Exception:
+            logger.debug(
+                "Failed deepening %s/%s.", ns, comp, exc_info=True
+            )
             break
-    else:
+        depth *= 2
+    if complete():
+        return repo
+    logger.debug("Fetching the complete history of %s/%s.", ns, comp)
+    try:
+        for r, link in ((remote, sscm["link"]), (["origin"], None)):
+            if is_shallow(repo):
+                if link is None:
+                    link = repo.remotes.origin.url
+                with throttle(get_endpoint(link)):
+                    repo.git.fetch("--unshallow", *r)
+    except Exception:
+        logger.exception(
+            "Failed fetching the complete history of %s/%s.", ns, comp
+        )
+        return None
+    if not has_commit(repo, bscm["ref"]):
         logger.error(
-            "Exhausted upstream fetching attempts for %s/%s.", ns, comp
+            "Build commit %s not found in the %s/%s upstream repository.",
+            bscm["ref"],
+            ns,
+            comp,
         )
         return None
-    logger.debug(
-        "Successfully fetched upstream repository for %s/%s.", ns, comp
-    )
     return repo
 
 
@@ -535,10 +2241,103 @@ def configure_repo(ns, comp, repo):
     return repo
 
 
+def clean_message(msg):
+    """Cleans up a commit message the way `git commit` does, stripping
+    trailing whitespace and leading, trailing and repeated empty lines.
+
+    :param msg: The commit message
+    :returns: The cleaned up commit message
+    """
+    lines = list()
+    for line in msg.splitlines():
+        line = line.rstrip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def sync_repo_merge_pygit2(ns, comp, repo, bscm, sscm, dscm):
+    """Synchronize component repo source branch into the destination branch
+    in-process using pygit2.  The result is identical to that of the git
+    backend, see sync_repo_merge().
+
+    Does not push the repo.
+
+    :param ns: The component namespace
+    :param comp: The component name
+    :param repo: git Repo instance to be synchronized
+    :param bscm: The component build SCM
+    :param sscm: The source SCM
+    :param dscm: The destination SCM
+    :returns: repo
+    :raises: pygit2 errors on failure
+    """
+    r = pygit2.Repository(repo.working_dir)
+    src = r.revparse_single(bscm["ref"]).peel(pygit2.Commit)
+    ref = r.lookup_reference("refs/heads/{}".format(dscm["ref"]))
+    head = ref.peel(pygit2.Commit)
+    sig = pygit2.Signature(c["main"]["git"]["author"], c["main"]["git"]["email"])
+    msg = "{}\nSource: {}#{}".format(
+        c["main"]["git"]["message"], sscm["link"], bscm["ref"]
+    )
+    oid = r.create_commit(
+        None, sig, sig, clean_message(msg), src.tree_id, [head.id]
+    )
+    ref.set_target(oid, "commit: {}".format(msg.splitlines()[0]))
+    return repo
+
+
+def is_up_to_date(ns, comp, repo, bscm, dscm):
+    """Checks whether the destination branch already matches the build
+    commit, either having an identical tree or containing the commit in its
+    history, so that synchronizing it would not change anything.
+
+    :param ns: The component namespace
+    :param comp: The component name
+    :param repo: git Repo instance to be checked
+    :param bscm: The component build SCM
+    :param dscm: The destination SCM
+    :returns: True if up to date, False otherwise
+    """
+    try:
+        head = repo.heads[dscm["ref"]].commit
+        src = repo.commit(bscm["ref"])
+        if head.tree.hexsha == src.tree.hexsha:
+            logger.debug(
+                "The %s/%s destination tree is identical to the build.",
+                ns,
+                comp,
+            )
+            return True
+        if repo.is_ancestor(src, head):
+            logger.debug(
+                "The %s/%s destination already contains the build commit.",
+                ns,
+                comp,
+            )
+            return True
+    except Exception:
+        logger.debug(
+            "Cannot compare the %s/%s branches.", ns, comp, exc_info=True
+        )
+    return False
+
+
+@timed("merge")
 def sync_repo_merge(ns, comp, repo, bscm, sscm, dscm):
     """Synchronize component repo source branch into the desination branch using
     the merge mechanism.
 
+    The result is a single commit on top of the destination branch with
+    the tree of the build commit, created directly in the object store.
+    Neither the working tree nor the index are updated.
+
+    Uses the pygit2 backend if selected, see git_backend(), unless the
+    repository is a blobless clone pygit2 cannot work with.  Falls back to
+    the git backend on failures.
+
     Does not push the repo.
 
     :param ns: The component namespace
@@ -554,72 +2353,52 @@ def sync_repo_merge(ns, comp, repo, bscm, sscm, dscm):
         ns,
         comp,
     )
-    logger.debug(
-        "Generating a temporary merge branch name for %s/%s.", ns, comp
-    )
-    for attempt in range(retry):
-        bname = "".join(random.choice(string.ascii_letters) for i in range(16))
-        logger.debug("Checking the availability of %s/%s#%s.", ns, comp, bname)
+    if backend == "pygit2" and c["main"]["control"]["clone"] != "blobless":
         try:
-            repo.git.rev_parse("--quiet", bname, "--")
-            logger.debug(
-                "%s/%s#%s is taken.  Some people choose really weird branch names.  "
-                "Retrying, attempt #%d/%d.",
+            sync_repo_merge_pygit2(ns, comp, repo, bscm, sscm, dscm)
+        except Exception:
+            logger.warning(
+                "Failed to merge %s/%s in-process, falling back to git.",
                 ns,
                 comp,
-                bname,
-                attempt + 1,
-                retry,
+                exc_info=True,
             )
-        except Exception:
+        else:
             logger.debug(
-                "Using %s/%s#%s as the temporary merge branch name.",
-                ns,
-                comp,
-                bname,
+                "Successfully merged %s/%s with upstream.", ns, comp
             )
-            break
-    else:
-        logger.error(
-            "Exhausted attempts finding an unused branch name while synchronizing %s/%s;"
-            "this is very rare, congratulations.  Skipping.",
-            ns,
-            comp,
-        )
-        return None
+            return repo
     try:
-        actor = "{} <{}>".format(
-            c["main"]["git"]["author"], c["main"]["git"]["email"]
-        )
-        repo.git.checkout(bscm["ref"])
-        repo.git.switch("-c", bname)
-        repo.git.merge(
-            "--allow-unrelated-histories",
-            "--no-commit",
-            "-s",
-            "ours",
-            dscm["ref"],
-        )
-        repo.git.commit(
-            "--author",
-            actor,
-            "--allow-empty",
-            "-m",
-            "Temporary working tree merge",
-        )
-        repo.git.checkout(dscm["ref"])
-        repo.git.merge("--no-commit", "--squash", bname)
+        tree = repo.git.rev_parse("{}^{{tree}}".format(bscm["ref"]))
+        head = repo.git.rev_parse("refs/heads/{}".format(dscm["ref"]))
         msg = "{}\nSource: {}#{}".format(
             c["main"]["git"]["message"], sscm["link"], bscm["ref"]
         )
         with tempfile.NamedTemporaryFile(
             mode="w", prefix="msg-{}-{}-".format(ns, comp)
         ) as msgfile:
-            msgfile.write(msg)
+            msgfile.write(clean_message(msg))
             msgfile.flush()
-            repo.git.commit(
-                "--author", actor, "--allow-empty", "-F", msgfile.name
+            commit = repo.git.commit_tree(
+                tree,
+                "-p",
+                head,
+                "-F",
+                msgfile.name,
+                env={
+                    "GIT_AUTHOR_NAME": c["main"]["git"]["author"],
+                    "GIT_AUTHOR_EMAIL": c["main"]["git"]["email"],
+                    "GIT_COMMITTER_NAME": c["main"]["git"]["author"],
+                    "GIT_COMMITTER_EMAIL": c["main"]["git"]["email"],
+                },
             )
+        repo.git.update_ref(
+            "-m",
+            "commit: {}".format(msg.splitlines()[0]),
+            "refs/heads/{}".format(dscm["ref"]),
+            commit,
+            head,
+        )
     except Exception:
         logger.exception("Failed to merge %s/%s.", ns, comp)
         return None
@@ -627,6 +2406,7 @@ def sync_repo_merge(ns, comp, repo, bscm, sscm, dscm):
     return repo
 
 
+@timed("merge")
 def sync_repo_pull(ns, comp, repo, bscm):
     """Synchronize component repo source branch into the desination branch using
     the clean pull mechanism. Branches must be compatible.
@@ -655,6 +2435,7 @@ def sync_repo_pull(ns, comp, repo, bscm):
     return repo
 
 
+@timed("push")
 def repo_push(ns, comp, repo, dscm):
     """Push synchronized repo to component destination SCM repository
 
@@ -665,55 +2446,85 @@ def repo_push(ns, comp, repo, dscm):
     :returns: repo, or None on error
     """
     logger.debug("Pushing synchronized contents for %s/%s.", ns, comp)
-    for attempt in range(retry):
-        try:
-            if not dry_run:
-                logger.debug("Pushing %s/%s.", ns, comp)
-                repo.git.push("--set-upstream", "origin", dscm["ref"])
-                logger.debug("Successfully pushed %s/%s.", ns, comp)
-            else:
-                logger.debug("Pushing %s/%s (--dry-run).", ns, comp)
-                repo.git.push(
-                    "--dry-run", "--set-upstream", "origin", dscm["ref"]
-                )
-                logger.debug(
-                    "Successfully pushed %s/%s (--dry-run).", ns, comp
-                )
-        except Exception:
-            logger.warning(
-                "Pushing attempt #%d/%d failed, retrying.",
-                attempt + 1,
-                retry,
-                exc_info=True,
-            )
-            continue
+
+    def push():
+        if not dry_run:
+            logger.debug("Pushing %s/%s.", ns, comp)
+            repo.git.push("--set-upstream", "origin", dscm["ref"])
+            logger.debug("Successfully pushed %s/%s.", ns, comp)
         else:
-            return repo
-    else:
+            logger.debug("Pushing %s/%s (--dry-run).", ns, comp)
+            repo.git.push("--dry-run", "--set-upstream", "origin", dscm["ref"])
+            logger.debug("Successfully pushed %s/%s (--dry-run).", ns, comp)
+
+    try:
+        with_retry(
+            push,
+            get_endpoint(dscm["link"]),
+            "Pushing {}/{}".format(ns, comp),
+            "push",
+        )
+    except Exception:
         logger.error("Exhausted pushing attempts for %s/%s.", ns, comp)
         return None
+    return repo
 
 
-def sync_repo(comp, ns="rpms", nvr=None):
+@timed("sync_repo")
+def sync_repo(comp, ns="rpms", nvr=None, scmurl=None):
     """Synchronizes the component SCM repository for the given NVR.
     If no NVR is provided, finds the latest build in the corresponding
-    trigger tag.
+    trigger tag.  If the build SCMURL is already known, e.g. from
+    resolve_builds(), it can be passed to save a build system lookup.
+
+    With the persistent state enabled, components whose build SCMURL and
+    destination branch head did not change since their last successful
+    synchronization and build are not synchronized again.  If only the
+    build is missing, the recorded head is returned without synchronizing.
+    Likewise, destination branches found up to date are not committed to,
+    and their head is returned unless they are known to be built already.
 
-    Calls sync_cache() if required.  Does not call build_comp().
+    Runs the `git`, `cache` and `push` stages, see sync_stages, one after
+    another.  Calls sync_cache() if required.  Does not call build_comp().
 
     :param comp: The component name
     :param ns: The component namespace
     :param nvr: Optional NVR to synchronize
-    :returns: The SCM reference of the final synchronized commit, or None on error
+    :param scmurl: Optional SCMURL of the NVR
+    :returns: The SCM reference of the final synchronized commit, False if
+              already up to date, or None on error
+    """
+    job = {"ns": ns, "comp": comp, "nvr": nvr, "scmurl": scmurl}
+    try:
+        for stage in ("git", "cache", "push"):
+            if not sync_stages[stage](job):
+                break
+    finally:
+        if "tempdir" in job:
+            job.pop("tempdir").cleanup()
+    return job.get("ref")
+
+
+@timed("stage_git")
+def sync_stage_git(job):
+    """Runs the `git` stage of the component synchronization, preparing
+    the synchronized repository: resolves the build, clones and fetches the
+    repositories, merges or pulls and finds the sources to synchronize.
+
+    :param job: The job dictionary with the `ns`, `comp`, `nvr` and `scmurl` keys
+    :returns: True if the job should continue, False if `ref` is final
     """
+    ns, comp, nvr, scmurl = job["ns"], job["comp"], job["nvr"], job["scmurl"]
     if "main" not in c:
         logger.critical("DistroBaker is not configured, aborting.")
-        return None
+        job["ref"] = None
+        return False
     if comp in c["main"]["control"]["exclude"][ns]:
         logger.critical(
             "The component %s/%s is excluded from sync, aborting.", ns, comp
         )
-        return None
+        job["ref"] = None
+        return False
 
     logger.info("Synchronizing SCM for %s/%s.", ns, comp)
 
@@ -724,16 +2535,17 @@ def sync_repo(comp, ns="rpms", nvr=None):
             ns,
             comp,
         )
-        return None
+        job["ref"] = None
+        return False
 
     logger.debug("Processing %s/%s: %s", ns, comp, nvr)
 
-    tempdir = tempfile.TemporaryDirectory(
+    job["tempdir"] = tempfile.TemporaryDirectory(
         prefix="repo-{}-{}-".format(ns, comp)
     )
-    logger.debug("Temporary directory created: %s", tempdir.name)
+    logger.debug("Temporary directory created: %s", job["tempdir"].name)
 
-    bscm = get_scmurl(nvr)
+    bscm = scmurl if scmurl else get_scmurl(nvr)
     if bscm is None:
         logger.error(
             "Could not find build SCMURL for %s/%s: %s, skipping.",
@@ -741,26 +2553,11 @@ def sync_repo(comp, ns="rpms", nvr=None):
             comp,
             nvr,
         )
-        return None
+        job["ref"] = None
+        return False
     bscm = split_scmurl(bscm)
-    if comp in c["comps"][ns]:
-        csrc = c["comps"][ns][comp]["source"]
-        cdst = c["comps"][ns][comp]["destination"]
-    else:
-        cname = comp
-        sname = ""
-        if ns == "modules":
-            ms = split_module(comp)
-            cname = ms["name"]
-            sname = ms["stream"]
-        csrc = c["main"]["defaults"][ns]["source"] % {
-            "component": cname,
-            "stream": sname,
-        }
-        cdst = c["main"]["defaults"][ns]["destination"] % {
-            "component": cname,
-            "stream": sname,
-        }
+    csrc = c["comps"][ns].resolve(comp)["source"]
+    cdst = c["comps"][ns].resolve(comp)["destination"]
     sscm = split_scmurl(
         "{}/{}/{}".format(c["main"]["source"]["scm"], ns, csrc)
     )
@@ -769,103 +2566,736 @@ def sync_repo(comp, ns="rpms", nvr=None):
     )
     dscm["ref"] = dscm["ref"] if dscm["ref"] else "master"
 
-    repo = clone_destination_repo(ns, comp, cdst, dscm, tempdir.name)
-    if repo is None:
-        logger.error(
-            "Failed to clone destination repo for %s/%s, skipping.", ns, comp
-        )
-        return None
+    prev = get_sync_state(ns, comp)
+    if (
+        prev is not None
+        and prev["source"] == bscm["link"] + "#" + bscm["ref"]
+        and prev["destination"] == dscm["link"] + "#" + dscm["ref"]
+        and prev["head"] is not None
+        and get_remote_head(dscm) == prev["head"]
+    ):
+        if prev["task"] is not None:
+            logger.info(
+                "%s/%s is already synchronized with %s, skipping.",
+                ns,
+                comp,
+                nvr,
+            )
+            job["ref"] = False
+            return False
+        logger.info(
+            "%s/%s is already synchronized with %s but was not built.",
+            ns,
+            comp,
+            nvr,
+        )
+        job["ref"] = prev["head"]
+        return False
+
+    repo = clone_destination_repo(
+        ns,
+        comp,
+        cdst,
+        dscm,
+        job["tempdir"].name,
+        use_mirror=update_mirror(ns, comp, dscm, sscm),
+    )
+    if repo is None:
+        logger.error(
+            "Failed to clone destination repo for %s/%s, skipping.", ns, comp
+        )
+        job["ref"] = None
+        return False
+
+    if fetch_upstream_repo(ns, comp, csrc, sscm, repo) is None:
+        logger.error(
+            "Failed to fetch upstream repo for %s/%s, skipping.", ns, comp
+        )
+        job["ref"] = None
+        return False
+
+    if (
+        deepen_repo(
+            ns,
+            comp,
+            repo,
+            bscm,
+            sscm,
+            ancestry=not c["main"]["control"]["merge"],
+        )
+        is None
+    ):
+        logger.error(
+            "Failed to fetch enough history for %s/%s, skipping.", ns, comp
+        )
+        job["ref"] = None
+        return False
+
+    if configure_repo(ns, comp, repo) is None:
+        logger.error(
+            "Failed to configure the git repository for %s/%s, skipping.",
+            ns,
+            comp,
+        )
+        job["ref"] = None
+        return False
+
+    logger.debug("Gathering destination files for %s/%s.", ns, comp)
+
+    try:
+        dsrc = parse_sources(comp, ns, read_sources(repo))
+    except Exception:
+        logger.exception("Failed to read sources of %s/%s.", ns, comp)
+        dsrc = None
+    if dsrc is None:
+        logger.error(
+            "Error processing the %s/%s destination sources file, skipping.",
+            ns,
+            comp,
+        )
+        job["ref"] = None
+        return False
+
+    if is_up_to_date(ns, comp, repo, bscm, dscm):
+        logger.info(
+            "%s/%s already contains %s, nothing to synchronize.",
+            ns,
+            comp,
+            nvr,
+        )
+        count("up_to_date", "git")
+        source = bscm["link"] + "#" + bscm["ref"]
+        head = repo.heads[dscm["ref"]].commit.hexsha
+        if not dry_run:
+            set_sync_state(
+                ns,
+                comp,
+                source=source,
+                destination=dscm["link"] + "#" + dscm["ref"],
+                head=head,
+                nvr=nvr,
+            )
+        if (
+            prev is not None
+            and prev["source"] == source
+            and prev["task"] is not None
+        ):
+            job["ref"] = False
+        else:
+            # not known to be built; the build stage skips existing builds
+            job["ref"] = head
+        return False
+
+    if c["main"]["control"]["merge"]:
+        if sync_repo_merge(ns, comp, repo, bscm, sscm, dscm) is None:
+            logger.error(
+                "Failed to sync merge repo for %s/%s, skipping.", ns, comp
+            )
+            job["ref"] = None
+            return False
+    else:
+        if sync_repo_pull(ns, comp, repo, bscm) is None:
+            logger.error(
+                "Failed to sync pull repo for %s/%s, skipping.", ns, comp
+            )
+            job["ref"] = None
+            return False
+
+    logger.debug("Gathering source files for %s/%s.", ns, comp)
+    try:
+        ssrc = parse_sources(comp, ns, read_sources(repo, bscm["ref"]))
+    except Exception:
+        logger.exception("Failed to read sources of %s/%s.", ns, comp)
+        ssrc = None
+    if ssrc is None:
+        logger.error(
+            "Error processing the %s/%s source sources file, skipping.",
+            ns,
+            comp,
+        )
+        job["ref"] = None
+        return False
+
+    job.update(
+        {
+            "nvr": nvr,
+            "repo": repo,
+            "bscm": bscm,
+            "dscm": dscm,
+            "srcdiff": diff_sources(dsrc, ssrc),
+        }
+    )
+    return True
+
+
+@timed("stage_cache")
+def sync_stage_cache(job):
+    """Runs the `cache` stage of the component synchronization, copying
+    the new lookaside cache files of the component.
+
+    :param job: The job dictionary, as prepared by the `git` stage
+    :returns: True if the job should continue, False if `ref` is final
+    """
+    ns, comp = job["ns"], job["comp"]
+    if job["srcdiff"]:
+        logger.debug("Source files for %s/%s differ.", ns, comp)
+        if sync_cache(comp, job["srcdiff"], ns) is None:
+            logger.error(
+                "Failed to synchronize sources for %s/%s, skipping.", ns, comp
+            )
+            job["ref"] = None
+            return False
+    else:
+        logger.debug("Source files for %s/%s are up-to-date.", ns, comp)
+    logger.debug("Component %s/%s successfully synchronized.", ns, comp)
+    return True
+
+
+@timed("stage_push")
+def sync_stage_push(job):
+    """Runs the `push` stage of the component synchronization, pushing
+    the synchronized repository and recording the synchronization state.
+
+    :param job: The job dictionary, as prepared by the `git` stage
+    :returns: True if the job should continue, False if `ref` is final
+    """
+    ns, comp, repo, bscm, dscm = (
+        job["ns"],
+        job["comp"],
+        job["repo"],
+        job["bscm"],
+        job["dscm"],
+    )
+    if repo_push(ns, comp, repo, dscm) is None:
+        logger.error("Failed to push %s/%s, skipping.", ns, comp)
+        job["ref"] = None
+        return False
+
+    head = repo.git.rev_parse("HEAD")
+    if not dry_run:
+        set_sync_state(
+            ns,
+            comp,
+            source=bscm["link"] + "#" + bscm["ref"],
+            destination=dscm["link"] + "#" + dscm["ref"],
+            head=head,
+            nvr=job["nvr"],
+            task=None,
+        )
+    logger.info("Successfully synchronized %s/%s.", ns, comp)
+    job["ref"] = head
+    return True
+
+
+@timed("stage_build")
+def sync_stage_build(job):
+    """Runs the `build` stage, submitting the build of the synchronized
+    component.  Does nothing if synchronization failed or was not needed.
+
+    :param job: The job dictionary with the final `ref`
+    :returns: True if a build was submitted, False otherwise
+    """
+    if not job.get("ref"):
+        return False
+    job["task"] = build_comp(
+        job["comp"],
+        job["ref"],
+        ns=job["ns"],
+        nvr=job["nvr"],
+        existing=job.get("existing"),
+    )
+    if job["task"] is None:
+        return False
+    if not dry_run:
+        set_sync_state(job["ns"], job["comp"], task=job["task"])
+    return True
+
+
+# Synchronization stages in the order they run
+sync_stages = {
+    "git": sync_stage_git,
+    "cache": sync_stage_cache,
+    "push": sync_stage_push,
+    "build": sync_stage_build,
+}
+
+
+def stage_worker(stage):
+    """Processes the jobs of a pipeline stage forever, handing them over
+    to the next one.  Started by `start_pipeline()`.
+
+    The build stage takes all queued jobs at once and checks them for
+    existing builds in bulk, see find_job_builds().
+
+    :param stage: The stage name
+    :returns: None
+    """
+    nxt = stage_names.index(stage) + 1
+    while True:
+        batch = [stage_queues[stage].get()]
+        if stage == "build":
+            while True:
+                try:
+                    batch.append(stage_queues[stage].get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                find_job_builds(batch)
+            except Exception:
+                logger.exception("Unexpected error finding existing builds.")
+        for job in batch:
+            proceed = False
+            try:
+                proceed = sync_stages[stage](job)
+            except Exception:
+                logger.exception(
+                    "Unexpected error in the %s stage of %s/%s.",
+                    stage,
+                    job["ns"],
+                    job["comp"],
+                )
+                job["ref"] = None
+            if stage == "build":
+                job["done"].set()
+                continue
+            if stage == "push" or not proceed:
+                if "tempdir" in job:
+                    job.pop("tempdir").cleanup()
+                job.pop("repo", None)
+            # Finished jobs skip to the build stage, which only builds those
+            # with a synchronized reference
+            stage_queues[stage_names[nxt] if proceed else "build"].put(job)
+
+
+def start_pipeline():
+    """Starts the pipeline stage queues and their worker threads, unless
+    already running.
+
+    :returns: None
+    """
+    with stage_lock:
+        if stage_queues:
+            return None
+        for stage in stage_names:
+            stage_queues[stage] = queue.Queue()
+            for i in range(stage_workers.get(stage, 1)):
+                threading.Thread(
+                    target=stage_worker,
+                    args=(stage,),
+                    name="distrobaker-{}-{}".format(stage, i),
+                    daemon=True,
+                ).start()
+        logger.debug("Started the pipeline with %s worker(s).", stage_workers)
+    return None
+
+
+def run_pipeline(comp, ns="rpms", nvr=None, scmurl=None):
+    """Synchronizes the component and submits its build, running the
+    `git`, `cache`, `push` and `build` stages.  If the pipeline is enabled,
+    see stages(), the stages run in their worker threads and this blocks
+    until the job leaves the pipeline.
+
+    :param comp: The component name
+    :param ns: The component namespace
+    :param nvr: Optional NVR to synchronize
+    :param scmurl: Optional SCMURL of the NVR
+    :returns: The job dictionary with the `ref` and `task` results
+    """
+    job = {"ns": ns, "comp": comp, "nvr": nvr, "scmurl": scmurl}
+    if not stage_workers:
+        job["ref"] = sync_repo(comp, ns=ns, nvr=nvr, scmurl=scmurl)
+        sync_stage_build(job)
+        return job
+    start_pipeline()
+    job["done"] = threading.Event()
+    stage_queues[stage_names[0]].put(job)
+    job["done"].wait()
+    return job
+
 
-    if fetch_upstream_repo(ns, comp, csrc, sscm, repo) is None:
-        logger.error(
-            "Failed to fetch upstream repo for %s/%s, skipping.", ns, comp
-        )
-        return None
+def find_job_builds(batch):
+    """Checks the synchronized jobs for existing builds in bulk, with a
+    single find_builds() call per namespace, and stores the results under
+    their `existing` keys for the build stage.
 
-    if configure_repo(ns, comp, repo) is None:
-        logger.error(
-            "Failed to configure the git repository for %s/%s, skipping.",
-            ns,
-            comp,
+    :param batch: A list of job dictionaries
+    :returns: None
+    """
+    todo = [x for x in batch if x.get("ref")]
+    for ns in {x["ns"] for x in todo}:
+        existing = find_builds(
+            {x["comp"]: x["ref"] for x in todo if x["ns"] == ns}, ns=ns
         )
-        return None
+        if existing is None:
+            continue
+        for x in todo:
+            if x["ns"] == ns:
+                x["existing"] = existing
+    return None
 
-    logger.debug("Gathering destination files for %s/%s.", ns, comp)
 
-    dsrc = parse_sources(comp, ns, os.path.join(repo.working_dir, "sources"))
-    if dsrc is None:
-        logger.error(
-            "Error processing the %s/%s destination sources file, skipping.",
-            ns,
-            comp,
-        )
-        return None
+def stream_cache_file(comp, ns, s, scache, dcache, scname, dcname):
+    """Copies a single lookaside cache file from the source to the
+    destination cache without staging it on the local disk.  The download
+    is piped directly into the destination upload CGI while its hash is
+    verified on the fly; the upload is aborted before completion if the
+    hash does not match.
 
-    if c["main"]["control"]["merge"]:
-        if sync_repo_merge(ns, comp, repo, bscm, sscm, dscm) is None:
-            logger.error(
-                "Failed to sync merge repo for %s/%s, skipping.", ns, comp
+    Streaming requires the source to announce the file size and the upload
+    to complete without rewinding its body.  If either is not the case,
+    the function returns False and the caller should fall back to the
+    staged copy.
+
+    :param comp: The component name
+    :param ns: The component namespace
+    :param s: The (filename, hash, hashtype) source tuple
+    :param scache: The source cache instance
+    :param dcache: The destination cache instance
+    :param scname: The source cache name of the component
+    :param dcname: The destination cache name of the component
+    :returns: True if the file was streamed, False if it cannot be streamed
+    :raises Exception: On transfer or verification errors
+    """
+    url = scache.get_download_url(
+        "{}/{}".format(ns, scname), urllib.parse.quote(s[0]), s[1], s[2]
+    )
+    source = get_endpoint(url)
+    head = pycurl.Curl()
+    try:
+        head.setopt(pycurl.URL, url)
+        head.setopt(pycurl.NOBODY, True)
+        head.setopt(pycurl.FOLLOWLOCATION, 1)
+        head.perform()
+        status = head.getinfo(pycurl.RESPONSE_CODE)
+        size = int(
+            head.getinfo(
+                getattr(
+                    pycurl,
+                    "CONTENT_LENGTH_DOWNLOAD_T",
+                    pycurl.CONTENT_LENGTH_DOWNLOAD,
+                )
             )
-            return None
-    else:
-        if sync_repo_pull(ns, comp, repo, bscm) is None:
-            logger.error(
-                "Failed to sync pull repo for %s/%s, skipping.", ns, comp
+        )
+    except Exception as e:
+        raise blame(e, source)
+    finally:
+        head.close()
+    if status != 200:
+        raise blame(
+            IOError(
+                "Source cache returned status {} for {}".format(status, url)
+            ),
+            source,
+        )
+    if size < 0:
+        logger.debug(
+            "Size of %s for %s/%s unknown, cannot stream it.", s[0], ns, comp
+        )
+        return False
+    boundary = uuid.uuid4().hex
+    preamble = "".join(
+        "--{}\r\nContent-Disposition: form-data; name=\"{}\"\r\n\r\n{}\r\n".format(
+            boundary, k, v
+        )
+        for k, v in (
+            ("name", "{}/{}".format(ns, dcname)),
+            ("{}sum".format(s[2]), s[1]),
+        )
+    )
+    preamble += (
+        "--{}\r\nContent-Disposition: form-data; name=\"file\"; "
+        'filename="{}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+    ).format(boundary, s[0])
+    preamble = preamble.encode("utf-8")
+    epilogue = "\r\n--{}--\r\n".format(boundary).encode("utf-8")
+    chunks = queue.Queue(maxsize=64)
+    abort = threading.Event()
+
+    def put(item):
+        while not abort.is_set():
+            try:
+                chunks.put(item, timeout=1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def write(data):
+        return None if put(data) else 0
+
+    def download():
+        dl = pycurl.Curl()
+        try:
+            dl.setopt(pycurl.URL, url)
+            dl.setopt(pycurl.HTTPHEADER, ["Pragma:", "Accept-Encoding: identity"])
+            dl.setopt(pycurl.FOLLOWLOCATION, 1)
+            dl.setopt(pycurl.LOW_SPEED_LIMIT, 1000)
+            dl.setopt(pycurl.LOW_SPEED_TIME, 60)
+            dl.setopt(pycurl.WRITEFUNCTION, write)
+            dl.perform()
+            if dl.getinfo(pycurl.RESPONSE_CODE) != 200:
+                raise IOError(
+                    "Source cache returned status {} for {}".format(
+                        dl.getinfo(pycurl.RESPONSE_CODE), url
+                    )
+                )
+        except Exception as e:
+            put(blame(e, source))
+        else:
+            put(None)
+        finally:
+            dl.close()
+
+    def body():
+        yield preamble
+        h = hashlib.new(s[2])
+        n = 0
+        while True:
+            data = chunks.get()
+            if data is None:
+                break
+            if isinstance(data, Exception):
+                raise data
+            h.update(data)
+            n += len(data)
+            yield data
+        if n != size or h.hexdigest() != s[1]:
+            # truncated or corrupted in transit, worth another try
+            raise blame(
+                IOError("{} failed checksum while streaming".format(s[0])),
+                source,
             )
-            return None
+        yield epilogue
 
-    logger.debug("Gathering source files for %s/%s.", ns, comp)
-    ssrc = parse_sources(comp, ns, os.path.join(repo.working_dir, "sources"))
-    if ssrc is None:
-        logger.error(
-            "Error processing the %s/%s source sources file, skipping.",
-            ns,
-            comp,
-        )
-        return None
+    gen = body()
+    buffered = bytearray()
+    failures = list()
 
-    srcdiff = ssrc - dsrc
-    if srcdiff:
-        logger.debug("Source files for %s/%s differ.", ns, comp)
-        if sync_cache(comp, srcdiff, ns) is None:
-            logger.error(
-                "Failed to synchronize sources for %s/%s, skipping.", ns, comp
+    def read(n):
+        try:
+            while len(buffered) < n:
+                buffered.extend(next(gen))
+        except StopIteration:
+            pass
+        except Exception as e:
+            failures.append(e)
+            return pycurl.READFUNC_ABORT
+        out = bytes(buffered[:n])
+        del buffered[:n]
+        read.sent += len(out)
+        return out
+
+    read.sent = 0
+
+    def seek(offset, origin):
+        if offset == 0 and read.sent == 0:
+            return pycurl.SEEKFUNC_OK
+        return pycurl.SEEKFUNC_CANTSEEK
+
+    downloader = threading.Thread(target=download, daemon=True)
+    downloader.start()
+    try:
+        if dry_run:
+            logger.debug(
+                "Running in dry run mode, verifying %s for %s/%s without uploading.",
+                s[0],
+                ns,
+                comp,
             )
-            return None
-    else:
-        logger.debug("Source files for %s/%s are up-to-date.", ns, comp)
+            for _ in gen:
+                pass
+            return True
+        output = io.BytesIO()
+        up = pycurl.Curl()
+        try:
+            up.setopt(pycurl.URL, dcache.upload_url)
+            up.setopt(pycurl.POST, 1)
+            up.setopt(
+                pycurl.HTTPHEADER,
+                [
+                    "Content-Type: multipart/form-data; boundary={}".format(
+                        boundary
+                    )
+                ],
+            )
+            up.setopt(
+                pycurl.POSTFIELDSIZE_LARGE,
+                len(preamble) + size + len(epilogue),
+            )
+            up.setopt(pycurl.READFUNCTION, read)
+            up.setopt(pycurl.SEEKFUNCTION, seek)
+            up.setopt(pycurl.WRITEDATA, output)
+            up.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_GSSNEGOTIATE)
+            up.setopt(pycurl.USERPWD, ":")
+            try:
+                up.perform()
+            except pycurl.error as e:
+                if failures:
+                    raise failures[0]
+                if e.args[0] == pycurl.E_SEND_FAIL_REWIND:
+                    logger.debug(
+                        "Upload of %s for %s/%s requires a seekable file, cannot stream it.",
+                        s[0],
+                        ns,
+                        comp,
+                    )
+                    return False
+                raise
+            status = up.getinfo(pycurl.RESPONSE_CODE)
+        finally:
+            up.close()
+        if status != 200:
+            raise IOError(
+                "Destination cache returned status {} uploading {}: {}".format(
+                    status, s[0], output.getvalue()
+                )
+            )
+    finally:
+        abort.set()
+        downloader.join()
+    logger.debug(
+        "File %s for %s/%s (%s bytes) successfully streamed to the destination cache.",
+        s[0],
+        ns,
+        comp,
+        size,
+    )
+    count("bytes", "cache_file", size)
+    return True
 
-    logger.debug("Component %s/%s successfully synchronized.", ns, comp)
 
-    if repo_push(ns, comp, repo, dscm) is None:
-        logger.error("Failed to push %s/%s, skipping.", ns, comp)
-        return None
+def mark_cache_present(name, sources):
+    """Records lookaside cache files as present in the destination cache,
+    both for the current run and in the state database.
 
-    logger.info("Successfully synchronized %s/%s.", ns, comp)
-    return repo.git.rev_parse("HEAD")
+    :param name: The destination cache name in the `ns/name` form
+    :param sources: An iterable of (filename, hash, hashtype) source tuples
+    :returns: None
+    """
+    cgi = c["main"]["destination"]["cache"]["cgi"]
+    keys = [(cgi, name, s[0], s[1]) for s in sources]
+    with cache_present_lock:
+        cache_present.update(keys)
+    for key in keys:
+        state_query(
+            "INSERT OR IGNORE INTO lookaside VALUES (?, ?, ?, ?)", key
+        )
+    return None
 
 
-def sync_cache(comp, sources, ns="rpms"):
-    """Synchronizes lookaside cache contents for the given component.
-    Expects a set of (filename, hash, hastype) tuples to synchronize, as
-    returned by parse_sources().
+def check_cache(comp, ns, dcname, sources):
+    """Determines which of the given lookaside cache files are already
+    present in the destination cache.  Files already verified during this
+    run or recorded in the state database are not queried again; the rest
+    is checked over a single keep-alive connection per thread.
+
+    Errors are not fatal; files that could not be checked are reported as
+    unchecked rather than as present, and should be checked again before
+    they are transferred.
 
     :param comp: The component name
-    :param sources: The set of source tuples
     :param ns: The component namespace
-    :returns: The number of files processed, or None on error
+    :param dcname: The destination cache name of the component
+    :param sources: An iterable of (filename, hash, hashtype) source tuples
+    :returns: A (present, unchecked) tuple of sets of the source tuples
+              present in the destination cache and those not checked
     """
-    if "main" not in c:
-        logger.critical("DistroBaker is not configured, aborting.")
-        return None
-    if comp in c["main"]["control"]["exclude"][ns]:
-        logger.critical(
-            "The component %s/%s is excluded from sync, aborting.", ns, comp
+    cgi = c["main"]["destination"]["cache"]["cgi"]
+    name = "{}/{}".format(ns, dcname)
+    present = set()
+    unknown = list()
+    for s in sources:
+        key = (cgi, name, s[0], s[1])
+        with cache_present_lock:
+            known = key in cache_present
+        if not known:
+            known = bool(
+                state_query(
+                    "SELECT 1 FROM lookaside WHERE cache = ? AND name = ? "
+                    "AND filename = ? AND hash = ?",
+                    key,
+                )
+            )
+        if known:
+            present.add(s)
+        else:
+            unknown.append(s)
+    if present:
+        logger.debug(
+            "%d cache file(s) for %s/%s already known to be present.",
+            len(present),
+            ns,
+            comp,
         )
-        return None
+    if not unknown:
+        return present, set()
+    if not hasattr(sessions, "lookaside"):
+        sessions.lookaside = pycurl.Curl()
+    curl = sessions.lookaside
+    found = set()
+    unchecked = set()
+    for s in unknown:
+        output = io.BytesIO()
+        try:
+            curl.reset()
+            curl.setopt(pycurl.URL, cgi)
+            curl.setopt(
+                pycurl.HTTPPOST,
+                [
+                    ("name", name),
+                    ("{}sum".format(s[2]), s[1]),
+                    ("filename", s[0]),
+                ],
+            )
+            curl.setopt(pycurl.FOLLOWLOCATION, 1)
+            curl.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_GSSNEGOTIATE)
+            curl.setopt(pycurl.USERPWD, ":")
+            curl.setopt(pycurl.WRITEDATA, output)
+            with throttle(get_endpoint(cgi)):
+                curl.perform()
+            status = curl.getinfo(pycurl.RESPONSE_CODE)
+        except Exception:
+            logger.warning(
+                "Failed checking %s for %s/%s in the destination cache.",
+                s[0],
+                ns,
+                comp,
+                exc_info=True,
+            )
+            unchecked.add(s)
+            continue
+        if status == 200 and output.getvalue() == b"Available":
+            found.add(s)
+        elif status != 200:
+            unchecked.add(s)
+    if found:
+        mark_cache_present(name, found)
     logger.debug(
-        "Synchronizing %d cache file(s) for %s/%s.", len(sources), ns, comp
+        "Checked %d cache file(s) for %s/%s, %d already present.",
+        len(unknown),
+        ns,
+        comp,
+        len(found),
     )
+    return present | found, unchecked
+
+
+@timed("cache_file")
+def sync_cache_file(comp, ns, s, scname, dcname, dirname, check=True):
+    """Synchronizes a single lookaside cache file for the given component,
+    retrying on failures.  Safe to be called concurrently; every call uses
+    its own cache instances.
+
+    :param comp: The component name
+    :param ns: The component namespace
+    :param s: The (filename, hash, hashtype) source tuple
+    :param scname: The source cache name of the component
+    :param dcname: The destination cache name of the component
+    :param dirname: Directory to download the file to
+    :param check: False to skip the initial destination existence check,
+                  optional
+    :returns: True on success, False on error
+    """
     scache = pyrpkg.lookaside.CGILookasideCache(
         "sha512",
         c["main"]["source"]["cache"]["url"],
@@ -878,116 +3308,248 @@ def sync_cache(comp, sources, ns="rpms"):
         c["main"]["destination"]["cache"]["cgi"],
     )
     dcache.download_path = c["main"]["destination"]["cache"]["path"]
-    tempdir = tempfile.TemporaryDirectory(
-        prefix="cache-{}-{}-".format(ns, comp)
-    )
-    logger.debug("Temporary directory created: %s", tempdir.name)
-    if comp in c["comps"][ns]:
-        scname = c["comps"][ns][comp]["cache"]["source"]
-        dcname = c["comps"][ns][comp]["cache"]["destination"]
-    else:
-        scname = c["main"]["defaults"]["cache"]["source"] % {"component": comp}
-        dcname = c["main"]["defaults"]["cache"]["source"] % {"component": comp}
-    for s in sources:
-        # There's no API for this and .upload doesn't let us override it
-        dcache.hashtype = s[2]
-        for attempt in range(retry):
+    # There's no API for this and .upload doesn't let us override it
+    dcache.hashtype = s[2]
+
+    def transfer():
+        nonlocal check
+        exists = check and dcache.remote_file_exists(
+            "{}/{}".format(ns, dcname), s[0], s[1]
+        )
+        check = True
+        if not exists:
+            if streaming and stream_cache_file(
+                comp, ns, s, scache, dcache, scname, dcname
+            ):
+                if not dry_run:
+                    mark_cache_present("{}/{}".format(ns, dcname), [s])
+                return True
+            logger.debug(
+                "File %s for %s/%s (%s/%s) not available in the destination cache, downloading.",
+                s[0],
+                ns,
+                comp,
+                ns,
+                dcname,
+            )
             try:
-                if not dcache.remote_file_exists(
-                    "{}/{}".format(ns, dcname), s[0], s[1]
-                ):
-                    logger.debug(
-                        "File %s for %s/%s (%s/%s) not available in the destination cache, downloading.",
-                        s[0],
-                        ns,
-                        comp,
-                        ns,
-                        dcname,
-                    )
-                    scache.download(
-                        "{}/{}".format(ns, scname),
-                        s[0],
+                scache.download(
+                    "{}/{}".format(ns, scname),
+                    s[0],
+                    s[1],
+                    os.path.join(dirname, s[0]),
+                    hashtype=s[2],
+                )
+            except Exception as e:
+                raise blame(
+                    e, get_endpoint(c["main"]["source"]["cache"]["url"])
+                )
+            logger.debug(
+                "File %s for %s/%s (%s/%s) successfully downloaded.  "
+                "Uploading to the destination cache.",
+                s[0],
+                ns,
+                comp,
+                ns,
+                scname,
+            )
+            if not dry_run:
+                try:
+                    dcache.upload(
+                        "{}/{}".format(ns, dcname),
+                        os.path.join(dirname, s[0]),
                         s[1],
-                        os.path.join(tempdir.name, s[0]),
-                        hashtype=s[2],
-                    )
-                    logger.debug(
-                        "File %s for %s/%s (%s/%s) successfully downloaded.  "
-                        "Uploading to the destination cache.",
-                        s[0],
-                        ns,
-                        comp,
-                        ns,
-                        scname,
                     )
-                    if not dry_run:
-                        dcache.upload(
-                            "{}/{}".format(ns, dcname),
-                            os.path.join(tempdir.name, s[0]),
-                            s[1],
-                        )
-                        logger.debug(
-                            "File %s for %s/%s (%s/%s) )successfully uploaded to the destination cache.",
-                            s[0],
-                            ns,
-                            comp,
-                            ns,
-                            dcname,
-                        )
-                    else:
-                        logger.debug(
-                            "Running in dry run mode, not uploading %s for %s/%s.",
-                            s[0],
-                            ns,
-                            comp,
-                        )
-                else:
+                except pyrpkg.errors.AlreadyUploadedError:
                     logger.debug(
-                        "File %s for %s/%s (%s/%s) already uploaded, skipping.",
+                        "File %s for %s/%s (%s/%s) uploaded concurrently.",
                         s[0],
                         ns,
                         comp,
                         ns,
                         dcname,
                     )
-            except Exception:
-                logger.warning(
-                    "Failed attempt #%d/%d handling %s for %s/%s (%s/%s -> %s/%s), retrying.",
-                    attempt + 1,
-                    retry,
+                mark_cache_present("{}/{}".format(ns, dcname), [s])
+                count(
+                    "bytes",
+                    "cache_file",
+                    os.path.getsize(os.path.join(dirname, s[0])),
+                )
+                logger.debug(
+                    "File %s for %s/%s (%s/%s) )successfully uploaded to the destination cache.",
                     s[0],
                     ns,
                     comp,
                     ns,
-                    scname,
-                    ns,
                     dcname,
-                    exc_info=True,
                 )
             else:
-                break
+                logger.debug(
+                    "Running in dry run mode, not uploading %s for %s/%s.",
+                    s[0],
+                    ns,
+                    comp,
+                )
         else:
-            logger.error(
-                "Exhausted lookaside cache synchronization attempts for %s/%s while working on %s, skipping.",
+            logger.debug(
+                "File %s for %s/%s (%s/%s) already uploaded, skipping.",
+                s[0],
                 ns,
                 comp,
-                s[0],
+                ns,
+                dcname,
+            )
+        return True
+
+    try:
+        return with_retry(
+            transfer,
+            get_endpoint(c["main"]["destination"]["cache"]["cgi"]),
+            "Synchronizing {} for {}/{} ({}/{} -> {}/{})".format(
+                s[0], ns, comp, ns, scname, ns, dcname
+            ),
+            "cache_file",
+            also=(get_endpoint(c["main"]["source"]["cache"]["url"]),),
+        )
+    except Exception:
+        logger.error(
+            "Exhausted lookaside cache synchronization attempts for %s/%s "
+            "while working on %s, skipping.",
+            ns,
+            comp,
+            s[0],
+        )
+        return False
+
+
+def sync_cache_slot(comp, ns, s, scname, dcname, dirname, check=True):
+    """Calls sync_cache_file() once a global lookaside cache transfer slot
+    is available.
+
+    :param comp: The component name
+    :param ns: The component namespace
+    :param s: The (filename, hash, hashtype) source tuple
+    :param scname: The source cache name of the component
+    :param dcname: The destination cache name of the component
+    :param dirname: Directory to download the file to
+    :param check: False to skip the initial destination existence check,
+                  optional
+    :returns: True on success, False on error
+    """
+    slots = cache_slots
+    if slots is None:
+        return sync_cache_file(comp, ns, s, scname, dcname, dirname, check)
+    with slots:
+        return sync_cache_file(comp, ns, s, scname, dcname, dirname, check)
+
+
+@timed("sync_cache")
+def sync_cache(comp, sources, ns="rpms"):
+    """Synchronizes lookaside cache contents for the given component.
+    Expects a dictionary of hashtypes to lists of (filename, hash, hashtype)
+    tuples to synchronize, as returned by diff_sources().
+
+    Up to `cache_jobs()` files are transferred concurrently, subject to
+    the global `cache_jobs_total()` limit.
+
+    :param comp: The component name
+    :param sources: The source tuples grouped by hashtype
+    :param ns: The component namespace
+    :returns: The number of files processed, or None on error
+    """
+    if "main" not in c:
+        logger.critical("DistroBaker is not configured, aborting.")
+        return None
+    if comp in c["main"]["control"]["exclude"][ns]:
+        logger.critical(
+            "The component %s/%s is excluded from sync, aborting.", ns, comp
+        )
+        return None
+    total = sum(len(x) for x in sources.values())
+    logger.debug(
+        "Synchronizing %d cache file(s) for %s/%s.", total, ns, comp
+    )
+    tempdir = tempfile.TemporaryDirectory(
+        prefix="cache-{}-{}-".format(ns, comp)
+    )
+    logger.debug("Temporary directory created: %s", tempdir.name)
+    scname = c["comps"][ns].resolve(comp)["cache"]["source"]
+    dcname = c["comps"][ns].resolve(comp)["cache"]["destination"]
+    # (source tuple, check) pairs; files that could not be checked are
+    # checked again before the transfer
+    missing = list()
+    for group in sources.values():
+        present, unchecked = check_cache(comp, ns, dcname, group)
+        missing.extend((x, x in unchecked) for x in group if x not in present)
+    logger.debug(
+        "%d cache file(s) for %s/%s missing in the destination cache.",
+        len(missing),
+        ns,
+        comp,
+    )
+    if cache_workers == 1 or len(missing) < 2:
+        for s, check in missing:
+            if not sync_cache_slot(
+                comp, ns, s, scname, dcname, tempdir.name, check
+            ):
+                return None
+        return total
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(cache_workers, len(missing)),
+        thread_name_prefix="cache-{}-{}".format(ns, comp),
+    ) as executor:
+        futures = [
+            executor.submit(
+                sync_cache_slot,
+                comp,
+                ns,
+                s,
+                scname,
+                dcname,
+                tempdir.name,
+                check,
             )
-            return None
-    return len(sources)
+            for s, check in missing
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                ok = future.result()
+            except Exception:
+                logger.exception(
+                    "Unexpected error synchronizing cache files for %s/%s.",
+                    ns,
+                    comp,
+                )
+                ok = False
+            if not ok:
+                for f in futures:
+                    f.cancel()
+                return None
+    return total
 
 
-def build_comp(comp, ref, ns="rpms"):
+@timed("build")
+def build_comp(comp, ref, ns="rpms", nvr=None, existing=None):
     """Submits a build for the requested component.  Requires the
     component name, namespace and the destination SCM reference to build.
     The build is submitted for the configured build target.  The build
-    SCMURL is prefixed with the configured prefix.
+    SCMURL is prefixed with the configured prefix.  Submitted builds are
+    watched, see watch_task().
+
+    If the destination build system already has a build of the reference,
+    complete or in progress, or an open build task for it, nothing is
+    submitted and the ID of the existing task is returned; see
+    find_builds().  Callers building many components should find their
+    builds in bulk and pass the results.
 
     In the dry-run mode, the returned task ID is 0.
 
     :param comp: The component name
     :param ref: The SCM reference
     :param ns: The component namespace
+    :param nvr: The synchronized NVR, optional
+    :param existing: The find_builds() results including the component,
+                     optional; looked up if not provided
     :returns: The build system task ID, or None on error
     """
     if "main" not in c:
@@ -1000,54 +3562,74 @@ def build_comp(comp, ref, ns="rpms"):
         return None
     logger.info("Processing build for %s/%s.", ns, comp)
     if ns == "rpms":
-        bsys = get_buildsys("destination")
-        buildcomp = comp
-        if comp in c["comps"][ns]:
-            buildcomp = split_scmurl(c["comps"][ns][comp]["destination"])[
-                "comp"
-            ]
-        try:
-            if not dry_run:
-                task = bsys.build(
-                    "{}/{}/{}#{}".format(
-                        c["main"]["build"]["prefix"], ns, buildcomp, ref
-                    ),
-                    c["main"]["build"]["target"],
-                    {"scratch": c["main"]["build"]["scratch"]},
-                )
-                logger.debug(
-                    "Build submitted for %s/%s; task %d; SCMURL: %s/%s/%s#%s.",
+        if existing is None:
+            existing = find_builds({comp: ref}, ns=ns)
+        if existing is None:
+            logger.warning(
+                "Cannot check for existing builds of %s/%s, submitting anyway.",
+                ns,
+                comp,
+            )
+        elif comp in existing:
+            logger.info(
+                "The %s/%s component is already built or being built from %s "
+                "in task %s (%s), skipping submission.",
+                ns,
+                comp,
+                ref,
+                existing[comp]["task"],
+                existing[comp]["state"],
+            )
+            count("builds", "skipped")
+            if existing[comp]["state"] != "COMPLETE":
+                watch_task(existing[comp]["task"], ns, comp, nvr=nvr)
+            return existing[comp]["task"]
+        with buildsys("destination") as bsys:
+            buildcomp = get_build_comp(comp, ns)
+            try:
+                if not dry_run:
+                    task = bsys.build(
+                        "{}/{}/{}#{}".format(
+                            c["main"]["build"]["prefix"], ns, buildcomp, ref
+                        ),
+                        c["main"]["build"]["target"],
+                        {"scratch": c["main"]["build"]["scratch"]},
+                    )
+                    logger.debug(
+                        "Build submitted for %s/%s; task %d; SCMURL: %s/%s/%s#%s.",
+                        ns,
+                        comp,
+                        task,
+                        c["main"]["build"]["prefix"],
+                        ns,
+                        buildcomp,
+                        ref,
+                    )
+                    watch_task(task, ns, comp, nvr=nvr)
+                else:
+                    task = 0
+                    logger.info(
+                        "Running in the dry mode, not submitting any builds "
+                        "for %s/%s (%s/%s/%s#%s).",
+                        ns,
+                        comp,
+                        c["main"]["build"]["prefix"],
+                        ns,
+                        buildcomp,
+                        ref,
+                    )
+                return task
+            except Exception:
+                logger.exception(
+                    "Failed submitting build for %s/%s (%s/%s/%s#%s).",
                     ns,
                     comp,
-                    task,
                     c["main"]["build"]["prefix"],
                     ns,
-                    buildcomp,
-                    ref,
-                )
-            else:
-                task = 0
-                logger.info(
-                    "Running in the dry mode, not submitting any builds for %s/%s (%s/%s/%s#%s).",
-                    ns,
                     comp,
-                    c["main"]["build"]["prefix"],
-                    ns,
-                    buildcomp,
                     ref,
                 )
-            return task
-        except Exception:
-            logger.exception(
-                "Failed submitting build for %s/%s (%s/%s/%s#%s).",
-                ns,
-                comp,
-                c["main"]["build"]["prefix"],
-                ns,
-                comp,
-                ref,
-            )
-            return None
+                return None
     elif ns == "modules":
         logger.critical(
             "Cannot build %s/%s; module building not implemented.", ns, comp
@@ -1058,16 +3640,376 @@ def build_comp(comp, ref, ns="rpms"):
         return None
 
 
-def process_message(msg):
-    """Processes a fedora-messaging messages.  We can only handle Koji
-    tagging events; messaging should be configured properly.
+def get_build_comp(comp, ns="rpms"):
+    """Gets the name the component is built as in the destination, i.e.
+    the name of its destination repository.
 
-    If the message is recognized and matches our configuration or mode,
-    the function calls `sync_repo()` and `build_comp()`.
+    :param comp: The component name
+    :param ns: The component namespace
+    :returns: The destination component name
+    """
+    if comp in c["comps"][ns]:
+        return split_scmurl(c["comps"][ns][comp]["destination"])["comp"]
+    return comp
+
+
+def get_build_owner(bsys):
+    """Gets the ID of the destination build system user submitting the
+    builds.  Looked up once and cached.
+
+    :param bsys: An authenticated destination koji session
+    :returns: The user ID, or None if unknown
+    """
+    global build_owner
+    if build_owner is None:
+        try:
+            build_owner = bsys.getLoggedInUser()["id"]
+        except Exception:
+            logger.debug(
+                "Cannot find the destination build system user.",
+                exc_info=True,
+            )
+    return build_owner
+
+
+def find_builds(refs, ns="rpms"):
+    """Finds components the destination build system already builds from
+    the given SCM references, either as a build, complete or in progress,
+    whose source matches the reference, or as an open build task for the
+    same SCMURL submitted by the DistroBaker user.  Checks all components
+    with a single multicall.
+
+    Scratch builds leave no builds behind, so only the open tasks are
+    checked if scratch builds are configured.
+
+    :param refs: A dictionary mapping component names to SCM references
+    :param ns: The components namespace
+    :returns: A dictionary mapping the found component names to
+              dictionaries with the `task` and `state` keys, or None on
+              error
+    """
+    found = dict()
+    if not refs:
+        return found
+    scmurls = {
+        comp: "{}/{}/{}#{}".format(
+            c["main"]["build"]["prefix"], ns, get_build_comp(comp, ns), ref
+        )
+        for comp, ref in refs.items()
+    }
+    calls = dict()
+    with buildsys("destination") as bsys:
+        if bsys is None:
+            logger.error("Build system unavailable, cannot find builds.")
+            return None
+        # Only open build tasks of our own are of interest
+        opts = {
+            "method": "build",
+            "state": [
+                koji.TASK_STATES[x] for x in ("FREE", "OPEN", "ASSIGNED")
+            ],
+            "decode": True,
+        }
+        owner = get_build_owner(bsys)
+        if owner is not None:
+            opts["owner"] = owner
+        try:
+            with bsys.multicall(batch=1000) as mc:
+                if not c["main"]["build"]["scratch"]:
+                    for comp, ref in refs.items():
+                        calls[comp] = mc.listBuilds(
+                            source="*/{}/{}*#{}".format(
+                                ns, get_build_comp(comp, ns), ref
+                            )
+                        )
+                tasks = mc.listTasks(opts=opts)
+        except Exception:
+            logger.exception("An error occurred while finding builds.")
+            return None
+    try:
+        for comp, call in calls.items():
+            for b in call.result:
+                if b["state"] in (
+                    koji.BUILD_STATES["BUILDING"],
+                    koji.BUILD_STATES["COMPLETE"],
+                ):
+                    found[comp] = {
+                        "task": b["task_id"],
+                        "state": koji.BUILD_STATES[b["state"]],
+                    }
+                    break
+        byurl = {v: k for k, v in scmurls.items()}
+        for t in tasks.result:
+            comp = byurl.get((t.get("request") or [None])[0])
+            if comp is not None and comp not in found:
+                found[comp] = {
+                    "task": t["id"],
+                    "state": koji.TASK_STATES[t["state"]],
+                }
+    except Exception:
+        logger.exception("An error occurred while finding builds.")
+        return None
+    logger.debug(
+        "Found %d of %d component(s) already built.", len(found), len(refs)
+    )
+    return found
+
+
+def watch_task(task, ns, comp, nvr=None):
+    """Starts watching a submitted build task, see poll_tasks().  Does
+    nothing in the dry run mode or if watching is disabled.
+
+    :param task: The build system task ID
+    :param ns: The component namespace
+    :param comp: The component name
+    :param nvr: The synchronized NVR, optional
+    :returns: None
+    """
+    if not task or not watch_interval:
+        return None
+    submitted = time.time()
+    with watch_lock:
+        watched[task] = {
+            "ns": ns,
+            "comp": comp,
+            "nvr": nvr,
+            "submitted": submitted,
+        }
+    state_query(
+        "INSERT OR REPLACE INTO builds "
+        "(task, ns, comp, nvr, state, submitted) VALUES (?, ?, ?, ?, ?, ?)",
+        (task, ns, comp, nvr, "OPEN", submitted),
+    )
+    start_watcher()
+    return None
+
+
+def start_watcher():
+    """Starts the build task watcher thread, unless already running.  Tasks
+    left unfinished in the state database by a previous run are watched
+    again.
+
+    :returns: None
+    """
+    global watcher_thread
+    with watch_lock:
+        if watcher_thread is not None or not watch_interval:
+            return None
+        watcher_thread = threading.Thread(
+            target=watcher, name="distrobaker-watcher", daemon=True
+        )
+    for task, ns, comp, nvr, submitted in (
+        state_query(
+            "SELECT task, ns, comp, nvr, submitted FROM builds "
+            "WHERE finished IS NULL"
+        )
+        or list()
+    ):
+        with watch_lock:
+            watched.setdefault(
+                task,
+                {"ns": ns, "comp": comp, "nvr": nvr, "submitted": submitted},
+            )
+    watcher_thread.start()
+    logger.debug("Started the build task watcher.")
+    return None
+
+
+def watcher():
+    """Polls the watched build tasks forever.  Started by
+    `start_watcher()`.
 
-    :param msg: fedora-messaging message
     :returns: None
     """
+    while True:
+        time.sleep(watch_interval)
+        try:
+            poll_tasks()
+        except Exception:
+            logger.exception("Unexpected error polling the build tasks.")
+
+
+def poll_tasks():
+    """Polls all watched build tasks with a single multicall and records
+    the outcomes of the finished ones.  Components whose builds failed or
+    were canceled are no longer considered built by the state, so that
+    they are built again on the next synchronization.
+
+    :returns: The number of finished tasks, or None on error
+    """
+    with watch_lock:
+        tasks = dict(watched)
+    if not tasks:
+        return 0
+    calls = dict()
+    with buildsys("destination") as bsys:
+        if bsys is None:
+            logger.error("Build system unavailable, cannot poll build tasks.")
+            return None
+        try:
+            with bsys.multicall(batch=1000) as mc:
+                for task in tasks:
+                    calls[task] = mc.getTaskInfo(task)
+        except Exception:
+            logger.exception("An error occurred while polling build tasks.")
+            return None
+    finished = 0
+    for task, call in calls.items():
+        try:
+            info = call.result
+            outcome = koji.TASK_STATES[info["state"]]
+        except Exception:
+            logger.debug("Cannot poll build task %s.", task, exc_info=True)
+            continue
+        if outcome not in ("CLOSED", "FAILED", "CANCELED"):
+            continue
+        rec = dict(tasks[task], state=outcome, finished=time.time())
+        if info.get("create_ts") and info.get("completion_ts"):
+            rec["duration"] = info["completion_ts"] - info["create_ts"]
+        else:
+            rec["duration"] = rec["finished"] - rec["submitted"]
+        with watch_lock:
+            watched.pop(task, None)
+            outcomes[task] = rec
+        finished += 1
+        observe("build_task", rec["duration"])
+        count("builds", outcome.lower())
+        state_query(
+            "UPDATE builds SET state = ?, finished = ? WHERE task = ?",
+            (outcome, rec["finished"], task),
+        )
+        if outcome == "CLOSED":
+            logger.info(
+                "Build task %s of %s/%s completed successfully.",
+                task,
+                rec["ns"],
+                rec["comp"],
+            )
+            continue
+        logger.error(
+            "Build task %s of %s/%s finished in the %s state.",
+            task,
+            rec["ns"],
+            rec["comp"],
+            outcome,
+        )
+        prev = get_sync_state(rec["ns"], rec["comp"])
+        if prev is not None and prev["task"] == task:
+            set_sync_state(rec["ns"], rec["comp"], task=None)
+        key = (rec["ns"], rec["comp"])
+        with work:
+            if rec["nvr"] and synced.get(key) == rec["nvr"]:
+                del synced[key]
+    if finished:
+        logger.info("Build summary: %s", json.dumps(build_summary()))
+    return finished
+
+
+def build_summary(since=None):
+    """Summarizes the outcomes of the watched build tasks.
+
+    :param since: Only include tasks submitted since this UNIX time, optional
+    :returns: A dictionary with the `closed`, `failed`, `canceled` and
+              `open` task counts and the `failures` list of failed
+              components in the `ns/comp` form
+    """
+    since = since or 0
+    with watch_lock:
+        done = [x for x in outcomes.values() if x["submitted"] >= since]
+        left = [x for x in watched.values() if x["submitted"] >= since]
+    summary = {
+        k: sum(1 for x in done if x["state"] == k.upper())
+        for k in ("closed", "failed", "canceled")
+    }
+    summary["open"] = len(left)
+    summary["failures"] = sorted(
+        "{}/{}".format(x["ns"], x["comp"])
+        for x in done
+        if x["state"] != "CLOSED"
+    )
+    return summary
+
+
+def record_duration(ns, comp, seconds):
+    """Records how long processing the given component took, updating its
+    estimated cost as an exponentially weighted moving average.
+
+    :param ns: The component namespace
+    :param comp: The component name
+    :param seconds: The processing duration in seconds
+    :returns: The new estimate in seconds
+    """
+    get_cost(ns, comp)
+    with durations_lock:
+        prev = durations.get((ns, comp))
+        est = seconds if prev is None else (prev + seconds) / 2
+        durations[(ns, comp)] = est
+    state_query(
+        "INSERT OR REPLACE INTO durations (ns, comp, seconds) VALUES (?, ?, ?)",
+        (ns, comp, est),
+    )
+    return est
+
+
+def get_cost(ns, comp):
+    """Gets the estimated cost of processing the given component, based on
+    its past processing durations.  Components never processed before are
+    estimated at the average of all known components.
+
+    :param ns: The component namespace
+    :param comp: The component name
+    :returns: The estimated duration in seconds
+    """
+    global durations_loaded
+    with durations_lock:
+        if not durations_loaded:
+            durations_loaded = True
+            for rns, rcomp, secs in (
+                state_query("SELECT ns, comp, seconds FROM durations") or list()
+            ):
+                durations.setdefault((rns, rcomp), secs)
+        if (ns, comp) in durations:
+            return durations[(ns, comp)]
+        if not durations:
+            return 0.0
+        return sum(durations.values()) / len(durations)
+
+
+def get_priority(ns, comp):
+    """Gets the configured priority class of the given component.
+
+    :param ns: The component namespace
+    :param comp: The component name
+    :returns: The priority class, 0 if not configured
+    """
+    return c["main"]["control"]["priority"].get(ns, dict()).get(comp, 0)
+
+
+def schedule_key(ns, comp, age=0):
+    """Computes the scheduling order key of the given component.  Higher
+    priority classes come first; waiting for `control.aging` seconds counts
+    as one priority class.  Within the same class, components expected to
+    finish sooner come first.
+
+    :param ns: The component namespace
+    :param comp: The component name
+    :param age: Seconds the work has been waiting, optional
+    :returns: A key sorting the most urgent work first
+    """
+    return (
+        -(get_priority(ns, comp) + age / c["main"]["control"]["aging"]),
+        get_cost(ns, comp),
+        comp.lower(),
+    )
+
+
+def parse_message(msg):
+    """Validates a fedora-messaging message.  We can only handle Koji
+    tagging events; messaging should be configured properly.
+
+    :param msg: fedora-messaging message
+    :returns: A (namespace, component, NVR) tuple if the message should be processed, None otherwise
+    """
     if "main" not in c:
         logger.critical("DistroBaker is not configured, aborting.")
         return None
@@ -1095,118 +4037,527 @@ def process_message(msg):
                 logger.info(
                     "Handling an RPM trigger for %s, tag %s.", comp, tag
                 )
-                if comp in c["main"]["control"]["exclude"]["rpms"]:
-                    logger.info(
-                        "The rpms/%s component is excluded from sync, skipping.",
-                        comp,
-                    )
-                    return None
-                ref = sync_repo(comp, ns="rpms", nvr=nvr)
-                if ref is not None:
-                    task = build_comp(comp, ref, ns="rpms")
-                    if task is not None:
-                        logger.info(
-                            "Build submission of rpms/%s complete, task %s, trigger processed.",
-                            comp,
-                            task,
-                        )
-                    else:
-                        logger.error(
-                            "Build submission of rpms/%s failed, aborting.trigger.",
-                            comp,
-                        )
-                else:
-                    logger.error(
-                        "Synchronization of rpms/%s failed, aborting trigger.",
-                        comp,
-                    )
+                if comp in c["main"]["control"]["exclude"]["rpms"]:
+                    logger.info(
+                        "The rpms/%s component is excluded from sync, skipping.",
+                        comp,
+                    )
+                    return None
+                return ("rpms", comp, nvr)
+            logger.debug(
+                "RPM component %s not configured for sync and the strict "
+                "mode is enabled, ignoring.",
+                comp,
+            )
+        elif tag == c["main"]["trigger"]["modules"]:
+            logger.error(
+                "The message matches our module configuration but module building not implemented, ignoring."
+            )
+        else:
+            logger.debug("Message tag not configured as a trigger, ignoring.")
+    else:
+        logger.warning("Unable to handle %s topics, ignoring.", msg.topic)
+    return None
+
+
+def process_trigger(comp, nvr, ns="rpms"):
+    """Processes a trigger for the given component build, synchronizing
+    and building it with `run_pipeline()`.
+
+    :param comp: The component name
+    :param nvr: The NVR of the triggering build
+    :param ns: The component namespace
+    :returns: The build system task ID, False if already up to date, or None on error
+    """
+    start = time.monotonic()
+    job = run_pipeline(comp, ns=ns, nvr=nvr)
+    record_duration(ns, comp, time.monotonic() - start)
+    if job["ref"] is None:
+        logger.error(
+            "Synchronization of %s/%s failed, aborting trigger.", ns, comp
+        )
+        return None
+    if job["ref"] is False:
+        logger.info("%s/%s is up to date, trigger processed.", ns, comp)
+        return False
+    task = job.get("task")
+    if task is None:
+        logger.error(
+            "Build submission of %s/%s failed, aborting trigger.", ns, comp
+        )
+        return None
+    logger.info(
+        "Build submission of %s/%s complete, task %s, trigger processed.",
+        ns,
+        comp,
+        task,
+    )
+    return task
+
+
+def process_message(msg):
+    """Processes a fedora-messaging messages.  We can only handle Koji
+    tagging events; messaging should be configured properly.
+
+    If the message is recognized and matches our configuration or mode,
+    the function calls `sync_repo()` and `build_comp()`.
+
+    :param msg: fedora-messaging message
+    :returns: None
+    """
+    trigger = parse_message(msg)
+    if trigger is not None:
+        process_trigger(trigger[1], trigger[2], ns=trigger[0])
+    return None
+
+
+def queue_trigger(rowid, ns, comp, nvr, delay=None, waiter=None):
+    """Queues a trigger for processing by the workers, coalescing it with
+    any pending trigger of the same component.  The newest NVR wins.
+    Triggers for NVRs already synchronized are dropped.
+
+    :param rowid: The state database row ID of the trigger, or None
+    :param ns: The component namespace
+    :param comp: The component name
+    :param nvr: The NVR of the triggering build
+    :param delay: Seconds until the trigger is due; defaults to `coalesce()`
+    :param waiter: An event set once the trigger is processed, optional
+    :returns: True if the trigger was queued, False if dropped
+    """
+    key = (ns, comp)
+    with work:
+        if key not in running and synced.get(key) == nvr:
+            logger.info(
+                "%s/%s already synchronized to %s, dropping the trigger.",
+                ns,
+                comp,
+                nvr,
+            )
+            if rowid is not None:
+                state_query("DELETE FROM queue WHERE id = ?", (rowid,))
+            return False
+        due = time.monotonic() + (debounce if delay is None else delay)
+        if key in pending:
+            logger.debug(
+                "Coalescing the %s/%s trigger for %s with %s.",
+                ns,
+                comp,
+                nvr,
+                pending[key]["nvr"],
+            )
+            # triggers may arrive out of order, keep the newest NVR
+            if compare_nvrs(nvr, pending[key]["nvr"]) >= 0:
+                pending[key]["nvr"] = nvr
+            pending[key]["due"] = due
+        else:
+            pending[key] = {
+                "nvr": nvr,
+                "rowids": list(),
+                "waiters": list(),
+                "due": due,
+                "since": time.monotonic(),
+            }
+        if rowid is not None:
+            pending[key]["rowids"].append(rowid)
+        if waiter is not None:
+            pending[key]["waiters"].append(waiter)
+        work.notify()
+        logger.debug(
+            "Queued the %s/%s trigger for %s, %d trigger(s) pending.",
+            ns,
+            comp,
+            nvr,
+            len(pending),
+        )
+    return True
+
+
+def queue_depth():
+    """Gets the number of triggers waiting to be processed.
+
+    :returns: The number of pending triggers
+    """
+    with work:
+        return len(pending)
+
+
+def enqueue_message(msg):
+    """Validates a fedora-messaging message and queues it for processing
+    by the workers started with `start_workers()`, returning immediately.
+    Meant to be used as the message consumer callback.
+
+    With the persistent state enabled, the trigger is recorded in the state
+    database before returning, so that it survives restarts once the message
+    is acknowledged.  If that fails, the message is rejected and requeued
+    by the broker.  Without the persistent state, nothing would hold the
+    trigger after the acknowledgement, so this waits until the trigger is
+    processed instead.
+
+    :param msg: fedora-messaging message
+    :returns: None
+    """
+    trigger = parse_message(msg)
+    if trigger is None:
+        return None
+    if state_path is None:
+        done = threading.Event()
+        if queue_trigger(None, *trigger, delay=0, waiter=done):
+            done.wait()
+        return None
+    rowid = state_query(
+        "INSERT INTO queue (ns, comp, nvr) VALUES (?, ?, ?)",
+        trigger,
+        rowid=True,
+    )
+    if rowid is None:
+        logger.error(
+            "Failed to record the %s/%s trigger, requeueing the message.",
+            trigger[0],
+            trigger[1],
+        )
+        raise fedora_messaging.exceptions.Nack()
+    queue_trigger(rowid, *trigger)
+    return None
+
+
+def next_trigger():
+    """Waits for the next due trigger of a component that is not being
+    processed already and marks the component as running.  Of all due
+    triggers, the most urgent one is picked, see schedule_key().
+
+    :returns: A (namespace, component, NVR, state row IDs, waiters) tuple,
+              or None once the workers are being stopped
+    """
+    with work:
+        while True:
+            if stopping.is_set():
+                return None
+            now = time.monotonic()
+            waiting = [k for k in pending if k not in running]
+            ready = [k for k in waiting if pending[k]["due"] <= now]
+            if ready:
+                key = min(
+                    ready,
+                    key=lambda k: schedule_key(
+                        k[0], k[1], now - pending[k]["since"]
+                    ),
+                )
+                trigger = pending.pop(key)
+                running.add(key)
+                return key + (
+                    trigger["nvr"],
+                    trigger["rowids"],
+                    trigger["waiters"],
+                )
+            if waiting:
+                work.wait(min(pending[k]["due"] for k in waiting) - now)
             else:
-                logger.debug(
-                    "RPM component %s not configured for sync and the strict mode is enabled, ignoring.",
+                work.wait()
+
+
+def worker():
+    """Processes queued triggers until stopped.  Started by
+    `start_workers()`, stopped by `stop_workers()`.
+
+    :returns: None
+    """
+    while True:
+        trigger = next_trigger()
+        if trigger is None:
+            return None
+        ns, comp, nvr, rowids, waiters = trigger
+        task = None
+        try:
+            if synced.get((ns, comp)) == nvr:
+                logger.info(
+                    "%s/%s already synchronized to %s, dropping the trigger.",
+                    ns,
                     comp,
+                    nvr,
                 )
-        elif tag == c["main"]["trigger"]["modules"]:
-            logger.error(
-                "The message matches our module configuration but module building not implemented, ignoring."
+            else:
+                task = process_trigger(comp, nvr, ns=ns)
+        except Exception:
+            logger.exception(
+                "Unexpected error processing the %s/%s trigger.", ns, comp
             )
-        else:
-            logger.debug("Message tag not configured as a trigger, ignoring.")
-    else:
-        logger.warning("Unable to handle %s topics, ignoring.", msg.topic)
-    return None
+        finally:
+            for rowid in rowids:
+                state_query("DELETE FROM queue WHERE id = ?", (rowid,))
+            with work:
+                if task is not None:
+                    synced[(ns, comp)] = nvr
+                running.discard((ns, comp))
+                work.notify_all()
+            for waiter in waiters:
+                waiter.set()
+
+
+def start_workers(nworkers=None):
+    """Starts the worker threads processing queued triggers.  Triggers
+    left over in the state database from a previous run are queued first
+    and NVRs recorded as synchronized there are not synchronized again.
+
+    :param nworkers: The number of workers; defaults to `job_slots()`
+    :returns: The list of started worker threads
+    """
+    with work:
+        queued = {x for v in pending.values() for x in v["rowids"]}
+    rows = [
+        tuple(x)
+        for x in state_query(
+            "SELECT id, ns, comp, nvr FROM queue ORDER BY id"
+        )
+        or list()
+        if x[0] not in queued
+    ]
+    with work:
+        for ns, comp, nvr in (
+            state_query("SELECT ns, comp, nvr FROM syncs WHERE task IS NOT NULL")
+            or list()
+        ):
+            synced.setdefault((ns, comp), nvr)
+    for row in rows:
+        queue_trigger(*row, delay=0)
+    if rows:
+        logger.info("Requeued %d pending trigger(s).", len(rows))
+    threads = list()
+    for i in range(nworkers if nworkers else job_slots()):
+        t = threading.Thread(
+            target=worker, name="distrobaker-worker-{}".format(i), daemon=True
+        )
+        t.start()
+        threads.append(t)
+    with work:
+        worker_threads.extend(threads)
+    logger.debug("Started %d worker(s).", len(threads))
+    return threads
+
+
+def stop_workers(timeout=None):
+    """Stops the worker threads started by `start_workers()`.  Workers
+    finish the trigger they are processing first; pending triggers are
+    left queued and, with the persistent state enabled, requeued on the
+    next start.
+
+    :param timeout: Seconds to wait for each worker to exit, optional
+    :returns: True if all workers exited, False otherwise
+    """
+    with work:
+        threads = list(worker_threads)
+        stopping.set()
+        work.notify_all()
+    for t in threads:
+        t.join(timeout)
+    alive = [t for t in threads if t.is_alive()]
+    with work:
+        worker_threads[:] = alive
+        if not alive:
+            stopping.clear()
+    logger.debug(
+        "Stopped %d worker(s), %d still running.",
+        len(threads) - len(alive),
+        len(alive),
+    )
+    return not alive
+
+
+def process_component(rec, builds=None):
+    """Processes a single component in the `ns/comp` form, synchronizing
+    its SCM repository and submitting a build.  Used by
+    `process_components()`, possibly from several threads at once.
+
+    :param rec: The component to process in the `ns/comp` form
+    :param builds: Pre-resolved builds as returned by resolve_builds(), optional
+    :returns: The job dictionary if the component was processed, False if skipped
+    """
+    m = cre.match(rec)
+    if m is None:
+        logger.error("Cannot process %s; looks like garbage.", rec)
+        return False
+    m = m.groupdict()
+    logger.info("Processing %s.", rec)
+    if m["namespace"] == "modules":
+        logger.warning(
+            "The modules/%s component is a module; modules currently not implemented, skipping.",
+            m["component"],
+        )
+        return False
+    if m["component"] in c["main"]["control"]["exclude"][m["namespace"]]:
+        logger.info(
+            "The %s/%s component is excluded from sync, skipping.",
+            m["namespace"],
+            m["component"],
+        )
+        return False
+    if (
+        c["main"]["control"]["strict"]
+        and m["component"] not in c["comps"][m["namespace"]]
+    ):
+        logger.info(
+            "The %s/%s component not configured while the strict mode is enabled, ignoring.",
+            m["namespace"],
+            m["component"],
+        )
+        return False
+    resolved = (builds or dict()).get(m["component"], dict())
+    start = time.monotonic()
+    job = run_pipeline(
+        m["component"],
+        ns=m["namespace"],
+        nvr=resolved.get("nvr"),
+        scmurl=resolved.get("scmurl"),
+    )
+    record_duration(m["namespace"], m["component"], time.monotonic() - start)
+    logger.info("Done processing %s.", rec)
+    return job
 
 
 def process_components(compset):
     """Processes the supplied set of components.  If the set is empty,
     fetch all latest components from the trigger tags.
 
+    Components are processed by a pool of `job_slots()` workers, the most
+    important and cheapest first, see schedule_key().  With the pipeline
+    enabled, see stages(), their stages overlap and the build stage checks
+    the components it has queued for existing builds in bulk.
+
     :param compset: A set of components to process in the `ns/comp` form
     :returns: None
     """
     if "main" not in c:
         logger.critical("DistroBaker is not configured, aborting.")
         return None
+    tagged = None
     if not compset:
         logger.debug(
             "No components selected, gathering components from triggers."
         )
-        compset.update(
-            "{}/{}".format("rpms", x["package_name"])
-            for x in get_buildsys("source").listTagged(
-                c["main"]["trigger"]["rpms"], latest=True
+        with buildsys("source") as bsys:
+            tagged = bsys.listTagged(c["main"]["trigger"]["rpms"], latest=True)
+            compset.update(
+                "{}/{}".format("rpms", x["package_name"]) for x in tagged
             )
-        )
-        compset.update(
-            "{}/{}:{}".format("modules", x["package_name"], x["version"])
-            for x in get_buildsys("source").listTagged(
-                c["main"]["trigger"]["modules"], latest=True
+            compset.update(
+                "{}/{}:{}".format("modules", x["package_name"], x["version"])
+                for x in bsys.listTagged(
+                    c["main"]["trigger"]["modules"], latest=True
+                )
             )
+    builds = resolve_builds(
+        {
+            x.split("/", 1)[1]
+            for x in compset
+            if x.startswith("rpms/") and cre.match(x)
+        },
+        tagged=tagged,
+    )
+    slots = job_slots()
+    if slots > workers:
+        logger.info(
+            "Raising the number of jobs from %d to %d to keep all pipeline "
+            "stages busy.",
+            workers,
+            slots,
         )
-    logger.info("Processing %d component(s).", len(compset))
-    processed = 0
-    for rec in sorted(compset, key=str.lower):
+    logger.info(
+        "Processing %d component(s) with %d job(s).", len(compset), slots
+    )
+
+    def order(rec):
         m = cre.match(rec)
         if m is None:
-            logger.error("Cannot process %s; looks like garbage.", rec)
-            continue
-        m = m.groupdict()
-        logger.info("Processing %s.", rec)
-        if m["namespace"] == "modules":
-            logger.warning(
-                "The modules/%s component is a module; modules currently not implemented, skipping.",
-                m["component"],
-            )
-            continue
-        if m["component"] in c["main"]["control"]["exclude"][m["namespace"]]:
-            logger.info(
-                "The %s/%s component is excluded from sync, skipping.",
-                m["namespace"],
-                m["component"],
-            )
-            continue
-        if (
-            c["main"]["control"]["strict"]
-            and m["component"] not in c["comps"][m["namespace"]]
-        ):
-            logger.info(
-                "The %s/%s component not configured while the strict mode is enabled, ignoring.",
-                m["namespace"],
-                m["component"],
-            )
-            continue
-        ref = sync_repo(comp=m["component"], ns=m["namespace"])
-        if ref is not None:
-            build_comp(comp=m["component"], ref=ref, ns=m["namespace"])
-        logger.info("Done processing %s.", rec)
-        processed += 1
+            return ((0, 0.0, rec.lower()), rec.lower())
+        return (schedule_key(m["namespace"], m["component"]), rec.lower())
+
+    compset = sorted(compset, key=order)
+    started = time.time()
+    results = dict()
+    if slots > 1:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=slots, thread_name_prefix="distrobaker"
+        ) as executor:
+            futures = {
+                executor.submit(process_component, rec, builds): rec
+                for rec in compset
+            }
+            for future in concurrent.futures.as_completed(futures):
+                rec = futures[future]
+                try:
+                    results[rec] = future.result()
+                except Exception:
+                    logger.exception("Unexpected error processing %s.", rec)
+                    results[rec] = False
+    else:
+        for rec in compset:
+            results[rec] = process_component(rec, builds)
+    processed = sum(1 for x in results.values() if x)
     logger.info(
         "Synchronized %d component(s), %d skipped.",
         processed,
         len(compset) - processed,
     )
+    logger.info(
+        "Build summary: %s", json.dumps(build_summary(since=started))
+    )
+    logger.info("Metrics summary: %s", json.dumps(metrics_summary()))
     return None
 
 
+def resolve_builds(comps, tagged=None):
+    """Resolves the latest builds and their SCMURLs for a set of rpms
+    components in bulk.  Uses a single listing of the rpms trigger tag and
+    batched multicalls for the SCMURL lookups instead of two build system
+    calls per component.
+
+    Components that cannot be resolved are omitted; sync_repo() looks
+    them up individually.
+
+    :param comps: A set of rpms component names
+    :param tagged: The latest builds in the trigger tag, if already known, optional
+    :returns: A dictionary mapping component names to dictionaries with `nvr` and `scmurl` keys
+    """
+    builds = dict()
+    if not comps:
+        return builds
+    with buildsys("source") as bsys:
+        if bsys is None:
+            logger.error("Build system unavailable, cannot resolve builds.")
+            return builds
+        try:
+            if tagged is None:
+                tagged = bsys.listTagged(
+                    c["main"]["trigger"]["rpms"], latest=True
+                )
+            nvrs = {
+                x["package_name"]: x["nvr"]
+                for x in tagged
+                if x["package_name"] in comps
+            }
+            calls = dict()
+            with bsys.multicall(batch=1000) as mc:
+                for comp, nvr in nvrs.items():
+                    calls[comp] = mc.getBuild(nvr)
+        except Exception:
+            logger.exception(
+                "An error occurred while resolving builds in bulk."
+            )
+            return builds
+    for comp, call in calls.items():
+        try:
+            scmurl = call.result["source"]
+        except Exception:
+            logger.debug(
+                "Cannot find the SCMURL of %s in bulk.", nvrs[comp], exc_info=True
+            )
+            continue
+        builds[comp] = {"nvr": nvrs[comp], "scmurl": scmurl}
+    logger.debug(
+        "Resolved %d of %d build(s) in bulk.", len(builds), len(comps)
+    )
+    return builds
+
+
 def get_scmurl(nvr):
     """Get SCMURL for a source build system build NVR.  NVRs are unique.
 
@@ -1216,19 +4567,20 @@ def get_scmurl(nvr):
     if "main" not in c:
         logger.critical("DistroBaker is not configured, aborting.")
         return None
-    bsys = get_buildsys("source")
-    if bsys is None:
-        logger.error(
-            "Build system unavailable, cannot retrieve the SCMURL of %s.", nvr
-        )
-        return None
-    try:
-        bsrc = bsys.getBuild(nvr)
-    except Exception:
-        logger.exception(
-            "An error occured while retrieving the SCMURL for %s.", nvr
-        )
-        return None
+    with buildsys("source") as bsys:
+        if bsys is None:
+            logger.error(
+                "Build system unavailable, cannot retrieve the SCMURL of %s.",
+                nvr,
+            )
+            return None
+        try:
+            bsrc = bsys.getBuild(nvr)
+        except Exception:
+            logger.exception(
+                "An error occurred while retrieving the SCMURL for %s.", nvr
+            )
+            return None
     if "source" in bsrc:
         bsrc = bsrc["source"]
         logger.debug("Retrieved SCMURL for %s: %s", nvr, bsrc)
@@ -1250,26 +4602,26 @@ def get_build(comp, ns="rpms"):
     if "main" not in c:
         logger.critical("DistroBaker is not configured, aborting.")
         return None
-    bsys = get_buildsys("source")
-    if bsys is None:
-        logger.error(
-            "Build system unavailable, cannot find the latest build for %s/%s.",
-            ns,
-            comp,
-        )
-        return None
     if ns == "rpms":
-        try:
-            nvr = bsys.listTagged(
-                c["main"]["trigger"][ns], package=comp, latest=True
-            )
-        except Exception:
-            logger.exception(
-                "An error occured while getting the latest build for %s/%s.",
-                ns,
-                comp,
-            )
-            return None
+        with buildsys("source") as bsys:
+            if bsys is None:
+                logger.error(
+                    "Build system unavailable, cannot find the latest build for %s/%s.",
+                    ns,
+                    comp,
+                )
+                return None
+            try:
+                nvr = bsys.listTagged(
+                    c["main"]["trigger"][ns], package=comp, latest=True
+                )
+            except Exception:
+                logger.exception(
+                    "An error occurred while getting the latest build for %s/%s.",
+                    ns,
+                    comp,
+                )
+                return None
         if nvr:
             logger.debug(
                 "Located the latest build for %s/%s: %s",
@@ -1291,72 +4643,277 @@ def get_build(comp, ns="rpms"):
     return None
 
 
-def get_buildsys(which):
-    """Get a koji build system session for either the source or the
-    destination.  Caches the sessions so future calls are cheap.
-    Destination sessions are authenticated, source sessions are not.
+def new_buildsys(which):
+    """Creates a new koji build system session for either the source or
+    the destination.  Destination sessions are authenticated, source
+    sessions are not.
 
-    :param which: Session to select, source or destination
+    :param which: Session to create, source or destination
     :returns: Koji session object, or None on error
     """
-    if "main" not in c:
-        logger.critical("DistroBaker is not configured, aborting.")
-        return None
-    if which not in ("source", "destination"):
-        logger.error('Cannot get "%s" build system.', which)
-        return None
-
-    session_timed_out = False
-    if hasattr(get_buildsys, which):
-        session_age = datetime.datetime.now() - getattr(
-            get_buildsys, which + "_session_start_time"
-        )
-        # slightly less than an hour, to be safe
-        if session_age.seconds > 3550 or session_age.days > 0:
-            session_timed_out = True
-
-    if session_timed_out or not hasattr(get_buildsys, which):
-        logger.debug(
-            'Initializing the %s koji instance with the "%s" profile.',
+    logger.debug(
+        'Initializing the %s koji instance with the "%s" profile.',
+        which,
+        c["main"][which]["profile"],
+    )
+    try:
+        bsys = koji.read_config(profile_name=c["main"][which]["profile"])
+        bsys = koji.ClientSession(bsys["server"], opts=bsys)
+    except Exception:
+        logger.exception(
+            'Failed initializing the %s koji instance with the "%s" profile, skipping.',
             which,
             c["main"][which]["profile"],
         )
+        return None
+    logger.debug("The %s koji instance initialized.", which)
+    if which == "destination":
+        logger.debug("Authenticating with the destination koji instance.")
         try:
-            bsys = koji.read_config(profile_name=c["main"][which]["profile"])
-            bsys = koji.ClientSession(bsys["server"], opts=bsys)
+            bsys.gssapi_login()
         except Exception:
             logger.exception(
-                'Failed initializing the %s koji instance with the "%s" profile, skipping.',
-                which,
-                c["main"][which]["profile"],
+                "Failed authenticating against the destination koji instance, skipping."
             )
             return None
-        logger.debug("The %s koji instance initialized.", which)
+        logger.debug(
+            "Successfully authenticated with the destination koji instance."
+        )
+    return bsys
+
+
+def check_buildsys(which, bsys):
+    """Checks whether a build system session is usable.  Destination
+    sessions must also still be authenticated.
+
+    :param which: The session side, source or destination
+    :param bsys: The koji session object
+    :returns: True if the session is healthy, False otherwise
+    """
+    try:
         if which == "destination":
-            logger.debug("Authenticating with the destination koji instance.")
+            return bool(bsys.getLoggedInUser())
+        bsys.getAPIVersion()
+    except Exception:
+        logger.debug(
+            "The %s koji session failed the health check.",
+            which,
+            exc_info=True,
+        )
+        return False
+    return True
+
+
+class SessionPool:
+    """A pool of koji build system sessions for one side.  Koji sessions
+    cannot be safely shared between concurrent callers, so each caller
+    leases a session for itself, see lease().  Sessions are created on
+    demand up to `koji_sessions()` and renewed in the background, see
+    renew(), before they expire.
+    """
+
+    def __init__(self, which, size):
+        self.which = which
+        self.size = size
+        self.idle = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a session from the pool, creating a new one if none is
+        idle and the pool is not full, or waiting for one otherwise.
+
+        :returns: A `(session, start time)` pair, or None on error
+        """
+        while True:
+            try:
+                entry = self.idle.get_nowait()
+                break
+            except queue.Empty:
+                pass
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                entry = self.create()
+                if entry is None:
+                    with self.lock:
+                        self.created -= 1
+                    return None
+                break
+            # sessions dropped by renew() free up room, so check again
+            # every so often rather than waiting for a release forever
             try:
-                if session_timed_out:
-                    bsys.logout()
-                bsys.gssapi_login()
+                entry = self.idle.get(timeout=1)
+                break
+            except queue.Empty:
+                continue
+        if time.monotonic() - entry[1] > session_lifetime:
+            # only if the background renewal did not keep up
+            logger.debug("Renewing an expired %s koji session.", self.which)
+            entry = self.replace(entry)
+            if entry is None:
+                with self.lock:
+                    self.created -= 1
+        return entry
+
+    def release(self, entry):
+        """Returns a session to the pool.
+
+        :param entry: A `(session, start time)` pair from acquire()
+        :returns: None
+        """
+        self.idle.put(entry)
+        return None
+
+    @contextlib.contextmanager
+    def lease(self):
+        """Leases a session from the pool for the duration of the context.
+
+        :returns: A context manager yielding the koji session, or None on error
+        """
+        entry = self.acquire()
+        try:
+            yield entry[0] if entry is not None else None
+        finally:
+            if entry is not None:
+                self.release(entry)
+
+    def create(self):
+        """Creates a new session for the pool.
+
+        :returns: A `(session, start time)` pair, or None on error
+        """
+        bsys = new_buildsys(self.which)
+        if bsys is None:
+            return None
+        return (bsys, time.monotonic())
+
+    def replace(self, entry):
+        """Replaces a session with a new one, logging the old one out.
+
+        :param entry: The `(session, start time)` pair to replace
+        :returns: The new `(session, start time)` pair, or None on error
+        """
+        new = self.create()
+        if new is not None and self.which == "destination":
+            try:
+                entry[0].logout()
+            except Exception:
+                logger.debug(
+                    "Failed logging out of an old destination koji session.",
+                    exc_info=True,
+                )
+        return new
+
+    def renew(self):
+        """Health checks the idle sessions, replacing broken sessions and
+        those close to their expiry.  Called periodically by the renewal
+        thread, so that callers do not wait for logins.
+
+        :returns: None
+        """
+        for _ in range(self.idle.qsize()):
+            try:
+                entry = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            age = time.monotonic() - entry[1]
+            if age > session_lifetime - session_renewal or not check_buildsys(
+                self.which, entry[0]
+            ):
+                logger.debug("Renewing a %s koji session.", self.which)
+                new = self.replace(entry)
+                if new is not None:
+                    entry = new
+                elif age > session_lifetime:
+                    with self.lock:
+                        self.created -= 1
+                    continue
+            self.idle.put(entry)
+        return None
+
+
+def renew_buildsys():
+    """Renews the build system sessions forever.  Started with the first
+    session pool by `get_buildsys_pool()`.
+
+    :returns: None
+    """
+    while True:
+        time.sleep(session_check)
+        for pool in list(pools.values()):
+            try:
+                pool.renew()
             except Exception:
                 logger.exception(
-                    "Failed authenticating against the destination koji instance, skipping."
+                    "Unexpected error renewing the %s koji sessions.",
+                    pool.which,
                 )
-                return None
-            logger.debug(
-                "Successfully authenticated with the destination koji instance."
-            )
-        if which == "source":
-            get_buildsys.source = bsys
-            get_buildsys.source_session_start_time = datetime.datetime.now()
-        else:
-            get_buildsys.destination = bsys
-            get_buildsys.destination_session_start_time = (
-                datetime.datetime.now()
-            )
-    else:
-        logger.debug(
-            "The %s koji instance is already initialized, fetching from cache.",
-            which,
-        )
-    return vars(get_buildsys)[which]
+
+
+def get_buildsys_pool(which):
+    """Get the koji build system session pool for either the source or
+    the destination, creating it and its first session on the first call.
+    Sessions are leased from the pool, see buildsys().
+
+    :param which: Session pool to select, source or destination
+    :returns: SessionPool object, or None on error
+    """
+    if "main" not in c:
+        logger.critical("DistroBaker is not configured, aborting.")
+        return None
+    if which not in ("source", "destination"):
+        logger.error('Cannot get "%s" build system.', which)
+        return None
+    with pools_lock:
+        if which in pools:
+            return pools[which]
+        pool = SessionPool(which, pool_size)
+        entry = pool.acquire()
+        if entry is None:
+            return None
+        pool.release(entry)
+        if not pools:
+            threading.Thread(
+                target=renew_buildsys, name="distrobaker-koji", daemon=True
+            ).start()
+        pools[which] = pool
+    return pool
+
+
+def get_buildsys(which):
+    """Get a koji build system session for either the source or the
+    destination from its pool, see get_buildsys_pool(), so it is health
+    checked and renewed like the leased ones.  The session is returned to
+    the pool right away and may be handed to other callers as well;
+    concurrent callers should lease their own with buildsys() instead.
+
+    :param which: Session to select, source or destination
+    :returns: Koji session object, or None on error
+    """
+    pool = get_buildsys_pool(which)
+    if pool is None:
+        return None
+    entry = pool.acquire()
+    if entry is None:
+        return None
+    pool.release(entry)
+    return entry[0]
+
+
+@contextlib.contextmanager
+def buildsys(which):
+    """Leases a koji build system session for either the source or the
+    destination from its pool for the duration of the context.
+
+    :param which: Session to select, source or destination
+    :returns: A context manager yielding the koji session, or None on error
+    """
+    pool = get_buildsys_pool(which)
+    if pool is None:
+        yield None
+        return
+    with pool.lease() as bsys:
+        yield bsys
@@ -81,3 +81,102 @@ def last_commit(repodir):
     )
     out, err = proc.communicate()
     return out.rstrip()
+
+
+def setup_sync_repos(root, comp, branch="fluff-42.0.0-alpha"):
+    """Creates the source and destination repositories of a component
+    under root/src and root/dst, as configured by distrobaker.yaml with
+    the file:// SCMs pointing there
+
+    :param root: Directory to create the repositories in
+    :param comp: The component name
+    :param branch: The destination branch
+    :returns: The source head commit hash
+    """
+    src = os.path.join(root, "src", "rpms", comp + ".git")
+    dst = os.path.join(root, "dst", "rpms", comp + ".git")
+    work = os.path.join(root, "work-" + comp)
+    ident = ["-c", "user.name=John Doe", "-c", "user.email=jdoe@example.com"]
+    cmds = [
+        ["git", "init", "-q", "--bare", src],
+        ["git", "-C", src, "config", "uploadpack.allowfilter", "true"],
+        ["git", "init", "-q", "--bare", dst],
+        ["git", "-C", dst, "config", "uploadpack.allowfilter", "true"],
+        ["git", "clone", "-q", dst, work],
+        ["bash", "-c", "echo downstream > {}/README".format(work)],
+        ["git", "-C", work, "add", "."],
+        ["git", *ident, "-C", work, "commit", "-q", "-m", "Downstream"],
+        ["git", "-C", work, "push", "-q", "origin", "HEAD:" + branch],
+        ["git", "-C", work, "checkout", "-q", "--orphan", "rawhide"],
+        ["bash", "-c", "echo upstream > {}/README".format(work)],
+        ["git", "-C", work, "add", "."],
+        ["git", *ident, "-C", work, "commit", "-q", "-m", "Upstream"],
+        ["git", "-C", work, "push", "-q", src, "rawhide"],
+    ]
+    for cmd in cmds:
+        subprocess.run(cmd, check=True, capture_output=True)
+    return subprocess.run(
+        ["git", "-C", src, "rev-parse", "rawhide"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+def setup_sync_config(root):
+    """Loads the test configuration pointing the source and destination
+    SCMs to the repositories created by setup_sync_repos()
+
+    :param root: Directory holding the repositories
+    :returns: The loaded configuration
+    """
+    import distrobaker
+
+    crepo = os.path.join(root, "config")
+    setup_test_repo(crepo, os.path.join(DATA_DIR, "config", "distrobaker.yaml"))
+    cfg = distrobaker.load_config(crepo + "#main")
+    cfg["main"]["source"]["scm"] = "file://" + os.path.join(root, "src")
+    cfg["main"]["destination"]["scm"] = "file://" + os.path.join(root, "dst")
+    return cfg
+
+
+def add_source_commit(root, comp, text):
+    """Commits and pushes a change to the source repository of
+    a component created by setup_sync_repos()
+
+    :param root: Directory holding the repositories
+    :param comp: The component name
+    :param text: The new README contents
+    :returns: The new source head commit hash
+    """
+    src = os.path.join(root, "src", "rpms", comp + ".git")
+    work = os.path.join(root, "work-" + comp)
+    with open(os.path.join(work, "README"), "w") as f:
+        f.write(text)
+    ident = ["-c", "user.name=John Doe", "-c", "user.email=jdoe@example.com"]
+    for cmd in (
+        ["git", "-C", work, "add", "."],
+        ["git", *ident, "-C", work, "commit", "-q", "-m", text],
+        ["git", "-C", work, "push", "-q", src, "rawhide"],
+    ):
+        subprocess.run(cmd, check=True, capture_output=True)
+    return subprocess.run(
+        ["git", "-C", src, "rev-parse", "rawhide"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+def patch_buildsys(bsys):
+    """Patches distrobaker.buildsys() to lease the given fake koji session
+
+    :param bsys: The fake koji session
+    :returns: The patcher, usable as a context manager
+    """
+    import distrobaker
+    from unittest import mock
+
+    lease = mock.MagicMock()
+    lease.return_value.__enter__.return_value = bsys
+    return mock.patch.object(distrobaker, "buildsys", lease)
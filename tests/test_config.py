@@ -8,6 +8,7 @@ import sys
 import tempfile
 
 from parameterized import parameterized
+from unittest import mock
 
 try:
     import unittest2 as unittest
@@ -50,6 +51,13 @@ class TestConfigSetting(unittest.TestCase):
                 "cache": {"source": "freeipa", "destination": "ipa"},
             },
         )
+        self.assertEqual(cfg["main"]["control"]["clone"], "full")
+        self.assertEqual(cfg["main"]["control"]["depth"], 1)
+        self.assertEqual(cfg["main"]["limits"], {})
+        self.assertEqual(
+            cfg["main"]["control"]["priority"], {"rpms": {}, "modules": {}}
+        )
+        self.assertEqual(cfg["main"]["control"]["aging"], 600)
         self.assertEqual(
             cfg["comps"]["modules"]["testmodule:master"],
             {
@@ -58,6 +66,61 @@ class TestConfigSetting(unittest.TestCase):
                 "cache": {"source": "testmodule", "destination": "testmodule"},
             },
         )
+        # unconfigured components resolve to the defaults
+        self.assertNotIn("bash", cfg["comps"]["rpms"])
+        self.assertEqual(
+            cfg["comps"]["rpms"].resolve("bash"),
+            {
+                "source": "bash.git",
+                "destination": "bash.git#fluff-42.0.0-alpha",
+                "cache": {"source": "bash", "destination": "bash"},
+            },
+        )
+        self.assertEqual(
+            cfg["comps"]["modules"].resolve("perl:5.32")["destination"],
+            "perl.git#5.32-fluff-42.0.0-alpha",
+        )
+
+    def test_reload_config(self):
+        with tempfile.TemporaryDirectory() as td, mock.patch.dict(
+            distrobaker.c, clear=True
+        ):
+            helpers.setup_test_repo(
+                td,
+                os.path.join(helpers.DATA_DIR, "config", "distrobaker.yaml"),
+            )
+            cfg = distrobaker.load_config(td + "#main")
+            old = {x: cfg["comps"]["rpms"][x] for x in ("gzip", "ipa")}
+            work = os.path.join(td, "work")
+            helpers.run_cmds(
+                [
+                    ["git", "clone", "-b", "main", td, work],
+                    ["cd", work],
+                    ["git", "config", "user.name", "John Doe"],
+                    ["git", "config", "user.email", "jdoe@example.com"],
+                    [
+                        "sed",
+                        "-i",
+                        "s/gzip.git#fluff-42.0.0-alpha-experimental/gzip.git#fluff-43/",
+                        "distrobaker.yaml",
+                    ],
+                    ["git", "commit", "-a", "-m", "Change gzip"],
+                    ["git", "push", "origin", "main"],
+                ]
+            )
+            with mock.patch.object(
+                distrobaker,
+                "expand_component",
+                wraps=distrobaker.expand_component,
+            ) as expand:
+                cfg = distrobaker.load_config(td + "#main")
+                new = {x: cfg["comps"]["rpms"][x] for x in ("gzip", "ipa")}
+        # only the changed component is resolved again
+        self.assertEqual(
+            [x.args[2] for x in expand.call_args_list], ["gzip"]
+        )
+        self.assertEqual(new["gzip"]["destination"], "gzip.git#fluff-43")
+        self.assertIs(new["ipa"], old["ipa"])
 
     # test for failure when loading config files that are missing required sections
     # (this is just a randomly selected few of many possibilities)
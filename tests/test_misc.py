@@ -1,7 +1,13 @@
 # SPDX-License-Identifier: MIT
 
 import distrobaker
+import helpers
 import logging
+import os
+import tempfile
+import threading
+
+from unittest import mock
 
 try:
     import unittest2 as unittest
@@ -31,8 +37,69 @@ class TestMiscSettings(unittest.TestCase):
         self.assertEqual(distrobaker.pretend(False), False)
         self.assertEqual(distrobaker.pretend(), False)
 
+    def test_jobs(self):
+        self.assertIsNotNone(distrobaker.jobs())
+        self.assertEqual(distrobaker.jobs(4), 4)
+        self.assertEqual(distrobaker.jobs(), 4)
+        # at least one job is always used
+        self.assertEqual(distrobaker.jobs(0), 1)
+        self.assertEqual(distrobaker.jobs(1), 1)
+        self.assertEqual(distrobaker.jobs(), 1)
+
+    def test_cache_jobs(self):
+        self.assertEqual(distrobaker.cache_jobs(), 1)
+        self.assertEqual(distrobaker.cache_jobs(8), 8)
+        self.assertEqual(distrobaker.cache_jobs(0), 1)
+        self.assertIsNone(distrobaker.cache_jobs_total())
+        self.assertEqual(distrobaker.cache_jobs_total(16), 16)
+        self.assertEqual(distrobaker.cache_jobs_total(), 16)
+        self.assertIsNone(distrobaker.cache_jobs_total(0))
+
+    def test_stream(self):
+        self.assertTrue(distrobaker.stream())
+        self.assertEqual(distrobaker.stream(False), False)
+        self.assertEqual(distrobaker.stream(), False)
+        self.assertEqual(distrobaker.stream(True), True)
+
+    def test_state(self):
+        self.assertIsNone(distrobaker.state())
+        self.assertIsNone(distrobaker.state_query("SELECT 1"))
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, "state.db")
+            self.assertEqual(distrobaker.state(path), path)
+            self.assertEqual(distrobaker.state_query("SELECT 1"), [(1,)])
+            self.assertTrue(os.path.isfile(path))
+            self.assertIsNone(distrobaker.state(""))
+
+    def test_coalesce(self):
+        self.assertEqual(distrobaker.coalesce(), 0)
+        self.assertEqual(distrobaker.coalesce(30), 30)
+        self.assertEqual(distrobaker.coalesce(-1), 0)
+        self.assertEqual(distrobaker.coalesce(), 0)
+
+    def test_mirror(self):
+        self.assertIsNone(distrobaker.mirror())
+        self.assertEqual(distrobaker.mirror("/tmp/mirrors"), "/tmp/mirrors")
+        self.assertEqual(distrobaker.mirror(), "/tmp/mirrors")
+        self.assertIsNone(distrobaker.mirror(""))
+        self.assertIsNone(distrobaker.mirror_size())
+        self.assertEqual(distrobaker.mirror_size(1024), 1024)
+        self.assertIsNone(distrobaker.mirror_size(0))
+
 
 class TestMiscParsing(unittest.TestCase):
+    def setUp(self):
+        for patcher in (
+            mock.patch.dict(distrobaker.breakers, clear=True),
+            mock.patch.dict(distrobaker.limiters, clear=True),
+            mock.patch.object(distrobaker, "limits", dict()),
+            mock.patch.object(
+                distrobaker, "backoff_base", distrobaker.backoff_base
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     def test_split_scmurl(self):
         self.assertDictEqual(
             distrobaker.split_scmurl(""),
@@ -97,3 +164,440 @@ class TestMiscParsing(unittest.TestCase):
             distrobaker.split_module("name:stream:version:context"),
             {"name": "name", "stream": "stream"},
         )
+
+    def test_compare_nvrs(self):
+        for a, b, result in (
+            ("1.0", "1.0", 0),
+            ("1.10", "1.9", 1),
+            ("1.0", "1.0.1", -1),
+            ("1.0a", "1.0", 1),
+            ("1.0", "1a", 1),
+            ("01", "1", 0),
+            ("1.0~rc1", "1.0", -1),
+            ("1.0^git1", "1.0", 1),
+            ("1.0^git1", "1.0.1", -1),
+        ):
+            with self.subTest(a=a, b=b):
+                self.assertEqual(distrobaker.vercmp(a, b), result)
+                self.assertEqual(distrobaker.vercmp(b, a), -result)
+        with mock.patch.object(distrobaker, "rpm", None):
+            self.assertEqual(
+                distrobaker.compare_nvrs("foo-1.10-1.fc34", "foo-1.9-2.fc34"), 1
+            )
+            self.assertEqual(
+                distrobaker.compare_nvrs("foo-1.0-2.fc34", "foo-1.0-10.fc34"),
+                -1,
+            )
+            self.assertEqual(distrobaker.compare_nvrs("foo", "bar"), 0)
+
+    def test_metrics(self):
+        with distrobaker.timed("test"):
+            pass
+        distrobaker.count("bytes", "test", 42)
+        summary = distrobaker.metrics_summary()
+        self.assertEqual(summary["phases"]["test"]["count"], 1)
+        self.assertEqual(summary["counters"]["bytes"]["test"], 42)
+        text = distrobaker.metrics_text()
+        self.assertIn('distrobaker_phase_seconds_count{phase="test"} 1', text)
+        self.assertIn('distrobaker_bytes_total{phase="test"} 42', text)
+        self.assertIn("distrobaker_queue_depth 0", text)
+
+    def test_with_retry(self):
+        self.assertEqual(distrobaker.backoff(0), 0)
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise IOError("transient")
+            return "ok"
+
+        self.assertEqual(
+            distrobaker.with_retry(flaky, "flaky.example.com", "Test", "test"),
+            "ok",
+        )
+        self.assertEqual(len(calls), 3)
+
+        def fatal():
+            calls.append(1)
+            raise ValueError("fatal")
+
+        calls.clear()
+        with self.assertRaises(ValueError):
+            distrobaker.with_retry(fatal, "fatal.example.com", "Test", "test")
+        self.assertEqual(len(calls), 1)
+
+        def broken():
+            raise IOError("down")
+
+        with mock.patch.object(distrobaker, "retry", 1):
+            for _ in range(distrobaker.breaker_threshold):
+                with self.assertRaises(IOError):
+                    distrobaker.with_retry(
+                        broken, "down.example.com", "Test", "test"
+                    )
+            with self.assertRaises(distrobaker.CircuitOpenError):
+                distrobaker.with_retry(
+                    broken, "down.example.com", "Test", "test"
+                )
+
+        # open circuits are waited out, then attempted again
+        slept = list()
+
+        def sleep(delay):
+            slept.append(delay)
+            distrobaker.breakers["down.example.com"]["opened"] -= delay
+
+        with mock.patch.object(distrobaker.time, "sleep", sleep):
+            self.assertEqual(
+                distrobaker.with_retry(
+                    lambda: "ok", "down.example.com", "Test", "test"
+                ),
+                "ok",
+            )
+        self.assertEqual(len(slept), 1)
+        self.assertGreater(slept[0], distrobaker.breaker_cooldown - 5)
+        self.assertNotIn("down.example.com", distrobaker.breakers)
+
+        # failures count against the endpoint they are blamed on
+        def source():
+            raise distrobaker.blame(IOError("down"), "src.example.com")
+
+        with self.assertRaises(IOError), mock.patch.object(
+            distrobaker, "retry", 1
+        ):
+            distrobaker.with_retry(
+                source,
+                "dst.example.com",
+                "Test",
+                "test",
+                also=("src.example.com",),
+            )
+        self.assertEqual(
+            distrobaker.breakers["src.example.com"]["failures"], 1
+        )
+        self.assertNotIn("dst.example.com", distrobaker.breakers)
+        self.assertEqual(distrobaker.backoff(1), 1)
+
+    def test_get_endpoint(self):
+        self.assertEqual(
+            distrobaker.get_endpoint("https://src.fedoraproject.org/rpms/a"),
+            "src.fedoraproject.org",
+        )
+        self.assertEqual(
+            distrobaker.get_endpoint("git@pkgs.example.com:rpms/a"),
+            "pkgs.example.com",
+        )
+        self.assertEqual(distrobaker.get_endpoint("/srv/git/a"), "local")
+
+    def test_limits(self):
+        distrobaker.configure_limits(
+            {
+                "default": {"connections": 2, "rate": 0, "burst": 1},
+                "example.com": {"connections": 0, "rate": 100, "burst": 1},
+            }
+        )
+        limiter = distrobaker.get_limiter("other.example.com")
+        self.assertIs(limiter, distrobaker.get_limiter("other.example.com"))
+        with distrobaker.throttle("other.example.com", "example.com"):
+            with distrobaker.throttle("other.example.com"):
+                self.assertFalse(limiter.slots.acquire(blocking=False))
+        self.assertTrue(limiter.slots.acquire(blocking=False))
+        limiter.slots.release()
+        distrobaker.configure_limits({})
+        self.assertIsNone(distrobaker.get_limiter("other.example.com"))
+
+    def test_git_backend(self):
+        default = distrobaker.git_backend()
+        self.assertIn(default, distrobaker.git_backends)
+        self.assertEqual(distrobaker.git_backend("git"), "git")
+        self.assertEqual(distrobaker.git_backend(), "git")
+        with self.assertRaises(ValueError):
+            distrobaker.git_backend("svn")
+        self.assertEqual(distrobaker.git_backend(default), default)
+
+    def test_clean_message(self):
+        self.assertEqual(
+            distrobaker.clean_message("\nSubject  \n\n\nBody\t\n\n"),
+            "Subject\n\nBody\n",
+        )
+        self.assertEqual(distrobaker.clean_message("\n \n"), "")
+
+    def test_parse_sources(self):
+        md5 = "0123456789abcdef0123456789abcdef"
+        sha = "ab" * 64
+        src = distrobaker.parse_sources(
+            "comp",
+            "rpms",
+            "SHA512 (a (1).tar.gz) = {}\n{}  b.tar.gz\n".format(sha, md5),
+        )
+        self.assertEqual(
+            src,
+            {("a (1).tar.gz", sha): "sha512", ("b.tar.gz", md5): "md5"},
+        )
+        self.assertEqual(distrobaker.parse_sources("comp", "rpms", ""), {})
+        self.assertIsNone(
+            distrobaker.parse_sources("comp", "rpms", "garbage\n")
+        )
+        self.assertEqual(
+            distrobaker.diff_sources(
+                {("b.tar.gz", md5): "md5"},
+                src,
+            ),
+            {"sha512": [("a (1).tar.gz", sha, "sha512")]},
+        )
+
+    def test_schedule_key(self):
+        main = {"control": {"priority": {"rpms": {"glibc": 10}}, "aging": 60}}
+        with mock.patch.dict(distrobaker.c, {"main": main}):
+            self.assertEqual(distrobaker.get_priority("rpms", "glibc"), 10)
+            self.assertEqual(distrobaker.get_priority("rpms", "bash"), 0)
+            self.assertEqual(distrobaker.record_duration("rpms", "a", 10), 10)
+            self.assertEqual(distrobaker.record_duration("rpms", "a", 20), 15)
+            distrobaker.record_duration("rpms", "b", 5)
+            self.assertEqual(distrobaker.get_cost("rpms", "c"), 10)
+            order = sorted(
+                ["a", "b", "glibc"],
+                key=lambda x: distrobaker.schedule_key("rpms", x),
+            )
+            self.assertEqual(order, ["glibc", "b", "a"])
+            # eleven minutes of waiting beat ten priority classes
+            self.assertLess(
+                distrobaker.schedule_key("rpms", "a", 660),
+                distrobaker.schedule_key("rpms", "glibc"),
+            )
+        distrobaker.durations.clear()
+
+    def test_check_cache(self):
+        files = {name: (name, "0" * 32, "md5") for name in "abc"}
+        curl = mock.Mock()
+        replies = {"a": b"Available", "b": b"Missing"}
+
+        def setopt(opt, val):
+            if opt == distrobaker.pycurl.HTTPPOST:
+                curl.filename = dict(val)["filename"]
+            elif opt == distrobaker.pycurl.WRITEDATA:
+                curl.output = val
+
+        def perform():
+            if curl.filename not in replies:
+                raise distrobaker.pycurl.error("down")
+            curl.output.write(replies[curl.filename])
+
+        curl.setopt.side_effect = setopt
+        curl.perform.side_effect = perform
+        curl.getinfo.return_value = 200
+        with mock.patch.dict(
+            distrobaker.c,
+            {"main": {"destination": {"cache": {"cgi": "https://x/cgi"}}}},
+        ), mock.patch.object(
+            distrobaker.sessions, "lookaside", curl, create=True
+        ), mock.patch.object(
+            distrobaker, "cache_present", set()
+        ):
+            present, unchecked = distrobaker.check_cache(
+                "comp", "rpms", "comp", files.values()
+            )
+        self.assertEqual(present, {files["a"]})
+        # failed checks are not mistaken for missing files
+        self.assertEqual(unchecked, {files["c"]})
+
+    def test_stages(self):
+        self.assertEqual(distrobaker.stages(), {})
+        self.assertEqual(
+            distrobaker.stages("git=2, cache=4"),
+            {"git": 2, "cache": 4, "push": 1, "build": 1},
+        )
+        self.assertEqual(distrobaker.stages({"push": 0})["push"], 1)
+        with self.assertRaises(ValueError):
+            distrobaker.stages("clone=2")
+        self.assertEqual(distrobaker.stages(""), {})
+
+    def test_session_pool(self):
+        made = list()
+
+        def fake(which):
+            made.append(mock.Mock())
+            made[-1].getAPIVersion.side_effect = (
+                Exception("down") if len(made) == 2 else None
+            )
+            return made[-1]
+
+        with mock.patch.object(distrobaker, "new_buildsys", fake):
+            pool = distrobaker.SessionPool("source", 2)
+            with pool.lease() as first:
+                with pool.lease() as second:
+                    self.assertIsNot(first, second)
+            self.assertEqual(len(made), 2)
+            # the failing session is replaced in the background
+            pool.renew()
+            self.assertEqual(len(made), 3)
+            self.assertEqual(pool.idle.qsize(), 2)
+            with pool.lease() as bsys:
+                self.assertIn(bsys, (made[0], made[2]))
+
+    def test_session_pool_dropped(self):
+        with mock.patch.object(
+            distrobaker, "new_buildsys", lambda which: mock.Mock()
+        ):
+            pool = distrobaker.SessionPool("source", 1)
+            entry = pool.acquire()
+            got = list()
+            waiter = threading.Thread(
+                target=lambda: got.append(pool.acquire()), daemon=True
+            )
+            waiter.start()
+            # the leased session expires and its replacement fails
+            with pool.lock:
+                pool.created -= 1
+            waiter.join(5)
+            self.assertFalse(waiter.is_alive())
+            self.assertIsNot(got[0], entry)
+            self.assertEqual(pool.created, 1)
+
+    def test_get_buildsys(self):
+        with mock.patch.object(
+            distrobaker, "new_buildsys", lambda which: mock.Mock()
+        ), mock.patch.dict(distrobaker.c, {"main": {}}), mock.patch.dict(
+            distrobaker.pools, clear=True
+        ), mock.patch.object(
+            distrobaker, "pool_size", 1
+        ):
+            bsys = distrobaker.get_buildsys("source")
+            # the session comes from the pool and goes back to it
+            with distrobaker.buildsys("source") as leased:
+                self.assertIs(leased, bsys)
+            self.assertIs(distrobaker.get_buildsys("source"), bsys)
+            self.assertIsNot(distrobaker.get_buildsys("destination"), bsys)
+
+    def test_poll_tasks(self):
+        states = {1: "CLOSED", 2: "FAILED", 3: "OPEN"}
+        bsys = mock.MagicMock()
+        mc = bsys.multicall.return_value.__enter__.return_value
+        mc.getTaskInfo.side_effect = lambda t: mock.Mock(
+            result={"state": distrobaker.koji.TASK_STATES[states[t]]}
+        )
+        with helpers.patch_buildsys(bsys), mock.patch.object(
+            distrobaker, "start_watcher"
+        ):
+            for task in states:
+                distrobaker.watch_task(task, "rpms", "comp{}".format(task))
+            self.assertEqual(distrobaker.poll_tasks(), 2)
+        self.assertEqual(mc.getTaskInfo.call_count, 3)
+        self.assertEqual(
+            distrobaker.build_summary(),
+            {
+                "closed": 1,
+                "failed": 1,
+                "canceled": 0,
+                "open": 1,
+                "failures": ["rpms/comp2"],
+            },
+        )
+        distrobaker.watched.clear()
+        distrobaker.outcomes.clear()
+
+    def test_resolve_builds(self):
+        bsys = mock.MagicMock()
+        bsys.listTagged.return_value = [
+            {"package_name": name, "nvr": "{}-1.0-1".format(name)}
+            for name in ("foo", "bar", "baz", "other")
+        ]
+        mc = bsys.multicall.return_value.__enter__.return_value
+
+        def get_build(nvr):
+            if nvr.startswith("baz"):
+                return mock.Mock(spec=[])
+            return mock.Mock(result={"source": "git+https://x/" + nvr})
+
+        mc.getBuild.side_effect = get_build
+        with helpers.patch_buildsys(bsys), mock.patch.dict(
+            distrobaker.c, {"main": {"trigger": {"rpms": "trigger"}}}
+        ):
+            builds = distrobaker.resolve_builds({"foo", "bar", "baz"})
+        # a single tag listing and multicall for all the components
+        bsys.listTagged.assert_called_once_with("trigger", latest=True)
+        self.assertEqual(bsys.multicall.call_count, 1)
+        self.assertEqual(mc.getBuild.call_count, 3)
+        bsys.getBuild.assert_not_called()
+        self.assertEqual(
+            builds,
+            {
+                name: {
+                    "nvr": "{}-1.0-1".format(name),
+                    "scmurl": "git+https://x/{}-1.0-1".format(name),
+                }
+                for name in ("foo", "bar")
+            },
+        )
+
+    def test_find_builds(self):
+        main = {"build": {"prefix": "git+https://dst", "scratch": False}}
+        comps = {"rpms": {}}
+        bsys = mock.MagicMock()
+        mc = bsys.multicall.return_value.__enter__.return_value
+        mc.listBuilds.side_effect = lambda source: mock.Mock(
+            result=[{"task_id": 7, "state": 1}] if "/done*" in source else []
+        )
+        mc.listTasks.return_value = mock.Mock(
+            result=[
+                {"id": 8, "state": 1, "request": ["git+https://dst/rpms/open#b"]}
+            ]
+        )
+        bsys.getLoggedInUser.return_value = {"id": 5}
+        with mock.patch.dict(
+            distrobaker.c, {"main": main, "comps": comps}
+        ), helpers.patch_buildsys(bsys), mock.patch.object(
+            distrobaker, "build_owner", None
+        ):
+            self.assertEqual(
+                distrobaker.find_builds({"done": "a", "open": "b", "new": "c"}),
+                {
+                    "done": {"task": 7, "state": "COMPLETE"},
+                    "open": {"task": 8, "state": "OPEN"},
+                },
+            )
+            # a batch of jobs is checked with a single lookup
+            jobs = [
+                {"ns": "rpms", "comp": x, "ref": x, "nvr": None}
+                for x in ("a", "b", "c")
+            ] + [{"ns": "rpms", "comp": "d", "ref": False, "nvr": None}]
+            distrobaker.find_job_builds(jobs)
+            for job in jobs[:3]:
+                self.assertIsNotNone(job["existing"])
+            self.assertNotIn("existing", jobs[3])
+        self.assertEqual(mc.listTasks.call_count, 2)
+        self.assertEqual(mc.listTasks.call_args.kwargs["opts"]["owner"], 5)
+        self.assertEqual(bsys.getLoggedInUser.call_count, 1)
+
+    def test_is_up_to_date(self):
+        actor = distrobaker.git.Actor("John Doe", "jdoe@example.com")
+        with tempfile.TemporaryDirectory() as td:
+            repo = distrobaker.git.Repo.init(td)
+
+            def commit(text, **kwargs):
+                with open(os.path.join(td, "README"), "w") as f:
+                    f.write(text)
+                repo.index.add(["README"])
+                return repo.index.commit(
+                    text, author=actor, committer=actor, **kwargs
+                )
+
+            def check(ref):
+                return distrobaker.is_up_to_date(
+                    "rpms", "a", repo, {"ref": ref.hexsha}, {"ref": "dest"}
+                )
+
+            first = commit("first")
+            repo.create_head("dest", first)
+            second = commit("second")
+            self.assertTrue(check(first))
+            self.assertFalse(check(second))
+            # the destination moved on, but contains the build commit
+            third = commit("third")
+            repo.heads.dest.commit = third
+            self.assertTrue(check(second))
+            # identical trees with unrelated history
+            repo.heads.dest.commit = commit("fourth", parent_commits=[])
+            self.assertFalse(check(third))
+            self.assertTrue(check(commit("fourth")))
@@ -0,0 +1,603 @@
+# SPDX-License-Identifier: MIT
+
+import distrobaker
+import email
+import git
+import hashlib
+import helpers
+import http.server
+import os
+import tempfile
+import threading
+import time
+
+from unittest import mock
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.root = tempdir.name
+        patcher = mock.patch.dict(distrobaker.c)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cfg = helpers.setup_sync_config(self.root)
+
+    def patch(self, **values):
+        for name, val in values.items():
+            patcher = mock.patch.object(distrobaker, name, val)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def scmurl(self, comp, ref):
+        return "file://{}/src/rpms/{}.git#{}".format(self.root, comp, ref)
+
+    def repo(self, side, comp):
+        return git.Repo(os.path.join(self.root, side, "rpms", comp + ".git"))
+
+    def scms(self, comp):
+        return (
+            distrobaker.split_scmurl(
+                "file://{}/dst/rpms/{}.git#fluff-42.0.0-alpha".format(
+                    self.root, comp
+                )
+            ),
+            distrobaker.split_scmurl(
+                "file://{}/src/rpms/{}.git".format(self.root, comp)
+            ),
+        )
+
+    def test_sync_repo_merge(self):
+        sha = helpers.setup_sync_repos(self.root, "foo")
+        dscm, sscm = self.scms("foo")
+        repo = git.Repo.clone_from(
+            dscm["link"], os.path.join(self.root, "work"), branch=dscm["ref"]
+        )
+        repo.git.fetch(sscm["link"], "rawhide")
+        parent = repo.head.commit.hexsha
+        branch = "refs/heads/{}".format(dscm["ref"])
+        backends = ("git", "pygit2") if distrobaker.pygit2 else ("git",)
+        for backend in backends:
+            with self.subTest(backend=backend), mock.patch.object(
+                distrobaker, "backend", backend
+            ):
+                repo.git.update_ref(branch, parent)
+                self.assertIs(
+                    distrobaker.sync_repo_merge(
+                        "rpms", "foo", repo, {"ref": sha}, sscm, dscm
+                    ),
+                    repo,
+                )
+                head = repo.commit(branch)
+                self.assertEqual(
+                    head.tree.hexsha, repo.commit(sha).tree.hexsha
+                )
+                self.assertEqual(
+                    [p.hexsha for p in head.parents], [parent]
+                )
+                self.assertTrue(
+                    head.message.startswith(
+                        "Merged update from upstream sources\n"
+                    )
+                )
+                self.assertTrue(
+                    head.message.endswith(
+                        "\n\nSource: {}#{}\n".format(sscm["link"], sha)
+                    )
+                )
+                self.assertEqual(head.author.name, "DistroBaker")
+                self.assertEqual(head.author.email, "noreply@example.com")
+                self.assertEqual(head.committer.name, "DistroBaker")
+
+    def test_sync_warm_state(self):
+        self.patch(
+            state_path=os.path.join(self.root, "state.db"), state_db=None
+        )
+        self.addCleanup(lambda: distrobaker.state_db.close())
+        sha = helpers.setup_sync_repos(self.root, "foo")
+        ref = distrobaker.sync_repo(
+            "foo", nvr="foo-1-1", scmurl=self.scmurl("foo", sha)
+        )
+        distrobaker.set_sync_state("rpms", "foo", task=42)
+        # unchanged components are skipped before anything is cloned
+        with mock.patch.object(
+            distrobaker, "clone_destination_repo"
+        ) as clone, mock.patch.object(distrobaker, "update_mirror") as update:
+            self.assertIs(
+                distrobaker.sync_repo(
+                    "foo", nvr="foo-1-1", scmurl=self.scmurl("foo", sha)
+                ),
+                False,
+            )
+            # not built yet, the recorded head is built without syncing
+            distrobaker.set_sync_state("rpms", "foo", task=None)
+            self.assertEqual(
+                distrobaker.sync_repo(
+                    "foo", nvr="foo-1-1", scmurl=self.scmurl("foo", sha)
+                ),
+                ref,
+            )
+        clone.assert_not_called()
+        update.assert_not_called()
+        # new builds are synchronized again
+        helpers.add_source_commit(self.root, "foo", "update")
+        self.assertTrue(
+            distrobaker.sync_repo(
+                "foo",
+                nvr="foo-1-2",
+                scmurl=self.scmurl(
+                    "foo", self.repo("src", "foo").commit("rawhide").hexsha
+                ),
+            )
+        )
+
+    def test_sync_up_to_date(self):
+        self.patch(
+            state_path=os.path.join(self.root, "state.db"), state_db=None
+        )
+        self.addCleanup(lambda: distrobaker.state_db.close())
+        sha = helpers.setup_sync_repos(self.root, "foo")
+        ref = distrobaker.sync_repo(
+            "foo", nvr="foo-1-1", scmurl=self.scmurl("foo", sha)
+        )
+        self.assertTrue(ref)
+        # up to date but not known to be built, the head is built
+        distrobaker.set_sync_state("rpms", "foo", head=None, task=None)
+        self.assertEqual(
+            distrobaker.sync_repo(
+                "foo", nvr="foo-1-1", scmurl=self.scmurl("foo", sha)
+            ),
+            ref,
+        )
+        self.assertEqual(
+            self.repo("dst", "foo").commit("fluff-42.0.0-alpha").hexsha, ref
+        )
+        # up to date and built
+        distrobaker.set_sync_state("rpms", "foo", head=None, task=42)
+        self.assertIs(
+            distrobaker.sync_repo(
+                "foo", nvr="foo-1-1", scmurl=self.scmurl("foo", sha)
+            ),
+            False,
+        )
+
+    def test_sync_clone_strategies(self):
+        for strategy in ("full", "shallow", "blobless"):
+            with self.subTest(clone=strategy):
+                self.cfg["main"]["control"]["clone"] = strategy
+                comp = strategy
+                sha = helpers.setup_sync_repos(self.root, comp)
+                first = distrobaker.sync_repo(
+                    comp, nvr="x-1-1", scmurl=self.scmurl(comp, sha)
+                )
+                sha = helpers.add_source_commit(self.root, comp, "update")
+                ref = distrobaker.sync_repo(
+                    comp, nvr="x-1-2", scmurl=self.scmurl(comp, sha)
+                )
+                head = self.repo("dst", comp).commit("fluff-42.0.0-alpha")
+                self.assertEqual(head.hexsha, ref)
+                self.assertEqual([p.hexsha for p in head.parents], [first])
+                self.assertEqual(
+                    head.tree.hexsha,
+                    self.repo("src", comp).commit(sha).tree.hexsha,
+                )
+                dscm = self.scms(comp)[0]
+                repo = distrobaker.clone_destination_repo(
+                    "rpms",
+                    comp,
+                    comp,
+                    dscm,
+                    os.path.join(self.root, "clone-" + comp),
+                )
+                self.assertEqual(
+                    repo.git.rev_parse("--is-shallow-repository"),
+                    "true" if strategy == "shallow" else "false",
+                )
+                self.assertEqual(
+                    repo.config_reader().get_value(
+                        'remote "origin"', "promisor", False
+                    ),
+                    strategy == "blobless",
+                )
+
+    def test_sync_blobless_without_ref(self):
+        # the default source has no ref, all source branches are fetched
+        source = self.cfg["comps"]["rpms"].resolve("foo")["source"]
+        self.assertIsNone(distrobaker.split_scmurl(source)["ref"])
+        sha = helpers.setup_sync_repos(self.root, "foo")
+        self.cfg["main"]["control"]["clone"] = "blobless"
+        ref = distrobaker.sync_repo(
+            "foo", nvr="foo-1-1", scmurl=self.scmurl("foo", sha)
+        )
+        self.assertTrue(ref)
+        head = self.repo("dst", "foo").commit("fluff-42.0.0-alpha")
+        self.assertEqual(head.hexsha, ref)
+        self.assertEqual(
+            head.tree.hexsha, self.repo("src", "foo").commit(sha).tree.hexsha
+        )
+
+    def test_mirror_update_and_eviction(self):
+        self.patch(
+            mirror_root=os.path.join(self.root, "mirror"),
+            mirror_cap=None,
+            mirror_index=None,
+        )
+        helpers.setup_sync_repos(self.root, "foo")
+        helpers.setup_sync_repos(self.root, "bar")
+        path = distrobaker.update_mirror("rpms", "foo", *self.scms("foo"))
+        self.assertEqual(
+            path, os.path.join(self.root, "mirror", "rpms", "foo.git")
+        )
+        # updates fetch new source commits
+        sha = helpers.add_source_commit(self.root, "foo", "update")
+        distrobaker.update_mirror("rpms", "foo", *self.scms("foo"))
+        self.assertEqual(
+            git.Repo(path).commit("refs/remotes/source/rawhide").hexsha, sha
+        )
+        self.assertEqual(list(distrobaker.mirror_index), [path])
+        # only one mirror fits, the least recently used one goes
+        distrobaker.mirror_size(distrobaker.mirror_index[path][1] + 1024)
+        other = distrobaker.update_mirror("rpms", "bar", *self.scms("bar"))
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(other))
+        self.assertEqual(list(distrobaker.mirror_index), [other])
+
+    def test_sync_cache_total_limit(self):
+        self.patch(cache_workers=4, cache_limit=None, cache_slots=None)
+        distrobaker.cache_jobs_total(2)
+        lock = threading.Lock()
+        active = list()
+        peak = list()
+
+        def transfer(comp, ns, s, scname, dcname, dirname, check=True):
+            with lock:
+                active.append(s)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(s)
+            return True
+
+        sources = {
+            comp: {
+                "md5": [
+                    ("{}-{}.tar.gz".format(comp, i), str(i), "md5")
+                    for i in range(4)
+                ]
+            }
+            for comp in ("foo", "bar")
+        }
+        with mock.patch.object(
+            distrobaker, "check_cache", return_value=(set(), set())
+        ), mock.patch.object(distrobaker, "sync_cache_file", transfer):
+            threads = [
+                threading.Thread(
+                    target=distrobaker.sync_cache, args=(comp, sources[comp])
+                )
+                for comp in sources
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(len(peak), 8)
+        self.assertEqual(max(peak), 2)
+
+    def test_pipeline(self):
+        self.patch(stage_workers={x: 1 for x in distrobaker.stage_names})
+        helpers.setup_sync_repos(self.root, "foo")
+        helpers.setup_sync_repos(self.root, "bar")
+        seen = list()
+        tempdirs = list()
+
+        def stage(name):
+            run = distrobaker.sync_stages[name]
+
+            def wrapper(job):
+                seen.append(
+                    (job["comp"], name, threading.current_thread().name)
+                )
+                if "tempdir" in job:
+                    tempdirs.append(job["tempdir"].name)
+                if name == "cache" and job["comp"] == "bar":
+                    raise RuntimeError("broken")
+                return run(job)
+
+            return wrapper
+
+        patcher = mock.patch.dict(
+            distrobaker.sync_stages,
+            {x: stage(x) for x in distrobaker.stage_names},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        jobs = dict()
+
+        def run(comp):
+            jobs[comp] = distrobaker.run_pipeline(
+                comp,
+                nvr="{}-1-1".format(comp),
+                scmurl=self.scmurl(
+                    comp, self.repo("src", comp).commit("rawhide").hexsha
+                ),
+            )
+
+        with mock.patch.object(
+            distrobaker, "find_builds", return_value=dict()
+        ), mock.patch.object(
+            distrobaker, "build_comp", return_value=42
+        ) as build_comp:
+            threads = [
+                threading.Thread(target=run, args=(x,)) for x in ("foo", "bar")
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(60)
+        # each stage runs in its own worker and hands the job to the next
+        self.assertEqual(
+            [(x[1], x[2]) for x in seen if x[0] == "foo"],
+            [
+                (x, "distrobaker-{}-0".format(x))
+                for x in distrobaker.stage_names
+            ],
+        )
+        self.assertEqual(
+            jobs["foo"]["ref"],
+            self.repo("dst", "foo").commit("fluff-42.0.0-alpha").hexsha,
+        )
+        self.assertEqual(jobs["foo"]["task"], 42)
+        build_comp.assert_called_once()
+        self.assertEqual(
+            build_comp.call_args.args, ("foo", jobs["foo"]["ref"])
+        )
+        # failures skip the remaining stages and reach the build stage
+        self.assertEqual(
+            [x[1] for x in seen if x[0] == "bar"], ["git", "cache", "build"]
+        )
+        self.assertIsNone(jobs["bar"]["ref"])
+        self.assertNotIn("task", jobs["bar"])
+        # temporary directories do not outlive the jobs
+        self.assertTrue(tempdirs)
+        for job in jobs.values():
+            self.assertNotIn("tempdir", job)
+            self.assertNotIn("repo", job)
+        for path in tempdirs:
+            self.assertFalse(os.path.exists(path))
+
+    def test_process_components_parallel(self):
+        self.patch(workers=4)
+        barrier = threading.Barrier(4, timeout=10)
+
+        def process(rec, builds=None):
+            # all components are in progress at the same time
+            barrier.wait()
+            if rec == "rpms/bar":
+                raise RuntimeError("broken")
+            return {"comp": rec}
+
+        with mock.patch.object(
+            distrobaker, "resolve_builds", return_value=dict()
+        ), mock.patch.object(
+            distrobaker, "process_component", process
+        ), self.assertLogs(
+            distrobaker.logger, level="INFO"
+        ) as cm:
+            distrobaker.process_components(
+                {"rpms/foo", "rpms/bar", "rpms/baz", "rpms/qux"}
+            )
+        # the failure does not abort the other components
+        self.assertIn(
+            "Synchronized 3 component(s), 1 skipped.",
+            "\n".join(cm.output),
+        )
+
+    def test_stream_cache_file(self):
+        content = os.urandom(300000)
+        uploads = list()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def reply(self, body):
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(content)
+
+            def do_HEAD(self):
+                self.reply(False)
+
+            def do_GET(self):
+                self.reply(True)
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                body = self.rfile.read(length)
+                if len(body) == length:
+                    uploads.append((self.headers["Content-Type"], body))
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:{}".format(server.server_port)
+        scache = mock.Mock()
+        scache.get_download_url.return_value = url + "/foo.tar.gz"
+        dcache = mock.Mock(upload_url=url + "/upload.cgi")
+        digest = hashlib.sha512(content).hexdigest()
+        self.assertTrue(
+            distrobaker.stream_cache_file(
+                "foo",
+                "rpms",
+                ("foo.tar.gz", digest, "sha512"),
+                scache,
+                dcache,
+                "foo",
+                "bar",
+            )
+        )
+        ctype, body = uploads[0]
+        message = email.message_from_bytes(
+            b"Content-Type: " + ctype.encode() + b"\r\n\r\n" + body
+        )
+        fields = {
+            part.get_param("name", header="content-disposition"): part
+            for part in message.get_payload()
+        }
+        self.assertEqual(fields["name"].get_payload(), "rpms/bar")
+        self.assertEqual(fields["sha512sum"].get_payload(), digest)
+        self.assertEqual(fields["file"].get_filename(), "foo.tar.gz")
+        self.assertEqual(fields["file"].get_payload(decode=True), content)
+        # a mismatching file is never uploaded in full
+        with self.assertRaises(IOError) as cm:
+            distrobaker.stream_cache_file(
+                "foo",
+                "rpms",
+                ("foo.tar.gz", "0" * 128, "sha512"),
+                scache,
+                dcache,
+                "foo",
+                "bar",
+            )
+        self.assertEqual(len(uploads), 1)
+        self.assertTrue(distrobaker.is_retryable(cm.exception))
+
+
+class TestTriggers(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.root = tempdir.name
+        patchers = [
+            mock.patch.dict(distrobaker.c),
+            mock.patch.object(distrobaker, "pending", dict()),
+            mock.patch.object(distrobaker, "running", set()),
+            mock.patch.object(distrobaker, "synced", dict()),
+            mock.patch.object(distrobaker, "state_path", None),
+            mock.patch.object(distrobaker, "state_db", None),
+            mock.patch.object(distrobaker, "debounce", 0),
+            mock.patch.object(distrobaker, "worker_threads", list()),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        helpers.setup_sync_config(self.root)
+
+    def message(self, name, release=1):
+        return mock.Mock(
+            topic="org.fedoraproject.prod.buildsys.tag",
+            body={
+                "name": name,
+                "version": "1.0",
+                "release": str(release),
+                "tag": "rawhide",
+            },
+        )
+
+    def use_state(self):
+        distrobaker.state_path = os.path.join(self.root, "state.db")
+        self.addCleanup(lambda: distrobaker.state_db.close())
+
+    def test_enqueue_message_acks_after_recording(self):
+        self.use_state()
+        distrobaker.enqueue_message(self.message("foo"))
+        self.assertEqual(
+            distrobaker.state_query("SELECT ns, comp, nvr FROM queue"),
+            [("rpms", "foo", "foo-1.0-1")],
+        )
+        self.assertEqual(distrobaker.pending[("rpms", "foo")]["rowids"], [1])
+        nack = distrobaker.fedora_messaging.exceptions.Nack
+        with mock.patch.object(distrobaker, "state_query", return_value=None):
+            with self.assertRaises(nack):
+                distrobaker.enqueue_message(self.message("bar"))
+        self.assertNotIn(("rpms", "bar"), distrobaker.pending)
+
+    def test_enqueue_message_without_state_waits(self):
+        processed = list()
+
+        def process(comp, nvr, ns="rpms"):
+            processed.append((ns, comp, nvr))
+            return 1
+
+        patcher = mock.patch.object(distrobaker, "process_trigger", process)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        threads = distrobaker.start_workers(1)
+        self.addCleanup(distrobaker.stop_workers, 10)
+        distrobaker.enqueue_message(self.message("foo"))
+        # returning acknowledges the message; the trigger is done by then
+        self.assertEqual(processed, [("rpms", "foo", "foo-1.0-1")])
+        self.assertEqual(distrobaker.synced[("rpms", "foo")], "foo-1.0-1")
+        # replayed messages are not processed again
+        distrobaker.enqueue_message(self.message("foo"))
+        self.assertEqual(len(processed), 1)
+        # stopped workers leave further triggers queued
+        self.assertTrue(distrobaker.stop_workers(10))
+        self.assertFalse(any(t.is_alive() for t in threads))
+        distrobaker.queue_trigger(None, "rpms", "bar", "bar-1.0-1", delay=0)
+        self.assertIn(("rpms", "bar"), distrobaker.pending)
+        self.assertEqual(len(processed), 1)
+
+    def test_replayed_trigger_dropped(self):
+        self.use_state()
+        distrobaker.synced[("rpms", "foo")] = "foo-1.0-1"
+        distrobaker.enqueue_message(self.message("foo"))
+        self.assertEqual(distrobaker.pending, dict())
+        self.assertEqual(distrobaker.state_query("SELECT * FROM queue"), [])
+        distrobaker.enqueue_message(self.message("foo", release=2))
+        self.assertEqual(
+            distrobaker.pending[("rpms", "foo")]["nvr"], "foo-1.0-2"
+        )
+
+    def test_component_serialization(self):
+        distrobaker.queue_trigger(None, "rpms", "foo", "foo-1.0-1", delay=0)
+        distrobaker.queue_trigger(None, "rpms", "bar", "bar-1.0-1", delay=0)
+        distrobaker.running.add(("rpms", "foo"))
+        # foo is being processed, its new trigger must wait
+        self.assertEqual(
+            distrobaker.next_trigger()[:3], ("rpms", "bar", "bar-1.0-1")
+        )
+        self.assertIn(("rpms", "bar"), distrobaker.running)
+        self.assertIn(("rpms", "foo"), distrobaker.pending)
+
+    def test_burst_coalesced(self):
+        distrobaker.debounce = 0.2
+        started = time.monotonic()
+        for release in range(1, 6):
+            distrobaker.queue_trigger(
+                release, "rpms", "foo", "foo-1.0-{}".format(release)
+            )
+            time.sleep(0.05)
+        self.assertEqual(len(distrobaker.pending), 1)
+        # the burst is processed once, with the newest NVR, once it settled
+        ns, comp, nvr, rowids, waiters = distrobaker.next_trigger()
+        self.assertGreaterEqual(time.monotonic() - started, 0.4)
+        self.assertEqual((comp, nvr), ("foo", "foo-1.0-5"))
+        self.assertEqual(rowids, [1, 2, 3, 4, 5])
+        self.assertEqual(distrobaker.pending, dict())
+
+    def test_out_of_order_triggers(self):
+        distrobaker.queue_trigger(None, "rpms", "foo", "foo-1.0-2", delay=0)
+        distrobaker.queue_trigger(None, "rpms", "foo", "foo-1.0-1", delay=0)
+        # the older late arrival does not replace the newer NVR
+        self.assertEqual(
+            distrobaker.pending[("rpms", "foo")]["nvr"], "foo-1.0-2"
+        )
+        distrobaker.queue_trigger(None, "rpms", "foo", "foo-1.0-10", delay=0)
+        self.assertEqual(
+            distrobaker.pending[("rpms", "foo")]["nvr"], "foo-1.0-10"
+        )